@@ -0,0 +1,92 @@
+"""
+    Throughput and memory of the sentence encoder backends (SBERT_CONFIG.backend). Each backend is measured in its own
+    process, so the RSS of one does not include the others. The ONNX models are exported on first use and their
+    parity against torch is reported.
+
+    python -m benchmarks.encoder_benchmark --backends torch onnx onnx-int8 --chunks 512 --queries 256
+"""
+import argparse
+import json
+import os
+import random
+import resource
+import subprocess
+import sys
+import time
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Sentence encoder backend benchmark")
+    parser.add_argument("--backends", nargs="+", choices=["torch", "onnx", "onnx-int8"],
+                        default=["torch", "onnx", "onnx-int8"])
+    parser.add_argument("--chunks", type=int, default=512, help="Chunk sized texts encoded in batches")
+    parser.add_argument("--queries", type=int, default=256, help="Questions encoded one at a time")
+    parser.add_argument("--worker", default=None, help=argparse.SUPPRESS)
+    return parser.parse_args()
+
+
+def rss_mb():
+    scale = 1024 * 1024 if sys.platform == "darwin" else 1024
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale, 1)
+
+
+def measure(backend, args):
+    from benchmarks.synthetic_corpus import generate_questions, generate_sentence
+    from src.agent.model_registry import load_embeddings_model, model_registry
+
+    rng = random.Random(11)
+    chunks = [" ".join(generate_sentence(rng) for _ in range(8)) for _ in range(args.chunks)]
+    questions = generate_questions(args.queries)
+
+    sbert_config = model_registry.config.model_copy(update=dict(backend=backend))
+    rss_before = rss_mb()
+    start_time = time.perf_counter()
+    encoder, loaded_backend = load_embeddings_model(sbert_config)
+    load_seconds = time.perf_counter() - start_time
+    encoder.embed_documents(questions[:8])
+
+    start_time = time.perf_counter()
+    encoder.embed_documents(chunks)
+    documents_seconds = time.perf_counter() - start_time
+
+    start_time = time.perf_counter()
+    for question in questions:
+        encoder.embed_query(question)
+    queries_seconds = time.perf_counter() - start_time
+
+    result = dict(backend=loaded_backend, load_seconds=round(load_seconds, 2),
+                  documents_per_sec=round(len(chunks) / documents_seconds, 1),
+                  queries_per_sec=round(len(questions) / queries_seconds, 1),
+                  query_p50_ms=round(queries_seconds / len(questions) * 1000, 2),
+                  rss_before_load_mb=rss_before, peak_rss_mb=rss_mb())
+    if loaded_backend != "torch":
+        from src.agent.onnx_encoder import read_manifest
+
+        result["parity"] = read_manifest(sbert_config.model_path)[loaded_backend]["parity"]
+    return result
+
+
+def main():
+    args = parse_args()
+    os.chdir(ROOT_DIR)
+    sys.path.insert(0, ROOT_DIR)
+    if args.worker:
+        print(json.dumps(measure(args.worker, args)))
+        return
+
+    results = {}
+    for backend in args.backends:
+        output = subprocess.run([sys.executable, "-m", "benchmarks.encoder_benchmark", "--worker", backend,
+                                 "--chunks", str(args.chunks), "--queries", str(args.queries)],
+                                cwd=ROOT_DIR, capture_output=True, text=True)
+        if output.returncode:
+            results[backend] = dict(error=output.stderr.strip().splitlines()[-1:])
+        else:
+            results[backend] = json.loads(output.stdout.strip().splitlines()[-1])
+    print(json.dumps(dict(chunks=args.chunks, queries=args.queries, results=results), indent=2))
+
+
+if __name__ == "__main__":
+    main()
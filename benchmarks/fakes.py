@@ -0,0 +1,74 @@
+"""
+    Local stand-ins so the benchmarks run without network access: a chat model, a Slack client and
+    a deterministic embedding model for runs without the SBERT weights.
+"""
+import asyncio
+import hashlib
+
+import numpy as np
+from langchain_core.messages import AIMessage, AIMessageChunk
+
+FAKE_ANSWER = ("**Answer**\n\n- The policy applies to **all employees**.\n- Requests must be approved in advance.\n"
+               "- Violations are reported to the compliance officer.")
+
+
+class FakeChatModel:
+    """
+        Mimics ChatOpenAI.ainvoke/astream with a fixed latency.
+    """
+
+    def __init__(self, latency=0.05, answer=FAKE_ANSWER):
+        self.latency = latency
+        self.answer = answer
+        self.calls = 0
+
+    async def ainvoke(self, prompt, **kwargs):
+        self.calls += 1
+        await asyncio.sleep(self.latency)
+        return AIMessage(content=self.answer)
+
+    async def astream(self, prompt, **kwargs):
+        self.calls += 1
+        tokens = self.answer.split(" ")
+        for k, token in enumerate(tokens):
+            await asyncio.sleep(self.latency / len(tokens))
+            yield AIMessageChunk(content=token if k == 0 else f" {token}")
+
+
+class FakeSlackClient:
+    """
+        Mimics slack_sdk AsyncWebClient.chat_postMessage.
+    """
+
+    messages = []
+
+    def __init__(self, token=None, latency=0.02, **kwargs):
+        self.latency = latency
+
+    async def chat_postMessage(self, **kwargs):
+        await asyncio.sleep(self.latency)
+        FakeSlackClient.messages.append(kwargs)
+        return dict(ok=True, ts=str(len(FakeSlackClient.messages)), channel=kwargs.get("channel"))
+
+
+class HashingEmbeddings:
+    """
+        Deterministic bag-of-words embeddings with the SentenceTransformerEmbeddings interface.
+    """
+
+    def __init__(self, dimensions=768):
+        self.dimensions = dimensions
+
+    def __embed__(self, text):
+        vector = np.zeros(self.dimensions, dtype=np.float32)
+        for token in text.lower().split():
+            digest = hashlib.md5(token.encode()).digest()
+            vector[int.from_bytes(digest[:4], "little") % self.dimensions] += 1.0
+        norm = np.linalg.norm(vector)
+        return (vector / norm if norm else vector).tolist()
+
+    def embed_documents(self, texts):
+        return [self.__embed__(text) for text in texts]
+
+    def embed_query(self, text):
+        return self.__embed__(text)
@@ -0,0 +1,89 @@
+"""
+    Local stand-in for the OpenAI chat completions API, to exercise the LLM gateway without network access.
+    Answers after a fixed latency and can inject rate limits and server errors.
+
+    python -m benchmarks.mock_openai_server --port 8090 --rate-limit-every 5 --error-rate 0.05
+    OPENAI_BASE_URL=http://127.0.0.1:8090/v1 python -m src.main
+"""
+import argparse
+import asyncio
+import json
+import random
+import time
+import uuid
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+from benchmarks.fakes import FAKE_ANSWER
+
+
+def create_app(latency=0.05, rate_limit_every=0, error_rate=0.0, retry_after=0.1):
+    app = FastAPI(title="Mock OpenAI")
+    stats = dict(requests=0, completions=0, rate_limited=0, errors=0, prompts={})
+
+    def completion_chunk(completion_id, model, delta, finish_reason=None):
+        return dict(id=completion_id, object="chat.completion.chunk", created=int(time.time()), model=model,
+                    choices=[dict(index=0, delta=delta, finish_reason=finish_reason)])
+
+    @app.post("/v1/chat/completions")
+    async def chat_completions(request: Request):
+        body = await request.json()
+        stats["requests"] += 1
+        if rate_limit_every and stats["requests"] % rate_limit_every == 0:
+            stats["rate_limited"] += 1
+            return JSONResponse(status_code=429, headers={"retry-after": str(retry_after)},
+                                content=dict(error=dict(message="Rate limit reached", type="rate_limit_exceeded")))
+        if random.random() < error_rate:
+            stats["errors"] += 1
+            return JSONResponse(status_code=500, content=dict(error=dict(message="Server error", type="server_error")))
+
+        prompt = "".join(message.get("content") or "" for message in body.get("messages", []))
+        stats["prompts"][prompt] = stats["prompts"].get(prompt, 0) + 1
+        stats["completions"] += 1
+        model = body.get("model", "mock")
+        completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+        usage = dict(prompt_tokens=len(prompt) // 4, completion_tokens=len(FAKE_ANSWER) // 4,
+                     total_tokens=(len(prompt) + len(FAKE_ANSWER)) // 4)
+
+        if body.get("stream"):
+            async def event_stream():
+                tokens = FAKE_ANSWER.split(" ")
+                for k, token in enumerate(tokens):
+                    await asyncio.sleep(latency / len(tokens))
+                    chunk = completion_chunk(completion_id, model, dict(content=token if k == 0 else f" {token}"))
+                    yield f"data: {json.dumps(chunk)}\n\n"
+                yield f"data: {json.dumps(completion_chunk(completion_id, model, {}, 'stop'))}\n\n"
+                yield "data: [DONE]\n\n"
+
+            return StreamingResponse(event_stream(), media_type="text/event-stream")
+
+        await asyncio.sleep(latency)
+        return dict(id=completion_id, object="chat.completion", created=int(time.time()), model=model,
+                    choices=[dict(index=0, message=dict(role="assistant", content=FAKE_ANSWER),
+                                  finish_reason="stop")],
+                    usage=usage)
+
+    @app.get("/stats")
+    async def get_stats():
+        return dict(stats, duplicate_prompts=sum(count - 1 for count in stats["prompts"].values()), prompts=None)
+
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Mock OpenAI chat completions server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8090)
+    parser.add_argument("--latency", type=float, default=0.05, help="Latency of a completion (s)")
+    parser.add_argument("--rate-limit-every", type=int, default=0, help="Answer every Nth request with a 429")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of requests answered with a 500")
+    parser.add_argument("--retry-after", type=float, default=0.1, help="Retry-After of the 429 responses (s)")
+    args = parser.parse_args()
+    uvicorn.run(create_app(args.latency, args.rate_limit_every, args.error_rate, args.retry_after),
+                host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+"""
+    Local stand-in for the Slack Web API chat.postMessage method, to exercise the Slack outbox without network access.
+    Answers after a fixed latency and can inject rate limits and server errors.
+
+    python -m benchmarks.mock_slack_server --port 8091 --rate-limit-every 5
+    SLACK_API_URL=http://127.0.0.1:8091/api/ python -m src.main
+"""
+import argparse
+import asyncio
+import random
+import time
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+
+
+def create_app(latency=0.02, rate_limit_every=0, error_rate=0.0, retry_after=1):
+    app = FastAPI(title="Mock Slack")
+    stats = dict(requests=0, messages=0, threads=0, replies=0, rate_limited=0, errors=0)
+    messages = []
+
+    @app.post("/api/chat.postMessage")
+    async def chat_post_message(request: Request):
+        body = await request.json()
+        stats["requests"] += 1
+        if rate_limit_every and stats["requests"] % rate_limit_every == 0:
+            stats["rate_limited"] += 1
+            return JSONResponse(status_code=429, headers={"Retry-After": str(retry_after)},
+                                content=dict(ok=False, error="ratelimited"))
+        if random.random() < error_rate:
+            stats["errors"] += 1
+            return JSONResponse(status_code=500, content=dict(ok=False, error="internal_error"))
+
+        await asyncio.sleep(latency)
+        ts = f"{time.time():.6f}"
+        stats["messages"] += 1
+        stats["replies" if body.get("thread_ts") else "threads"] += 1
+        messages.append(dict(body, ts=ts))
+        return dict(ok=True, channel=body.get("channel"), ts=ts, message=dict(text=body.get("text"), ts=ts))
+
+    @app.get("/stats")
+    async def get_stats():
+        return stats
+
+    @app.get("/messages")
+    async def get_messages():
+        return messages
+
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Mock Slack chat.postMessage server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8091)
+    parser.add_argument("--latency", type=float, default=0.02, help="Latency of a post (s)")
+    parser.add_argument("--rate-limit-every", type=int, default=0, help="Answer every Nth request with a 429")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of requests answered with a 500")
+    parser.add_argument("--retry-after", type=int, default=1, help="Retry-After of the 429 responses (s)")
+    args = parser.parse_args()
+    uvicorn.run(create_app(args.latency, args.rate_limit_every, args.error_rate, args.retry_after),
+                host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
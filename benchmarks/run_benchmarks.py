@@ -0,0 +1,237 @@
+"""
+    Ingestion and retrieval benchmarks against embedded Weaviate, with local stand-ins for OpenAI and Slack.
+
+    python -m benchmarks.run_benchmarks --documents 10 --pages 30 --concurrency 1 4 16
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Document agent ingestion and retrieval benchmarks")
+    parser.add_argument("--documents", type=int, default=5, help="Number of synthetic PDF documents")
+    parser.add_argument("--pages", type=int, default=20, help="Pages per document")
+    parser.add_argument("--lines", type=int, default=60, help="Lines of text per page")
+    parser.add_argument("--queries", type=int, default=200, help="Queries per concurrency level")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 16], help="Concurrency levels")
+    parser.add_argument("--llm-latency", type=float, default=0.05, help="Latency of the fake chat model (s)")
+    parser.add_argument("--openai-base-url", default=None,
+                        help="Send the LLM calls to an OpenAI compatible server such as benchmarks.mock_openai_server "
+                             "instead of the in-process fake chat model")
+    parser.add_argument("--slack-api-url", default=None,
+                        help="Post the Slack messages to a compatible server such as benchmarks.mock_slack_server "
+                             "instead of the in-process fake client")
+    parser.add_argument("--backend", choices=["weaviate", "local"], default="weaviate",
+                        help="Vector backend, embedded Weaviate or the in-process local index")
+    parser.add_argument("--search-mode", choices=["vector", "hybrid"], default="vector",
+                        help="Retrieval mode of the end-to-end queries")
+    parser.add_argument("--fake-embeddings", action="store_true",
+                        help="Use deterministic hashing embeddings instead of the SBERT model")
+    parser.add_argument("--work-dir", default=os.path.join(ROOT_DIR, "benchmarks", ".work"),
+                        help="Folder for the corpus and the embedded Weaviate data")
+    parser.add_argument("--output-dir", default=os.path.join(ROOT_DIR, "benchmarks", "results"),
+                        help="Folder the JSON results are written to")
+    return parser.parse_args()
+
+
+def configure_environment(args):
+    # The configuration is read at import time, the keys of agent-document.yml can be overridden from the environment
+    os.chdir(ROOT_DIR)
+    sys.path.insert(0, ROOT_DIR)
+    os.environ["ENVIRONMENT_NAME"] = "local"
+    os.environ["DOWNLOAD_FOLDER"] = os.path.join(args.work_dir, "download_data")
+    os.environ["VECTOR_DB_PATH"] = os.path.join(args.work_dir, "data_weaviate")
+    os.environ["VECTOR_BACKEND"] = args.backend
+    if args.openai_base_url:
+        os.environ["OPENAI_BASE_URL"] = args.openai_base_url
+        os.environ.setdefault("OPENAI_API_KEY", "mock")
+    if args.slack_api_url:
+        os.environ["SLACK_API_URL"] = args.slack_api_url
+    # The outbox posts nothing without a token, the fake client and the mock server accept any
+    os.environ["SLACK_TOKEN"] = os.environ.get("SLACK_TOKEN") or "mock"
+    shutil.rmtree(os.environ["DOWNLOAD_FOLDER"], ignore_errors=True)
+
+
+def latency_stats(latencies, elapsed):
+    values = np.asarray(latencies) * 1000
+    return dict(count=len(values), throughput_per_sec=round(len(values) / elapsed, 2),
+                mean_ms=round(float(values.mean()), 3),
+                p50_ms=round(float(np.percentile(values, 50)), 3),
+                p95_ms=round(float(np.percentile(values, 95)), 3),
+                p99_ms=round(float(np.percentile(values, 99)), 3))
+
+
+async def run_concurrently(coroutine_factory, items, concurrency):
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+
+    async def timed(item):
+        async with semaphore:
+            start_time = time.perf_counter()
+            await coroutine_factory(item)
+            latencies.append(time.perf_counter() - start_time)
+
+    start_time = time.perf_counter()
+    await asyncio.gather(*(timed(item) for item in items))
+    return latency_stats(latencies, time.perf_counter() - start_time)
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    scale = 1024 * 1024 if sys.platform == "darwin" else 1024
+    return dict(self=round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale, 1),
+                children=round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / scale, 1))
+
+
+def get_git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT_DIR, text=True).strip()
+    except Exception:
+        return None
+
+
+def benchmark_ingestion(args):
+    from benchmarks.synthetic_corpus import generate_corpus
+    from src.agent.embedding_generation import GenerateEmbedding
+    from src.agent.ingestion_manifest import IngestionManifest
+    from src.agent.keyword_index import keyword_indexes
+    from src.agent.vector_db_client import vector_backend
+
+    vector_backend.drop(GenerateEmbedding.collection_name)
+    keyword_indexes.get(GenerateEmbedding.collection_name).drop()
+    if os.path.exists(IngestionManifest(GenerateEmbedding.collection_name).manifest_path):
+        os.remove(IngestionManifest(GenerateEmbedding.collection_name).manifest_path)
+
+    paths = generate_corpus(os.environ["DOWNLOAD_FOLDER"], documents=args.documents, pages_per_document=args.pages,
+                            lines_per_page=args.lines)
+    start_time = time.perf_counter()
+    GenerateEmbedding().execute()
+    elapsed_time = time.perf_counter() - start_time
+
+    chunks = sum(len(entry["chunk_ids"]) for entry in IngestionManifest(GenerateEmbedding.collection_name)
+                 .entries.values())
+    return dict(documents=len(paths), pages=len(paths) * args.pages, chunks=chunks,
+                seconds=round(elapsed_time, 3), chunks_per_sec=round(chunks / elapsed_time, 2))
+
+
+def benchmark_maintenance():
+    from src.agent.maintenance import CollectionMaintenance, purge_document
+    from src.agent.tenants import tenants
+
+    tenant = tenants.resolve()
+    # One document purged, then a maintenance pass over what is left
+    file_name = sorted(name for name in os.listdir(tenant.upload_dir) if name.endswith(".pdf"))[0]
+    start_time = time.perf_counter()
+    purged = purge_document(tenant, file_name)
+    purge_seconds = time.perf_counter() - start_time
+
+    start_time = time.perf_counter()
+    report = CollectionMaintenance(tenant, fix=True).run()
+    return dict(purge=dict(chunks_deleted=purged.chunks_deleted, seconds=round(purge_seconds, 3)),
+                maintenance=dict(rows=report["rows"], orphan_rows=report["orphan_rows"],
+                                 duplicate_rows=report["duplicate_rows"], steps_seconds=report["seconds"],
+                                 seconds=round(time.perf_counter() - start_time, 3)))
+
+
+async def benchmark_queries(args):
+    from benchmarks.synthetic_corpus import generate_questions
+    from src.agent.controller import DocumentAgent
+    from src.agent.vector_db_client import aexecute_pure_vector_search_without_filters
+
+    questions = generate_questions(args.queries)
+    retrieval, end_to_end = {}, {}
+    for concurrency in args.concurrency:
+        retrieval[concurrency] = await run_concurrently(
+            lambda question: aexecute_pure_vector_search_without_filters(question, DocumentAgent.collection_name,
+                                                                         DocumentAgent.search_limit),
+            questions, concurrency)
+        end_to_end[concurrency] = await run_concurrently(
+            lambda question: DocumentAgent(queries=[question], search_mode=args.search_mode).execute(),
+            questions, concurrency)
+    return retrieval, end_to_end
+
+
+async def run(args):
+    from benchmarks.fakes import FakeChatModel, FakeSlackClient, HashingEmbeddings
+    import src.agent.slack_outbox as agent_slack_outbox
+    from src.agent.answer_cache import answer_cache
+    from src.agent.controller import DocumentAgent
+    from src.agent.executors import executors
+    from src.agent.llm_gateway import llm_gateway
+    from src.agent.model_registry import model_registry
+    from src.agent.retrieval_cache import retrieval_cache
+    from src.agent.slack_outbox import slack_outbox
+    from src.agent.vector_db_client import vector_backend
+
+    if args.fake_embeddings:
+        model_registry.set(HashingEmbeddings(), "hashing")
+        # MIN_DISTANCE is calibrated for SBERT, hashing embeddings keep every retrieved chunk
+        DocumentAgent.context_builder.min_distance = 2.0
+    else:
+        model_registry.load()
+    # The LLM calls go through the gateway, to the fake chat model or to the mock server
+    fake_model = None if args.openai_base_url else FakeChatModel(latency=args.llm_latency)
+    if not args.slack_api_url:
+        agent_slack_outbox.AsyncWebClient = FakeSlackClient
+    slack_outbox.config.spool_dir = os.path.join(args.work_dir, "spool", "slack")
+    # Every query has to reach the encoder, the vector database and the model
+    answer_cache.config.enabled = False
+    retrieval_cache.config.enabled = False
+
+    executors.start()
+    vector_backend.start()
+    llm_gateway.start(model=fake_model)
+    slack_outbox.start()
+    try:
+        ingestion = await asyncio.to_thread(benchmark_ingestion, args)
+        retrieval, end_to_end = await benchmark_queries(args)
+        # After the queries, so that the purged document does not change what they retrieve
+        maintenance = await asyncio.to_thread(benchmark_maintenance)
+        # Slack delivery is off the response path, measured separately once the queries are done
+        start_time = time.perf_counter()
+        await slack_outbox.join()
+        slack_drain_seconds = round(time.perf_counter() - start_time, 3)
+    finally:
+        await slack_outbox.stop()
+        await llm_gateway.aclose()
+        await vector_backend.aclose()
+        executors.shutdown()
+
+    return dict(run=dict(timestamp=time.strftime("%Y-%m-%dT%H:%M:%S"), git_commit=get_git_commit(),
+                         python=platform.python_version(), platform=platform.platform(), cpu_count=os.cpu_count(),
+                         arguments={key: value for key, value in vars(args).items()
+                                    if key not in ("work_dir", "output_dir")}),
+                ingestion=ingestion, retrieval=retrieval, end_to_end=end_to_end, maintenance=maintenance,
+                peak_rss_mb=peak_rss_mb(),
+                llm_calls=fake_model.calls if fake_model else None,
+                slack_messages=None if args.slack_api_url else len(FakeSlackClient.messages),
+                slack_drain_seconds=slack_drain_seconds)
+
+
+def main():
+    args = parse_args()
+    configure_environment(args)
+    results = asyncio.run(run(args))
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    output_path = os.path.join(args.output_dir, f"benchmark_{time.strftime('%Y%m%d_%H%M%S')}.json")
+    with open(output_path, "w") as f:
+        json.dump(results, f, indent=2)
+    print(json.dumps(results, indent=2))
+    print(f"Results written to {output_path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+"""
+    Cold start and memory of the multi-worker modes: uvicorn workers that each load the model, against gunicorn
+    workers forked from a preloaded master. Reports the time until /ready answers 200 and the RSS and PSS of every
+    process. PSS splits shared pages between the processes that map them, so it shows the copy-on-write sharing.
+
+    python -m benchmarks.startup_benchmark --workers 4 --mode uvicorn preload
+"""
+import argparse
+import json
+import os
+import signal
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.request
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Document agent startup benchmark")
+    parser.add_argument("--workers", type=int, default=4, help="Number of worker processes")
+    parser.add_argument("--mode", nargs="+", choices=["uvicorn", "preload"], default=["uvicorn", "preload"])
+    parser.add_argument("--port", type=int, default=9102)
+    parser.add_argument("--timeout", type=float, default=300, help="Seconds to wait for /ready")
+    return parser.parse_args()
+
+
+def get_command(mode, args):
+    if mode == "uvicorn":
+        return [sys.executable, "-m", "uvicorn", "src.main:app", "--port", str(args.port),
+                "--workers", str(args.workers)]
+    return [sys.executable, "-m", "gunicorn", "-c", "gunicorn.conf.py", "--bind", f"127.0.0.1:{args.port}",
+            "--workers", str(args.workers), "src.main:app"]
+
+
+def read_memory_kb(pid):
+    memory = {}
+    try:
+        with open(f"/proc/{pid}/smaps_rollup") as f:
+            for line in f:
+                key, value = line.split(":", 1)
+                if key in ("Rss", "Pss"):
+                    memory[key.lower()] = int(value.split()[0])
+    except (OSError, ValueError):
+        pass
+    return memory
+
+
+def get_children(pid):
+    try:
+        with open(f"/proc/{pid}/task/{pid}/children") as f:
+            return [int(child) for child in f.read().split()]
+    except OSError:
+        return []
+
+
+def wait_ready(port, timeout, ready_workers):
+    """
+        Polls /ready until `ready_workers` answers in a row are 200, each one may come from another worker.
+    """
+    start_time = time.perf_counter()
+    first_ready, consecutive = None, 0
+    while time.perf_counter() - start_time < timeout:
+        try:
+            with urllib.request.urlopen(f"http://127.0.0.1:{port}/ready", timeout=5) as response:
+                consecutive += response.status == 200
+                first_ready = first_ready or time.perf_counter() - start_time
+        except (urllib.error.URLError, ConnectionError, OSError):
+            consecutive = 0
+        if consecutive >= ready_workers:
+            return first_ready, time.perf_counter() - start_time
+        time.sleep(0.1)
+    return first_ready, None
+
+
+def measure(mode, args):
+    process = subprocess.Popen(get_command(mode, args), cwd=ROOT_DIR, stdout=subprocess.DEVNULL,
+                               stderr=subprocess.DEVNULL, start_new_session=True)
+    try:
+        first_ready, all_ready = wait_ready(args.port, args.timeout, args.workers * 2)
+        workers = get_children(process.pid)
+        processes = {str(pid): read_memory_kb(pid) for pid in [process.pid, *workers]}
+        worker_memory = [processes[str(pid)] for pid in workers if processes[str(pid)]]
+        return dict(first_ready_seconds=round(first_ready, 2) if first_ready else None,
+                    all_ready_seconds=round(all_ready, 2) if all_ready else None,
+                    total_pss_mb=round(sum(memory.get("pss", 0) for memory in processes.values()) / 1024, 1),
+                    worker_rss_mb=[round(memory.get("rss", 0) / 1024, 1) for memory in worker_memory],
+                    worker_pss_mb=[round(memory.get("pss", 0) / 1024, 1) for memory in worker_memory])
+    finally:
+        os.killpg(process.pid, signal.SIGTERM)
+        process.wait(timeout=60)
+
+
+def main():
+    args = parse_args()
+    results = {mode: measure(mode, args) for mode in args.mode}
+    print(json.dumps(dict(workers=args.workers, results=results), indent=2))
+
+
+if __name__ == "__main__":
+    main()
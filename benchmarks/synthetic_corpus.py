@@ -0,0 +1,82 @@
+"""
+    Deterministic synthetic PDF corpora for the benchmarks, written without any PDF library.
+"""
+import os
+import random
+
+TOPICS = ["vacation", "sick leave", "remote work", "expense reimbursement", "data retention", "access control",
+          "incident response", "encryption", "vendor management", "password rotation", "background checks",
+          "business continuity", "change management", "logging and monitoring", "acceptable use"]
+VERBS = ["must", "should", "may", "is required to", "is encouraged to"]
+SUBJECTS = ["Employees", "Managers", "The security team", "Contractors", "The company", "System owners"]
+ACTIONS = ["review the policy annually", "report violations to the compliance officer", "request approval in advance",
+           "retain records for seven years", "rotate credentials every 90 days", "complete the mandatory training",
+           "encrypt data at rest and in transit", "document every exception", "notify HR within 5 business days"]
+BOILERPLATE = "Zania, Inc. Confidential - Employee Handbook - Do not distribute"
+
+
+def generate_sentence(rng):
+    control_id = f"{rng.choice(['CC', 'AC', 'IR', 'PS'])}{rng.randint(1, 9)}.{rng.randint(1, 20)}"
+    return (f"{rng.choice(SUBJECTS)} {rng.choice(VERBS)} {rng.choice(ACTIONS)} under the "
+            f"{rng.choice(TOPICS)} policy (control {control_id}).")
+
+
+def generate_page_lines(rng, lines_per_page):
+    lines = [BOILERPLATE, f"Section {rng.randint(1, 12)}.{rng.randint(1, 9)} {rng.choice(TOPICS).title()}"]
+    lines.extend(generate_sentence(rng) for _ in range(lines_per_page - 2))
+    return lines
+
+
+def __escape__(text):
+    return text.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)")
+
+
+def write_pdf(path, pages):
+    objects = []
+
+    def add_object(body):
+        objects.append(body)
+        return len(objects)
+
+    font_id = add_object(b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>")
+    pages_id = len(objects) + 2 * len(pages) + 1
+    page_ids = []
+    for lines in pages:
+        text = " ".join(f"({__escape__(line)}) '" for line in lines)
+        stream = f"BT /F1 9 Tf 40 790 Td 11 TL {text} ET".encode("latin-1")
+        content_id = add_object(b"<< /Length %d >>\nstream\n%s\nendstream" % (len(stream), stream))
+        page_ids.append(add_object(b"<< /Type /Page /Parent %d 0 R /MediaBox [0 0 612 792] /Contents %d 0 R "
+                                   b"/Resources << /Font << /F1 %d 0 R >> >> >>" % (pages_id, content_id, font_id)))
+    add_object(b"<< /Type /Pages /Kids [%s] /Count %d >>" % (b" ".join(b"%d 0 R" % k for k in page_ids),
+                                                               len(page_ids)))
+    catalog_id = add_object(b"<< /Type /Catalog /Pages %d 0 R >>" % pages_id)
+
+    output = bytearray(b"%PDF-1.4\n")
+    offsets = []
+    for object_id, body in enumerate(objects, start=1):
+        offsets.append(len(output))
+        output += b"%d 0 obj\n%s\nendobj\n" % (object_id, body)
+    xref_offset = len(output)
+    output += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1)
+    output += b"".join(b"%010d 00000 n \n" % offset for offset in offsets)
+    output += b"trailer\n<< /Size %d /Root %d 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, catalog_id,
+                                                                                    xref_offset)
+    with open(path, "wb") as f:
+        f.write(output)
+
+
+def generate_corpus(output_dir, documents=5, pages_per_document=20, lines_per_page=60, seed=42):
+    rng = random.Random(seed)
+    os.makedirs(output_dir, exist_ok=True)
+    paths = []
+    for k in range(documents):
+        path = os.path.join(output_dir, f"synthetic_{k:04d}.pdf")
+        write_pdf(path, [generate_page_lines(rng, lines_per_page) for _ in range(pages_per_document)])
+        paths.append(path)
+    return paths
+
+
+def generate_questions(count, seed=7):
+    rng = random.Random(seed)
+    return [f"What {rng.choice(VERBS)} {rng.choice(SUBJECTS).lower()} do about {rng.choice(TOPICS)}?"
+            for _ in range(count)]
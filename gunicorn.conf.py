@@ -0,0 +1,74 @@
+"""
+    Preloaded multi-worker mode: the master imports the application and loads the sentence encoder once, the forked
+    uvicorn workers share the model weights copy-on-write instead of loading a copy each.
+    With EMBEDDING_SERVICE.mode client, the master starts the embedding server instead, the only process holding the
+    model, and the workers send their query texts to it.
+
+    gunicorn -c gunicorn.conf.py src.main:app
+"""
+import gc
+import os
+import subprocess
+import sys
+import threading
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '9002')}"
+workers = int(os.environ.get("WEB_CONCURRENCY", 4))
+worker_class = "uvicorn.workers.UvicornWorker"
+preload_app = True
+timeout = 120
+graceful_timeout = 30
+
+embedding_server = None
+stopping = threading.Event()
+
+
+def start_embedding_server(server):
+    global embedding_server
+    embedding_server = subprocess.Popen([sys.executable, "-m", "src.agent.embedding_service"])
+    server.log.info(f"Started the embedding server, pid {embedding_server.pid}")
+
+
+def supervise_embedding_server(server):
+    # Restarts the embedding server when it exits, the workers reconnect on their next request
+    while True:
+        code = embedding_server.wait()
+        if stopping.wait(1):
+            return
+        server.log.error(f"Embedding server exited with code {code}, restarting it")
+        start_embedding_server(server)
+
+
+def on_starting(server):
+    from src.agent.embedding_service import embedding_service
+    from src.agent.model_registry import model_registry
+
+    # The worker count gunicorn resolved, a --workers flag included, the LLM gateway of each worker divides the rate
+    # limits of the API account by it
+    os.environ["WEB_CONCURRENCY"] = str(server.cfg.workers)
+    if model_registry.config.backend != "torch":
+        # Export and parity check once, in a process of their own: torch is loaded for the parity check only, and
+        # neither it nor its thread pools end up in the master or the workers
+        export = subprocess.run([sys.executable, "-m", "src.agent.onnx_encoder"])
+        if export.returncode:
+            server.log.error(f"ONNX export failed with code {export.returncode}, the workers fall back to torch")
+    if embedding_service.is_remote:
+        start_embedding_server(server)
+        threading.Thread(target=supervise_embedding_server, args=(server,), name="embedding-supervisor",
+                         daemon=True).start()
+    elif model_registry.config.backend == "torch":
+        # No warmup encode in the master, the torch thread pools must not exist before the fork. An ONNX Runtime
+        # session starts its thread pool when it is created, so the ONNX backends are loaded by each worker
+        try:
+            model_registry.load(warmup=False)
+        except Exception as e:
+            server.log.error(f"Sentence encoder not preloaded, the workers load their own copy, {e}")
+    # Objects created so far are never collected, the collector does not touch (and copy) their pages
+    gc.freeze()
+
+
+def on_exit(server):
+    stopping.set()
+    if embedding_server is not None:
+        embedding_server.terminate()
+        embedding_server.wait(timeout=30)
@@ -0,0 +1,196 @@
+import hashlib
+import re
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+from fastapi.logger import logger
+
+from src.agent.metrics import record_cache_lookup
+from src.agent.retrieval_cache import retrieval_cache
+from src.agent.utils import DOCUMENT_ANSWER_PROMPT
+from src.config.config_client import config
+from src.schemas.pydantic_models import AnswerCacheConfig
+
+
+def normalize_question(question):
+    return re.sub(r"\s+", " ", re.sub(r"[^\w\s]", " ", question.lower())).strip()
+
+
+class SemanticIndex:
+    """
+        Normalized query embeddings of the cached answers of one collection version, in a matrix preallocated for
+        `capacity` rows and doubled when full. A removed row is replaced by the last one.
+    """
+
+    def __init__(self, dimensions, capacity=64):
+        self.vectors = np.zeros((capacity, dimensions), dtype=np.float32)
+        self.created_at = np.zeros(capacity, dtype=np.float64)
+        self.keys = []
+        self.rows = {}
+
+    def add(self, key, vector, created_at):
+        if key in self.rows:
+            self.remove(key)
+        row = len(self.keys)
+        if row == len(self.vectors):
+            self.vectors = np.concatenate([self.vectors, np.zeros_like(self.vectors)])
+            self.created_at = np.concatenate([self.created_at, np.zeros_like(self.created_at)])
+        self.vectors[row], self.created_at[row] = vector, created_at
+        self.keys.append(key)
+        self.rows[key] = row
+
+    def remove(self, key):
+        row, last = self.rows.pop(key), len(self.keys) - 1
+        last_key = self.keys.pop()
+        if row != last:
+            self.vectors[row], self.created_at[row] = self.vectors[last], self.created_at[last]
+            self.keys[row] = last_key
+            self.rows[last_key] = row
+
+    def search(self, query_vector, created_after):
+        size = len(self.keys)
+        similarities = self.vectors[:size] @ query_vector
+        # Expired rows never match
+        similarities[self.created_at[:size] < created_after] = -np.inf
+        best = int(np.argmax(similarities))
+        return self.keys[best], float(similarities[best])
+
+
+class AnswerCache:
+    """
+        Two tier cache in front of the LLM call.
+        Exact tier: normalized question + retrieved chunk ids + prompt/model version.
+        Semantic tier: cosine similarity of the SBERT query embedding against cached questions of the same collection.
+        Entries expire after ttl_seconds, the least recently used entry is evicted above max_entries, and entries
+        written before the last ingestion of their collection (older collection version) are never served, they
+        are dropped once an entry of the newer version is written. Shared by the threads of the process.
+    """
+
+    def __init__(self, cache_config: AnswerCacheConfig, llm_version: str):
+        self.config = cache_config
+        self.llm_version = llm_version
+        self._entries: OrderedDict[str, dict] = OrderedDict()
+        # Semantic tier, one index per (collection, version)
+        self._indexes: dict[tuple, SemanticIndex] = {}
+        self._lock = threading.Lock()
+        self.hits_exact = 0
+        self.hits_semantic = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __key__(self, collection, version, question, chunk_ids):
+        key = "|".join([collection.lower(), str(version), self.llm_version, normalize_question(question),
+                        *sorted(chunk_ids)])
+        return hashlib.sha256(key.encode()).hexdigest()
+
+    def __is_expired__(self, entry):
+        return time.monotonic() - entry["created_at"] > self.config.ttl_seconds
+
+    def __remove__(self, key):
+        entry = self._entries.pop(key)
+        group = (entry["collection"], entry["version"])
+        index = self._indexes[group]
+        index.remove(key)
+        if not index.keys:
+            del self._indexes[group]
+        self.evictions += 1
+
+    def __get_exact__(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if self.__is_expired__(entry):
+            self.__remove__(key)
+            return None
+        self._entries.move_to_end(key)
+        return entry
+
+    def __get_semantic__(self, collection, version, embedded_query):
+        index = self._indexes.get((collection.lower(), version))
+        if index is None or embedded_query is None:
+            return None
+        query_vector = np.asarray(embedded_query, dtype=np.float32)
+        query_vector /= (np.linalg.norm(query_vector) or 1.0)
+        key, similarity = index.search(query_vector, time.monotonic() - self.config.ttl_seconds)
+        if similarity < self.config.similarity_threshold:
+            return None
+        self._entries.move_to_end(key)
+        return self._entries[key]
+
+    def get(self, collection, question, chunk_ids, embedded_query=None, version=None):
+        if not self.config.enabled:
+            return None
+        if version is None:
+            version = retrieval_cache.collection_version(collection)
+        key = self.__key__(collection, version, question, chunk_ids)
+        with self._lock:
+            if entry := self.__get_exact__(key):
+                self.hits_exact += 1
+                tier = "exact"
+            elif entry := self.__get_semantic__(collection, version, embedded_query):
+                self.hits_semantic += 1
+                tier = "semantic"
+            else:
+                self.misses += 1
+        if entry is None:
+            record_cache_lookup("answer", hit=False)
+            return None
+        record_cache_lookup("answer", hit=True, tier=tier)
+        if tier == "semantic":
+            logger.info(f"Semantic answer cache hit for question {question}, cached question {entry['question']}")
+        return entry
+
+    def put(self, collection, question, chunk_ids, embedded_query, answer, documents, version=None):
+        if not self.config.enabled:
+            return
+        vector = np.asarray(embedded_query, dtype=np.float32)
+        vector /= (np.linalg.norm(vector) or 1.0)
+        if version is None:
+            version = retrieval_cache.collection_version(collection)
+        key = self.__key__(collection, version, question, chunk_ids)
+        group = (collection.lower(), version)
+        created_at = time.monotonic()
+        with self._lock:
+            # Entries of older versions of the collection can not be served anymore
+            for stale in [stale for stale in self._indexes if stale[0] == group[0] and stale != group]:
+                for stale_key in list(self._indexes[stale].keys):
+                    self.__remove__(stale_key)
+            if group not in self._indexes:
+                self._indexes[group] = SemanticIndex(len(vector))
+            self._indexes[group].add(key, vector, created_at)
+            self._entries[key] = dict(collection=group[0], version=version, question=question, vector=vector,
+                                      answer=answer, documents=documents, created_at=created_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.config.max_entries:
+                self.__remove__(next(iter(self._entries)))
+
+    async def aget(self, collection, question, chunk_ids, embedded_query=None):
+        # The collection version may be read from the SQLite file of the retrieval cache, off the event loop
+        if not self.config.enabled:
+            return None
+        return self.get(collection, question, chunk_ids, embedded_query,
+                        version=await retrieval_cache.acollection_version(collection))
+
+    async def aput(self, collection, question, chunk_ids, embedded_query, answer, documents):
+        if self.config.enabled:
+            self.put(collection, question, chunk_ids, embedded_query, answer, documents,
+                     version=await retrieval_cache.acollection_version(collection))
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits_exact + self.hits_semantic + self.misses
+            return dict(size=len(self._entries), hits_exact=self.hits_exact, hits_semantic=self.hits_semantic,
+                        misses=self.misses, evictions=self.evictions,
+                        hit_rate=round((self.hits_exact + self.hits_semantic) / lookups, 4) if lookups else 0.0)
+
+
+def get_llm_version():
+    model_type = config.get("DOCUMENT_AGENT_LLM_TYPE", "OPENAI_GPT_4o_MINI")
+    model_config = config.get(model_type, {})
+    prompt_version = hashlib.sha256(DOCUMENT_ANSWER_PROMPT.encode()).hexdigest()[:12]
+    return f"{model_config.get('MODEL_NAME')}:{model_config.get('TEMPERATURE')}:{prompt_version}"
+
+
+answer_cache = AnswerCache(AnswerCacheConfig(**(config.get("ANSWER_CACHE") or {})), get_llm_version())
@@ -0,0 +1,204 @@
+import hashlib
+import re
+import zlib
+from collections import Counter, defaultdict, deque
+
+import numpy as np
+from langchain_core.documents import Document
+
+from src.agent.metrics import CHUNKS_DEDUPLICATED
+from src.schemas.pydantic_models import ChunkerConfig
+
+# Word and punctuation tokens, the units the encoder's wordpiece tokenizer starts from
+TOKEN_PATTERN = re.compile(r"\w+|[^\w\s]")
+SENTENCE_END = re.compile(r"[.!?:;]")
+# Hyphens and underscores are removed from the page text, as they always were
+CLEAN_TABLE = str.maketrans("", "", "-_")
+DROPPED_METADATA = ("Creator", "ModDate", "Producer", "CreationDate")
+PAGE_SEPARATOR = "\n"
+MERSENNE_PRIME = (1 << 61) - 1
+# Lines at the top and at the bottom of a page looked at for headers and footers
+EDGE_LINES = 3
+DIGITS = re.compile(r"\d+")
+
+
+def clean_page(doc: Document, file_path):
+    """
+        Text of the page without hyphens and underscores in one copy, and a new metadata dict for its chunks.
+    """
+    metadata = {key: value for key, value in doc.metadata.items() if key not in DROPPED_METADATA}
+    metadata["agent"] = "Document"
+    metadata["file_path"] = file_path
+    return doc.page_content.translate(CLEAN_TABLE), metadata
+
+
+def chunk_text_hash(text):
+    """
+        Hash of the text of a chunk, case and whitespace insensitive.
+    """
+    return hashlib.sha1(" ".join(text.lower().split()).encode()).hexdigest()
+
+
+class RepeatedLineFilter:
+    """
+        Removes the headers and footers of the pages: the lines among the first and last EDGE_LINES of a page that,
+        numbers aside, are also at the edge of at least repeated_line_min_pages pages. Pages are held back
+        repeated_line_window_pages at a time, so the first pages are checked against the ones that follow.
+    """
+
+    def __init__(self, chunker_config: ChunkerConfig):
+        self.config = chunker_config
+        self._pages_with_line = Counter()
+        self.lines_removed = 0
+
+    @staticmethod
+    def __key__(line):
+        # "Page 3 of 20" and "Page 4 of 20" are the same footer
+        return DIGITS.sub("#", " ".join(line.lower().split()))
+
+    @staticmethod
+    def __edges__(lines):
+        filled = [index for index, line in enumerate(lines) if line.strip()]
+        return set(filled[:EDGE_LINES] + filled[-EDGE_LINES:])
+
+    def __strip__(self, page: Document, lines, edges):
+        kept = [line for index, line in enumerate(lines) if index not in edges or
+                self._pages_with_line[self.__key__(line)] < self.config.repeated_line_min_pages]
+        if len(kept) == len(lines):
+            return page
+        self.lines_removed += len(lines) - len(kept)
+        return Document(page_content="\n".join(kept), metadata=page.metadata)
+
+    def strip(self, pages):
+        window = deque()
+        for page in pages:
+            lines = page.page_content.split("\n")
+            edges = self.__edges__(lines)
+            self._pages_with_line.update({self.__key__(lines[index]) for index in edges})
+            window.append((page, lines, edges))
+            if len(window) > self.config.repeated_line_window_pages:
+                yield self.__strip__(*window.popleft())
+        while window:
+            yield self.__strip__(*window.popleft())
+
+
+class ChunkDeduplicator:
+    """
+        Drops the chunks already seen: exact duplicates by the hash of their normalized text, near duplicates by
+        MinHash signatures of their word shingles, bucketed with LSH and kept when their estimated Jaccard
+        similarity to every earlier chunk of their buckets is below near_duplicate_threshold.
+    """
+
+    def __init__(self, chunker_config: ChunkerConfig):
+        self.config = chunker_config
+        self.rows = chunker_config.minhash_permutations // chunker_config.minhash_bands
+        rng = np.random.default_rng(1)
+        self._a = rng.integers(1, 1 << 31, chunker_config.minhash_permutations, dtype=np.uint64)
+        self._b = rng.integers(0, 1 << 31, chunker_config.minhash_permutations, dtype=np.uint64)
+        self._hashes = set()
+        self._buckets = defaultdict(list)
+        self._signatures = []
+        self.exact_duplicates = 0
+        self.near_duplicates = 0
+
+    def signature(self, words):
+        size = self.config.shingle_size
+        shingles = {zlib.crc32(" ".join(words[i:i + size]).encode())
+                    for i in range(max(1, len(words) - size + 1))}
+        values = np.fromiter(shingles, dtype=np.uint64, count=len(shingles))
+        return ((values[:, None] * self._a + self._b) % MERSENNE_PRIME).min(axis=0)
+
+    def is_duplicate(self, text):
+        words = text.lower().split()
+        digest = chunk_text_hash(text)
+        if digest in self._hashes:
+            self.exact_duplicates += 1
+            CHUNKS_DEDUPLICATED.labels("exact").inc()
+            return True
+        self._hashes.add(digest)
+        if not self.config.near_duplicates or len(words) < self.config.shingle_size:
+            return False
+
+        signature = self.signature(words)
+        bands = [signature[i:i + self.rows].tobytes() for i in range(0, len(signature), self.rows)]
+        candidates = {index for band, key in enumerate(bands) for index in self._buckets[(band, key)]}
+        if any(np.mean(self._signatures[index] == signature) >= self.config.near_duplicate_threshold
+               for index in candidates):
+            self.near_duplicates += 1
+            CHUNKS_DEDUPLICATED.labels("near").inc()
+            return True
+        for band, key in enumerate(bands):
+            self._buckets[(band, key)].append(len(self._signatures))
+        self._signatures.append(signature)
+        return False
+
+
+class StreamingChunker:
+    """
+        Splits the pages of a document in one pass into chunks of CHUNKER.chunk_tokens tokens, overlapping by
+        overlap_tokens. Chunks run across page breaks and end on a sentence boundary when one is in their last
+        quarter. Each chunk records the page it starts on (`page`), the page it ends on (`end_page`), its character
+        offsets in the document (`start_index`, `end_index`) and in its first page (`page_offset`).
+        Headers and footers repeated across the pages are removed first, and duplicate chunks of the document are
+        dropped before embedding.
+    """
+
+    def __init__(self, chunker_config: ChunkerConfig):
+        self.config = chunker_config
+
+    @staticmethod
+    def __boundary__(text, text_start, tokens, end):
+        # Last sentence end in the last quarter of the chunk, the full chunk otherwise
+        for index in range(end - 1, end - 1 - (end // 4), -1):
+            if SENTENCE_END.fullmatch(text, tokens[index][0] - text_start, tokens[index][1] - text_start):
+                return index + 1
+        return end
+
+    def split(self, pages, file_path):
+        """
+            Yields the chunks of `pages`, the page documents of one file in order.
+        """
+        chunk_tokens, overlap_tokens = self.config.chunk_tokens, self.config.overlap_tokens
+        deduplicator = ChunkDeduplicator(self.config) if self.config.deduplicate else None
+        if self.config.strip_repeated_lines:
+            pages = RepeatedLineFilter(self.config).strip(pages)
+        # Text not chunked yet, starting at document offset `text_start`, and the document offsets of its tokens
+        text, text_start, tokens = "", 0, []
+        # (document offset, metadata) of the pages in the buffer
+        page_starts = []
+        emitted_end = 0
+
+        def make_chunk(end):
+            start_index, end_index = tokens[0][0], tokens[end - 1][1]
+            chunk_text = text[start_index - text_start:end_index - text_start]
+            if deduplicator and deduplicator.is_duplicate(chunk_text):
+                return None
+            page_offset, metadata = next(page for page in reversed(page_starts) if page[0] <= start_index)
+            end_page = next(page[1]["page"] for page in reversed(page_starts) if page[0] < end_index)
+            return Document(page_content=chunk_text,
+                            metadata=dict(metadata, end_page=end_page, start_index=start_index,
+                                          end_index=end_index, page_offset=start_index - page_offset))
+
+        for page in pages:
+            page_text, metadata = clean_page(page, file_path)
+            if text:
+                text += PAGE_SEPARATOR
+            page_start = text_start + len(text)
+            page_starts.append((page_start, metadata))
+            tokens.extend((page_start + match.start(), page_start + match.end())
+                          for match in TOKEN_PATTERN.finditer(page_text))
+            text += page_text
+
+            while len(tokens) > chunk_tokens:
+                end = self.__boundary__(text, text_start, tokens, chunk_tokens)
+                if chunk := make_chunk(end):
+                    yield chunk
+                emitted_end = tokens[end - 1][1]
+                # The next chunk starts overlap_tokens before the end of this one
+                del tokens[:max(end - overlap_tokens, 1)]
+                text, text_start = text[tokens[0][0] - text_start:], tokens[0][0]
+                page_starts = [page for index, page in enumerate(page_starts)
+                               if index == len(page_starts) - 1 or page_starts[index + 1][0] > text_start]
+
+        if tokens and tokens[-1][1] > emitted_end and (chunk := make_chunk(len(tokens))):
+            yield chunk
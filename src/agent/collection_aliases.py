@@ -0,0 +1,93 @@
+import json
+import os
+import threading
+import time
+
+from fastapi.logger import logger
+
+from src.agent.file_lock import file_lock
+from src.config.config_client import config
+
+
+class CollectionAliases:
+    """
+        Maps the collection name of a tenant to the versioned collection that serves it, and the encoder (model
+        name and version) it was built with, persisted in VECTOR_DB_PATH/collection_aliases.json. A collection
+        without an alias serves itself.
+        The file is replaced atomically and re-read when it changes, so every worker process follows a swap.
+    """
+
+    aliases_path = os.path.join(config.get("VECTOR_DB_PATH", "data_weaviate"), "collection_aliases.json")
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._state = dict(aliases={}, versions={})
+        self._mtime = None
+
+    def __load__(self):
+        try:
+            mtime = os.stat(self.aliases_path).st_mtime_ns
+        except FileNotFoundError:
+            return self._state
+        if mtime != self._mtime:
+            with self._lock:
+                try:
+                    with open(self.aliases_path) as f:
+                        self._state = json.load(f)
+                    self._mtime = mtime
+                except (OSError, ValueError) as e:
+                    logger.error(f"Failed while reading collection aliases {self.aliases_path}, {e}")
+        return self._state
+
+    def __save__(self, state):
+        os.makedirs(os.path.dirname(self.aliases_path) or ".", exist_ok=True)
+        with open(f"{self.aliases_path}.tmp", "w") as f:
+            json.dump(state, f, indent=2)
+        os.replace(f"{self.aliases_path}.tmp", self.aliases_path)
+        self._state, self._mtime = state, os.stat(self.aliases_path).st_mtime_ns
+
+    def resolve(self, collection_name):
+        return self.__load__()["aliases"].get(collection_name.lower(), collection_name)
+
+    def swapped_at(self, collection_name):
+        """
+            Time of the last switch of the collection, None if it never was.
+        """
+        return self.__load__().get("swapped_at", {}).get(collection_name.lower())
+
+    def encoder(self, collection_name):
+        """
+            Model name and version of the encoder that built the collection served, None if it was never re-indexed.
+        """
+        return self.__load__().get("encoders", {}).get(collection_name.lower())
+
+    def version(self, collection_name):
+        return self.__load__()["versions"].get(collection_name.lower(), 1)
+
+    def next_name(self, collection_name):
+        """
+            Name of the next version of the collection, zania -> zania_v2 -> zania_v3.
+        """
+        return f"{collection_name.lower()}_v{self.version(collection_name) + 1}"
+
+    def swap(self, collection_name, versioned_name, encoder=None):
+        """
+            Points the collection to `versioned_name`, built with `encoder`, in one atomic file replace, returns the
+            collection it served before.
+        """
+        version = int(versioned_name.rsplit("_v", 1)[1])
+        # Other workers may swap other collections, the file is read again under the lock
+        with self._lock, file_lock(f"{self.aliases_path}.lock"):
+            self._mtime = None
+            state = self.__load__()
+            previous = state["aliases"].get(collection_name.lower(), collection_name)
+            state = dict(aliases=dict(state["aliases"], **{collection_name.lower(): versioned_name.lower()}),
+                         versions=dict(state["versions"], **{collection_name.lower(): version}),
+                         swapped_at=dict(state.get("swapped_at", {}), **{collection_name.lower(): time.time()}),
+                         encoders=dict(state.get("encoders", {}), **{collection_name.lower(): encoder}))
+            self.__save__(state)
+        logger.info(f"Collection {collection_name} now served by {versioned_name}, previously {previous}")
+        return previous
+
+
+collection_aliases = CollectionAliases()
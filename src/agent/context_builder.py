@@ -0,0 +1,121 @@
+from fastapi.logger import logger
+
+from src.agent.metrics import CONTEXT_TOKENS
+from src.config.config_client import config
+
+CONTEXT_SEPARATOR = "\n\n---\n\n"
+# Shortest shared text treated as splitter overlap between two chunks of the same page
+MIN_OVERLAP = 20
+
+
+def get_token_encoder(model_name):
+    """
+        tiktoken encoding of the model, falls back to cl100k_base for unknown models and to a 4 characters per token
+        estimate when the encoding files are not available.
+    """
+    try:
+        import tiktoken
+        try:
+            return tiktoken.encoding_for_model(model_name).encode
+        except KeyError:
+            return tiktoken.get_encoding("cl100k_base").encode
+    except Exception as e:
+        logger.error(f"tiktoken encoding not available for {model_name}, estimating token counts, {e}")
+        return lambda text: range((len(text) + 3) // 4)
+
+
+def merge_overlap(first, second):
+    """
+        Text of two chunks of the same page joined without the text they share, None when they do not overlap.
+    """
+    if second in first:
+        return first
+    if first in second:
+        return second
+    for head, tail in ((first, second), (second, first)):
+        start = head.find(tail[:MIN_OVERLAP], max(0, len(head) - len(tail)))
+        while start != -1:
+            if tail.startswith(head[start:]):
+                return head + tail[len(head) - start:]
+            start = head.find(tail[:MIN_OVERLAP], start + 1)
+    return None
+
+
+class ContextBuilder:
+    """
+        Assembles the LLM context of a question from the retrieved chunks: drops the chunks farther than
+        MIN_DISTANCE, merges overlapping chunks of the same source and page and packs the best TOP_K of the result,
+        best chunk first, into the token budget of the model.
+    """
+
+    def __init__(self, min_distance, top_k, model_type=None):
+        self.model_type = model_type or config.get("DOCUMENT_AGENT_LLM_TYPE", "OPENAI_GPT_4o_MINI")
+        model_config = config.get(self.model_type, {})
+        self.model_name = model_config.get("MODEL_NAME", "gpt-4o-mini")
+        self.token_budget = int(model_config.get("CONTEXT_TOKEN_BUDGET", 3000))
+        self.min_distance = float(min_distance)
+        self.top_k = int(top_k)
+        self._encode = None
+
+    def count_tokens(self, text):
+        if self._encode is None:
+            self._encode = get_token_encoder(self.model_name)
+        return len(self._encode(text))
+
+    def __truncate__(self, text, max_tokens):
+        # Characters per token of this text, shrunk until it fits
+        while text and (tokens := self.count_tokens(text)) > max_tokens:
+            text = text[:int(len(text) * max_tokens / tokens) - 1]
+        return text
+
+    def filter_relevant(self, documents, search_mode="vector"):
+        # Hybrid scores are fused similarities, the distance threshold only applies to vector search results
+        if search_mode != "vector":
+            return documents
+        return [document for document in documents
+                if float(document["metadata"].get("score", 0.0)) <= self.min_distance]
+
+    @staticmethod
+    def merge_neighbours(documents):
+        """
+            Returns blocks of (text, documents) in rank order, chunks of the same source and page whose text overlaps
+            are merged into the block of the best ranked one.
+        """
+        blocks = []
+        for document in documents:
+            page_key = (document["metadata"].get("source"), document["metadata"].get("page"))
+            for block in blocks:
+                if block["page_key"] == page_key and \
+                        (merged := merge_overlap(block["text"], document["page_content"])) is not None:
+                    block["text"] = merged
+                    block["documents"].append(document)
+                    break
+            else:
+                blocks.append(dict(page_key=page_key, text=document["page_content"], documents=[document]))
+        return blocks
+
+    def build(self, documents, search_mode="vector"):
+        """
+            Returns the context text and the documents it was built from.
+        """
+        blocks = self.merge_neighbours(self.filter_relevant(documents, search_mode))
+        separator_tokens = self.count_tokens(CONTEXT_SEPARATOR)
+        texts, used_documents, used_tokens = [], [], 0
+        for block in blocks:
+            if len(texts) == self.top_k:
+                break
+            block_tokens = self.count_tokens(block["text"]) + (separator_tokens if texts else 0)
+            if used_tokens + block_tokens > self.token_budget:
+                if texts:
+                    continue
+                # The best chunk alone is over budget, it is cut rather than dropped
+                block["text"] = self.__truncate__(block["text"], self.token_budget)
+                block_tokens = self.count_tokens(block["text"])
+            texts.append(block["text"])
+            used_documents.extend(block["documents"])
+            used_tokens += block_tokens
+
+        CONTEXT_TOKENS.observe(used_tokens)
+        if len(used_documents) < len(documents):
+            logger.debug(f"Context packed {len(used_documents)} of {len(documents)} chunks in {used_tokens} tokens")
+        return CONTEXT_SEPARATOR.join(texts), used_documents
@@ -1,13 +1,25 @@
 import asyncio
+import time
 import warnings
 from fastapi.logger import logger
-from langchain_openai import ChatOpenAI
 from langchain.prompts import ChatPromptTemplate
 from src.agent.utils import *
 from src.startup_constants import *
 from src.config.config_client import config
-from src.agent.embedding_generation import GenerateEmbedding
-from src.agent.vector_db_client import execute_pure_vector_search_without_filters
+from src.agent.answer_cache import answer_cache
+from src.agent.collection_aliases import collection_aliases
+from src.agent.context_builder import ContextBuilder
+from src.agent.ingestion_jobs import ingestion_queue
+from src.agent.llm_gateway import llm_gateway
+from src.agent.metrics import stage, record_error
+from src.agent.model_registry import model_registry
+from src.agent.embedding_service import embedding_service
+from src.agent.retrieval_cache import retrieval_cache
+from src.agent.slack_outbox import slack_outbox
+from src.agent.tenants import tenants
+from src.agent.executors import run_io
+from src.agent.vector_db_client import aexecute_pure_vector_search_by_vector, aexecute_hybrid_search_by_vector, \
+    is_schema_exists
 
 warnings.simplefilter(action='ignore', category=FutureWarning)
 warnings.simplefilter(action='ignore', category=UserWarning)
@@ -21,80 +33,263 @@ class DocumentAgent:
     top_k = config.get("TOP_K", "2")
     min_distance = config.get("MIN_DISTANCE", "0.40")
     max_documents = config.get("MAX_DOCUMENTS", "10")
+    retrieval_concurrency = int(config.get("RETRIEVAL_CONCURRENCY", 8))
+    search_mode = config.get("SEARCH_MODE", "vector")
+    context_builder = ContextBuilder(min_distance=min_distance, top_k=top_k)
+    # MAX_DOCUMENTS candidates are retrieved, ContextBuilder packs the best TOP_K contexts of them
+    search_limit = max(int(top_k), int(max_documents))
 
-    def __init__(self, queries: list, file: UploadFile = File(None), override: bool = False):
+    def __init__(self, queries: list, file: UploadFile = File(None), override: bool = False,
+                 search_mode: str = None, project_id: str = None):
         self.queries = queries
         self.file = file
         self.override = override
+        self.search_mode = search_mode or self.search_mode
+        # Collection and upload folder of the X-ProjectID project
+        self.tenant = tenants.resolve(project_id)
+        # The versioned collection currently serving the tenant, switched by a re-index
+        self.collection_name = collection_aliases.resolve(self.tenant.index_name)
         self.format_response: list[dict] = []
+        self.ingestion_job = None
+        self.retrieval_semaphore = asyncio.Semaphore(self.retrieval_concurrency)
+        self.llm_semaphore = llm_gateway.request_semaphore()
 
-    def __generate_embedding_function__(self):
+    async def __generate_embedding_function__(self):
         try:
-            upload = save_upload_file(uploaded_file=self.file, overwrite=self.override)
-            if upload or self.override or not os.path.exists(f"{self.vector_db_path}/{self.collection_name}"):
-                GenerateEmbedding().execute()
-            else:
-                logger.info("Embedding already exist, skipping generation.")
+            await self.ingest()
+        except AgentException:
+            # Rejected upload or full ingestion queue, the client has to retry
+            raise
         except Exception as e:
             logger.error(f"Failed while embedding generation, {e}", exc_info=True)
 
-    async def __get_documents__(self, query_text):
+    def __check_encoder__(self):
+        # A collection re-indexed with another model is not searched with vectors of this one
+        encoder = collection_aliases.encoder(self.tenant.index_name)
+        if encoder is not None and encoder != model_registry.encoder:
+            raise AgentException(code=409, display_message=EMBEDDINGS_MODEL_MISMATCH,
+                                 message=f"{self.collection_name} was built with {encoder}, the questions are "
+                                         f"embedded with {model_registry.encoder}")
+
+    async def __embed_queries__(self):
+        try:
+            # Waits for the encoder while it is still loading at startup
+            model_version = await embedding_service.aversion()
+        except Exception as e:
+            raise RuntimeError(EMBEDDINGS_MODEL_NOT_AVAILABLE) from e
+        embedded_queries = [await retrieval_cache.aget_embedding(query, model_version) for query in self.queries]
+
+        # The questions of the request that are not cached yet share a forward pass with the other requests
+        if missing_queries := [query for query, vector in zip(self.queries, embedded_queries) if vector is None]:
+            with stage("query_encoding"):
+                missing_vectors = iter(await embedding_service.aembed(missing_queries))
+            for k, vector in enumerate(embedded_queries):
+                if vector is None:
+                    embedded_queries[k] = next(missing_vectors)
+                    await retrieval_cache.aset_embedding(self.queries[k], model_version, embedded_queries[k])
+        return embedded_queries
+
+    async def __get_documents__(self, query_text, embedded_query):
+        tenants.touch(self.collection_name)
         try:
-            if docs_and_scores := execute_pure_vector_search_without_filters(query=query_text,
+            async with self.retrieval_semaphore:
+                if self.search_mode == "hybrid":
+                    docs_and_scores = await aexecute_hybrid_search_by_vector(query=query_text,
+                                                                             embedded_query=embedded_query,
                                                                              index_name=self.collection_name,
-                                                                             search_limit=self.top_k):
+                                                                             search_limit=self.search_limit,
+                                                                             alpha=float(self.alpha))
+                else:
+                    docs_and_scores = await aexecute_pure_vector_search_by_vector(embedded_query=embedded_query,
+                                                                                  index_name=self.collection_name,
+                                                                                  search_limit=self.search_limit)
+            if docs_and_scores:
                 documents = [dict(page_content=doc.page_content, metadata=doc.metadata) for doc in docs_and_scores]
-                self.format_response.append(dict(question=query_text, answer="", documents=documents))
-                context_text = "\n\n---\n\n".join([doc.page_content for doc in docs_and_scores])
-                return context_text
+                # Token counting loads the tiktoken encoding on first use, kept off the event loop
+                with stage("context_packing"):
+                    context_text, documents = await run_io(self.context_builder.build, documents, self.search_mode)
+                if context_text:
+                    return context_text, documents
+                logger.info(f"No document within distance {self.min_distance} for question {query_text}")
         except Exception as e:
+            record_error("retrieval")
             logger.error(f"Failed while retrieving documents for question {query_text}, {e}", exc_info=True)
+        return None, None
+
+    @staticmethod
+    def __get_chunk_ids__(documents):
+        return [document["metadata"].get("id", "") for document in documents]
+
+    async def __answer_question__(self, model, prompt_template, query, embedded_query):
+        context_info, documents = await self.__get_documents__(query_text=query, embedded_query=embedded_query)
+        if not context_info:
+            logger.info(f"Failed while retrieving documents for question {query}")
             return None
 
+        chunk_ids = self.__get_chunk_ids__(documents)
+        if cached := await answer_cache.aget(self.collection_name, query, chunk_ids, embedded_query):
+            return dict(question=query, answer=cached["answer"], documents=cached["documents"])
+
+        # The LLM call starts as soon as this question's context is ready
+        prompt = prompt_template.format(context=context_info, question=query)
+        with stage("llm"):
+            resp = await model.ainvoke(prompt, request_semaphore=self.llm_semaphore)
+        if not resp.content:
+            logger.error(f"Empty LLM response for question {query}")
+            return None
+        await answer_cache.aput(self.collection_name, query, chunk_ids, embedded_query, resp.content, documents)
+        return dict(question=query, answer=resp.content, documents=documents)
+
+    async def __stream_question__(self, model, prompt_template, query, embedded_query, events: asyncio.Queue):
+        context_info, documents = await self.__get_documents__(query_text=query, embedded_query=embedded_query)
+        if not context_info:
+            logger.info(f"Failed while retrieving documents for question {query}")
+            await events.put(dict(event="error", question=query, message="No relevant documents found"))
+            return None
+
+        chunk_ids = self.__get_chunk_ids__(documents)
+        if cached := await answer_cache.aget(self.collection_name, query, chunk_ids, embedded_query):
+            await events.put(dict(event="documents", question=query, documents=cached["documents"]))
+            await events.put(dict(event="answer", question=query, answer=cached["answer"], cached=True))
+            return dict(question=query, answer=cached["answer"], documents=cached["documents"])
+        await events.put(dict(event="documents", question=query, documents=documents))
+
+        answer_tokens = []
+        prompt = prompt_template.format(context=context_info, question=query)
+        with stage("llm"):
+            async for chunk in model.astream(prompt, request_semaphore=self.llm_semaphore):
+                if chunk.content:
+                    answer_tokens.append(chunk.content)
+                    await events.put(dict(event="token", question=query, content=chunk.content))
+
+        answer = "".join(answer_tokens)
+        await events.put(dict(event="answer", question=query, answer=answer))
+        if not answer:
+            return None
+        await answer_cache.aput(self.collection_name, query, chunk_ids, embedded_query, answer, documents)
+        return dict(question=query, answer=answer, documents=documents)
+
+    @staticmethod
+    def __get_model__():
+        # Shared client, rate limiting, retries and coalescing of the process
+        return llm_gateway
+
     async def __generate_summary__(self):
         try:
-            # Creating OpenAI Model Instance
-            model_type = config.get("DOCUMENT_AGENT_LLM_TYPE", "OPENAI_GPT_4o_MINI")
-            openai_keys = config.get(model_type, {})
-            model = ChatOpenAI(
-                openai_api_key=openai_keys.get("OPENAI_API_KEY"),
-                model_name=openai_keys.get("MODEL_NAME"),
-                temperature=openai_keys.get("TEMPERATURE")
-            )
-
-            # Iterating over Questions to create async task, which can be further executed all at once.
-            async_tasks = []
+            model = self.__get_model__()
             prompt_template = ChatPromptTemplate.from_template(DOCUMENT_ANSWER_PROMPT)
-            for query in self.queries:
-                context_info = await self.__get_documents__(query_text=query)
-                if not context_info:
-                    logger.info(f"Failed while retrieving documents for question {query}")
-                    continue
-
-                prompt = prompt_template.format(context=context_info, question=query)
-                async_tasks.append(asyncio.create_task(coro=model.ainvoke(prompt), name=query))
-
-            # Calling Async Task
-            llm_response = await asyncio.gather(*async_tasks)
-            if not llm_response:
+            embedded_queries = await self.__embed_queries__()
+
+            # Retrieval and LLM call of every question run concurrently, retrieval bounded by RETRIEVAL_CONCURRENCY and
+            # LLM calls by the gateway
+            async_tasks = [asyncio.create_task(coro=self.__answer_question__(model, prompt_template, query,
+                                                                             embedded_query), name=query)
+                           for query, embedded_query in zip(self.queries, embedded_queries)]
+            llm_response = await asyncio.gather(*async_tasks, return_exceptions=True)
+
+            for query, resp in zip(self.queries, llm_response):
+                if isinstance(resp, Exception):
+                    record_error("llm")
+                    logger.error(f"Error while generating LLM response for question {query}, {resp}")
+                elif resp:
+                    self.format_response.append(resp)
+
+            if not self.format_response:
                 logger.error("Received empty response from LLM async call, raising assertion error")
                 raise AgentException(code=400, display_message=GENERIC_ERROR,
                                      message="Received empty response from LLM")
 
-            for k, resp in enumerate(llm_response):
-                if not resp.content:
-                    del self.format_response[k]
-                    continue
-                self.format_response[k].update({"answer": resp.content})
-
         except Exception as e:
             logger.error(f"Error while generating LLM response, {e}", exc_info=True)
 
-    async def execute(self):
+    async def ingest(self):
+        """
+            Saves the upload and queues its ingestion, questions are answered from what is already indexed.
+        """
+        if self.file is not None:
+            with stage("upload"):
+                saved_upload = await run_io(save_upload_file, uploaded_file=self.file, overwrite=self.override,
+                                            upload_dir=self.tenant.upload_dir)
+            if saved_upload.changed:
+                try:
+                    self.ingestion_job = ingestion_queue.submit(tenant=self.tenant,
+                                                                file_paths=[saved_upload.file_location],
+                                                                file_name=self.file.filename, force=self.override)
+                except AgentException:
+                    # Left in place, the upload would be taken as unchanged and never ingested on the retry
+                    await run_io(os.remove, saved_upload.file_location)
+                    raise
+            else:
+                self.ingestion_job = ingestion_queue.skip(tenant=self.tenant, file_name=self.file.filename)
+        elif os.path.isdir(self.tenant.upload_dir) and not await run_io(is_schema_exists, self.collection_name):
+            self.ingestion_job = ingestion_queue.submit(tenant=self.tenant)
+        else:
+            logger.info("Embedding already exist, skipping generation.")
+        return self.ingestion_job
+
+    async def embed_queries(self):
+        """
+            Validates and embeds the questions before a stream starts, once its 200 is sent a failure could only
+            truncate it.
+        """
+        if not self.queries:
+            raise AgentException(code=400, message="No question to answer", display_message=GENERIC_ERROR)
+        self.__check_encoder__()
+        try:
+            return await self.__embed_queries__()
+        except Exception as e:
+            logger.error(f"Failed while embedding the questions, {e}", exc_info=True)
+            raise AgentException(code=503, message=f"Failed while embedding the questions, {e}",
+                                 display_message=EMBEDDINGS_MODEL_NOT_AVAILABLE)
+
+    async def stream(self, embedded_queries):
+        """
+            Yields events as they happen: documents once a question's retrieval finishes, LLM tokens while they
+            arrive, the full answer per question and a final summary. The upload is ingested beforehand by ingest()
+            and the questions embedded by embed_queries().
+        """
+        start_time = time.perf_counter()
+        model = self.__get_model__()
+        prompt_template = ChatPromptTemplate.from_template(DOCUMENT_ANSWER_PROMPT)
+
+        events = asyncio.Queue()
+        async_tasks = [asyncio.create_task(coro=self.__stream_question__(model, prompt_template, query,
+                                                                         embedded_query, events), name=query)
+                       for query, embedded_query in zip(self.queries, embedded_queries)]
+
+        async def close_stream():
+            results = await asyncio.gather(*async_tasks, return_exceptions=True)
+            await events.put(None)
+            return results
+
+        closing_task = asyncio.create_task(close_stream())
         try:
-            # Embedding Generation
-            self.__generate_embedding_function__()
+            while (event := await events.get()) is not None:
+                yield event
+
+            for query, resp in zip(self.queries, closing_task.result()):
+                if isinstance(resp, Exception):
+                    logger.error(f"Error while streaming LLM response for question {query}, {resp}")
+                    yield dict(event="error", question=query, message=GENERIC_ERROR)
+                elif resp:
+                    self.format_response.append(resp)
 
+            yield dict(event="summary", questions=len(self.queries), answered=len(self.format_response),
+                       elapsed_ms=round((time.perf_counter() - start_time) * 1000, 2))
+        finally:
+            # Client went away before the end of the stream
+            for task in async_tasks:
+                task.cancel()
+            closing_task.cancel()
+
+        if self.format_response:
+            slack_outbox.enqueue(self.format_response)
+
+    async def execute(self):
+        # Embedding Generation, a rejected upload reaches the client with its status code
+        await self.__generate_embedding_function__()
+        self.__check_encoder__()
+        try:
             # Vector search for Query and LLM API call
             await self.__generate_summary__()
 
@@ -102,8 +297,8 @@ class DocumentAgent:
                 raise AgentException(code=400, display_message=GENERIC_ERROR,
                                      message="Document Agent execution failed while formatting the response")
 
-            # Slack Post message
-            await slack_message_post(messages=self.format_response)
+            # Slack Post message, delivered in the background
+            slack_outbox.enqueue(self.format_response)
 
             return self.format_response
         except Exception as e:
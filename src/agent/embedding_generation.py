@@ -1,23 +1,92 @@
+import os
+import pathlib
+import time
+import uuid
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
 from fastapi.logger import logger
-from langchain_community.document_loaders import PyPDFDirectoryLoader
 from langchain_text_splitters import RecursiveCharacterTextSplitter, NLTKTextSplitter
-from src.agent.utils import get_embeddings_model, get_documents
+from src.agent.chunker import StreamingChunker, chunk_text_hash
+from src.agent.collection_aliases import collection_aliases
+from src.agent.retrieval_cache import retrieval_cache
+from src.agent.executors import executors
+from src.agent.file_lock import named_lock
+from src.agent.metrics import stage, PAGES_PARSED, CHUNKS_DEDUPLICATED, CHUNKS_EMBEDDED
+from src.agent.pdf_parser import count_pdf_pages, parse_pdf_pages
+from src.agent.utils import get_embeddings_model, iter_documents, iter_batches
 from src.config.config_client import config
-from src.agent.vector_db_client import get_vector_db_client, get_vector_store
+from src.agent.ingestion_manifest import IngestionManifest, compute_file_hash
+from src.agent.tenants import tenants, PROJECTS_FOLDER
+from src.agent.vector_db_client import vector_backend, delete_documents_by_ids, insert_documents
+from src.schemas.pydantic_models import ChunkerConfig
 
 
 class GenerateEmbedding:
     raw_data_path = config.get("DOWNLOAD_FOLDER", "download_data")
     collection_name = "zania"
+    source_glob = "**/[!.]*.pdf"
+    batch_size = int(config.get("EMBEDDING_BATCH_SIZE", 256))
+    batch_mode = config.get("VECTOR_DB_BATCH_MODE", "fixed")
+    pages_per_task = int(config.get("PDF_PAGES_PER_TASK", 8))
+    parser_window = int(config.get("PDF_PARSER_WINDOW", 0)) or 2 * executors.parser_pool_size
+    chunker_config = ChunkerConfig(**(config.get("CHUNKER") or {}))
 
     def __init__(self, **kwargs):
         self.kwargs = kwargs
+        # Optional job status updated with pages parsed and chunks embedded
+        self.progress = kwargs.get("progress")
+        # Re-embed files even when their content hash is already in the manifest
+        self.force = kwargs.get("force", False)
+        # Collection and upload folder of the project, the original ones without a project
+        self.tenant = kwargs.get("tenant") or tenants.resolve()
+        # Resolved when the job runs, a job queued before a re-index swap writes to the new collection
+        self.collection_name = collection_aliases.resolve(self.tenant.index_name)
+        # Re-index builds run at a bounded rate, 0 is unbounded
+        self.max_chunks_per_second = kwargs.get("max_chunks_per_second", 0)
+        self.raw_data_path = self.tenant.upload_dir
+
+    @staticmethod
+    def collection_lock(index_name):
+        # Held by the ingestion, the re-index switch and the maintenance of a collection, across the worker processes.
+        # Taken on the name the tenant's collection is aliased by, which a re-index does not change.
+        return named_lock(index_name)
+
+    def list_source_files(self):
+        source_folder = pathlib.Path(self.raw_data_path)
+        # The upload folders of the projects live under the original download folder
+        projects_folder = source_folder / PROJECTS_FOLDER if self.tenant.project_id is None else None
+        return sorted(str(path) for path in source_folder.glob(self.source_glob)
+                      if path.is_file() and not (projects_folder and path.is_relative_to(projects_folder)))
 
-    def load_documents(self):
-        document_loader = PyPDFDirectoryLoader(self.raw_data_path)
-        return document_loader.lazy_load()
+    def load_documents(self, file_path):
+        """
+            Fans the pages of the PDF out to the parser processes in ranges of PDF_PAGES_PER_TASK and yields them in
+            order. At most PDF_PARSER_WINDOW ranges are in flight, so parsing runs ahead of splitting and embedding by a
+            bounded amount.
+        """
+        total_pages = count_pdf_pages(file_path)
+        in_flight = deque()
+        for first_page in range(0, total_pages, self.pages_per_task):
+            in_flight.append(executors.parser.submit(parse_pdf_pages, file_path, first_page,
+                                                     first_page + self.pages_per_task))
+            if len(in_flight) >= self.parser_window:
+                yield from self.__track_pages__(in_flight.popleft())
+        while in_flight:
+            yield from self.__track_pages__(in_flight.popleft())
 
-    def data_splitting(self, documents):
+    def __track_pages__(self, parse_task):
+        # Time spent waiting on the parser processes
+        with stage("pdf_parse"):
+            pages = parse_task.result()
+        PAGES_PARSED.inc(len(pages))
+        if self.progress:
+            self.progress.pages_parsed += len(pages)
+        return pages
+
+    def data_splitting(self, documents, file_path):
+        if self.chunker_config.engine == "streaming":
+            return StreamingChunker(self.chunker_config).split(documents, file_path)
         text_splitter = RecursiveCharacterTextSplitter(
             chunk_size=800,
             chunk_overlap=80,
@@ -28,19 +97,157 @@ class GenerateEmbedding:
         #     chunk_size=config.get("PDF_CHUNK_SIZE", 500)
         # )
         # return text_splitter.split_documents(documents)
-        copilot_documents = get_documents(documents, self.collection_name, text_splitter)
+        copilot_documents = iter_documents(documents, file_path, text_splitter)
         return copilot_documents
 
     @staticmethod
-    def vectorstore_db_insertion(docs):
+    def stamp_chunks(chunks, file_hash):
+        # The chunks of one ingestion of a file can be deleted together by their content hash, maintenance leaves
+        # the chunks written after its scan started alone
+        for chunk in chunks:
+            chunk.metadata["content_hash"] = file_hash
+            chunk.metadata["ingested_at"] = time.time()
+            yield chunk
+
+    def share_chunks(self, chunks, manifest: IngestionManifest, excluded_ids, shared_ids, new_hashes):
+        """
+            Leaves out the chunks whose text is already stored for another file of the collection, their ids are
+            appended to `shared_ids`. The text hashes of the chunks passed on are appended to `new_hashes`, in order.
+        """
+        for chunk in chunks:
+            chunk_hash = chunk_text_hash(chunk.page_content)
+            if self.chunker_config.deduplicate_across_files and \
+                    (chunk_id := manifest.find_chunk(chunk_hash)) is not None and chunk_id not in excluded_ids:
+                shared_ids.append(chunk_id)
+                CHUNKS_DEDUPLICATED.labels("shared").inc()
+                continue
+            new_hashes.append(chunk_hash)
+            yield chunk
+
+    @classmethod
+    def vectorstore_db_insertion(cls, docs, progress=None, index_name=None, max_chunks_per_second=0,
+                                 written_ids=None):
+        """
+            Encodes the chunks in batches of EMBEDDING_BATCH_SIZE and writes each batch to the vector backend and
+            the keyword index.
+            The write of batch N runs on a writer thread while batch N+1 is being encoded.
+            With max_chunks_per_second, the loop sleeps between batches to stay under that rate.
+            The ids of every batch sent to the backend are appended to `written_ids`, to clean up after a failure.
+        """
+        index_name = index_name or cls.collection_name
         embeddings = get_embeddings_model()
-        with get_vector_db_client() as client:
-            copilot_vectorstore = get_vector_store(client=client, embeddings=embeddings, collection_name="zania")
-            for count, doc in enumerate(docs):
-                logger.debug(f"Persisting batch {count}")
-                copilot_vectorstore.add_documents([doc])
+        start_time = time.perf_counter()
+        chunk_ids = []
+        vector_backend.prepare(index_name, embeddings)
+        with ThreadPoolExecutor(max_workers=1, thread_name_prefix="vector-db-writer") as writer:
+            pending_write = None
+            for count, batch in enumerate(iter_batches(docs, cls.batch_size)):
+                with stage("embedding_encode"):
+                    vectors = embeddings.embed_documents([doc.page_content for doc in batch])
+                if pending_write:
+                    chunk_ids.extend(pending_write.result())
+                CHUNKS_EMBEDDED.inc(len(batch))
+                if progress:
+                    progress.chunks_embedded += len(batch)
+                logger.debug(f"Persisting batch {count} of {len(batch)} chunks")
+                doc_ids = [str(uuid.uuid4()) for _ in batch]
+                if written_ids is not None:
+                    written_ids.extend(doc_ids)
+                pending_write = writer.submit(insert_documents, index_name, batch, vectors,
+                                              cls.batch_size, cls.batch_mode, doc_ids)
+                if max_chunks_per_second:
+                    chunks_done = (count * cls.batch_size) + len(batch)
+                    time.sleep(max(0.0, chunks_done / max_chunks_per_second - (time.perf_counter() - start_time)))
+            if pending_write:
+                chunk_ids.extend(pending_write.result())
+
+        elapsed_time = time.perf_counter() - start_time
+        logger.info(f"Inserted {len(chunk_ids)} chunks in {elapsed_time:.2f}s "
+                    f"({len(chunk_ids) / elapsed_time if elapsed_time else 0:.1f} chunks/sec)")
+        return chunk_ids
+
+    def ingest_file(self, file_path, manifest: IngestionManifest, excluded_ids=frozenset()):
+        """
+            Embeds the file unless its content is in the manifest already. The new chunks are written and recorded
+            before the chunks of the previous version of the file are deleted, so the file stays searchable, and a
+            failed ingestion removes what it wrote and keeps the previous version. Chunks already stored for another
+            file are referenced instead of written again, except the chunks of the previous version of the file and
+            `excluded_ids`, whose metadata would be stale.
+        """
+        file_hash = compute_file_hash(file_path)
+        if (entry := manifest.get(file_hash)) and not self.force:
+            if entry["source"] == file_path:
+                logger.info(f"File {file_path} is unchanged, skipping embedding generation.")
+            else:
+                logger.info(f"File {file_path} has the content of {entry['source']}, skipping embedding generation.")
+                manifest.record_duplicate(file_hash, file_path)
+                manifest.save()
+            return False
+
+        if manifest.get(file_hash):
+            previous_hash, previous_entry = file_hash, manifest.get(file_hash)
+        else:
+            previous_hash, previous_entry = manifest.find_by_source(file_path)
+
+        # parse -> split and clean -> embed and write, streamed through generators
+        documents = self.load_documents(file_path)
+        chunks = self.stamp_chunks(self.data_splitting(documents=documents, file_path=file_path), file_hash)
+        shared_ids, new_hashes = [], []
+        # The chunks stored for the previous version of the file
+        previous_ids = set(previous_entry["chunk_ids"]) - set(previous_entry.get("shared_chunk_ids", [])) \
+            if previous_entry else set()
+        excluded_ids = previous_ids | set(excluded_ids)
+        chunks = self.share_chunks(chunks, manifest, excluded_ids, shared_ids, new_hashes)
+        written_ids = []
+        try:
+            chunk_ids = self.vectorstore_db_insertion(chunks, progress=self.progress, index_name=self.collection_name,
+                                                      max_chunks_per_second=self.max_chunks_per_second,
+                                                      written_ids=written_ids)
+        except Exception:
+            logger.error(f"Failed while embedding {file_path}, deleting the {len(written_ids)} chunks written")
+            if written_ids:
+                delete_documents_by_ids(written_ids, self.collection_name)
+            raise
+
+        # The ids were generated in the order of the chunks, the ones the backend failed to store are left out
+        stored_ids = set(chunk_ids)
+        manifest.add_chunks((chunk_hash, chunk_id) for chunk_hash, chunk_id in zip(new_hashes, written_ids)
+                            if chunk_id in stored_ids)
+        manifest.share_chunks(shared_ids)
+        duplicate_sources = []
+        if previous_entry:
+            manifest.remove(previous_hash)
+            duplicate_sources = [source for source in previous_entry.get("duplicate_sources", [])
+                                 if source != file_path]
+        manifest.record(file_hash, file_path, chunk_ids + shared_ids,
+                        duplicate_sources if previous_hash == file_hash else [], shared_chunk_ids=shared_ids)
+        manifest.save()
+        logger.info(f"Embedded {len(chunk_ids)} chunks for file {file_path}, {len(shared_ids)} shared with other files")
+
+        if previous_entry:
+            # The files that had the previous content and were skipped as duplicates are embedded in its place
+            if previous_hash != file_hash:
+                for source in duplicate_sources:
+                    if os.path.exists(source) and compute_file_hash(source) == previous_hash:
+                        self.ingest_file(source, manifest, excluded_ids=previous_ids)
+            # Chunks still referenced by other files stay
+            stale_ids = manifest.release_chunks(previous_entry["chunk_ids"])
+            manifest.save()
+            logger.info(f"File {file_path} has changed, deleting {len(stale_ids)} stale chunks.")
+            if stale_ids:
+                delete_documents_by_ids(stale_ids, self.collection_name)
+        return True
 
     def execute(self):
-        documents = self.load_documents()
-        chunks = self.data_splitting(documents=documents)
-        self.vectorstore_db_insertion(chunks)
+        file_paths = self.kwargs.get("file_paths") or self.list_source_files()
+        # Jobs of the same collection are serialized, they share the manifest. Jobs of different projects only
+        # share the ingestion workers.
+        with self.collection_lock(self.tenant.index_name):
+            # A re-index may have switched the collection while the job waited for the lock
+            self.collection_name = collection_aliases.resolve(self.tenant.index_name)
+            with tenants.in_use(self.collection_name):
+                manifest = IngestionManifest(self.collection_name)
+                ingested_files = [file_path for file_path in file_paths if self.ingest_file(file_path, manifest)]
+        if ingested_files:
+            retrieval_cache.bump_collection_version(self.collection_name)
+        return ingested_files
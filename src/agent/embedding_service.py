@@ -0,0 +1,380 @@
+"""
+    Query embeddings batched across requests.
+
+    In `local` mode every process batches its own callers on its own copy of the encoder. In `client` mode the
+    processes send their texts to one embedding server over a Unix socket, the server batches the callers of every
+    process and is the only one holding the model:
+
+    python -m src.agent.embedding_service
+"""
+import asyncio
+import json
+import os
+import socket
+import struct
+import time
+from collections import deque
+
+import numpy as np
+from fastapi.logger import logger
+
+from src.agent.executors import executors, run_encoder
+from src.agent.metrics import EMBEDDING_BATCH_SIZE, EMBEDDING_QUEUE_DEPTH
+from src.agent.model_registry import model_registry
+from src.config.config_client import config
+from src.schemas.pydantic_models import EmbeddingServiceConfig
+
+HEADER = struct.Struct("!I")
+# Readiness probes do not wait for a busy or restarting embedding server
+READY_TIMEOUT_SECONDS = 2
+
+
+def encode_frame(header: dict, vectors=None):
+    payload = b""
+    if vectors is not None:
+        vectors = np.asarray(vectors, dtype=np.float32)
+        header = dict(header, shape=list(vectors.shape))
+        payload = vectors.tobytes()
+    header = json.dumps(header).encode()
+    return HEADER.pack(len(header)) + header + payload
+
+
+def decode_vectors(header: dict, payload: bytes):
+    if "error" in header:
+        raise RuntimeError(f"Embedding server failed, {header['error']}")
+    return np.frombuffer(payload, dtype=np.float32).reshape(header["shape"]).tolist()
+
+
+def payload_size(header: dict):
+    return int(np.prod(header["shape"])) * 4 if "shape" in header else 0
+
+
+async def read_frame(reader: asyncio.StreamReader):
+    (length,) = HEADER.unpack(await reader.readexactly(HEADER.size))
+    header = json.loads(await reader.readexactly(length))
+    return header, await reader.readexactly(payload_size(header))
+
+
+class MicroBatcher:
+    """
+        Collects the texts of concurrent callers and encodes them in one forward pass on the encoder thread.
+        A batch is sent once it holds max_batch_size texts or its oldest text has waited max_wait_ms. While a batch
+        is being encoded the next one fills up, so batches grow with the load.
+    """
+
+    def __init__(self, service_config: EmbeddingServiceConfig):
+        self.config = service_config
+        self._pending = deque()
+        self._pending_texts = 0
+        self._wake = None
+        self._worker = None
+
+    def start(self):
+        self._wake = asyncio.Event()
+        self._worker = asyncio.create_task(self.__worker__(), name="embedding-batcher")
+
+    async def stop(self):
+        if self._worker:
+            self._worker.cancel()
+            await asyncio.gather(self._worker, return_exceptions=True)
+            self._worker = None
+        for _, _, future in self._pending:
+            future.cancel()
+        self._pending.clear()
+        self._pending_texts = 0
+
+    async def aembed(self, texts: list[str]):
+        if not texts:
+            return []
+        if self._worker is None:
+            self.start()
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((time.monotonic(), texts, future))
+        self._pending_texts += len(texts)
+        EMBEDDING_QUEUE_DEPTH.set(self._pending_texts)
+        self._wake.set()
+        return await future
+
+    def __take_batch__(self):
+        # Callers are never split, a caller with more than max_batch_size texts is a batch of its own
+        batch, size = [], 0
+        while self._pending and (not batch or size + len(self._pending[0][1]) <= self.config.max_batch_size):
+            _, texts, future = self._pending.popleft()
+            batch.append((texts, future))
+            size += len(texts)
+        self._pending_texts -= size
+        EMBEDDING_QUEUE_DEPTH.set(self._pending_texts)
+        return batch
+
+    async def __worker__(self):
+        while True:
+            if not self._pending:
+                self._wake.clear()
+                await self._wake.wait()
+            deadline = self._pending[0][0] + self.config.max_wait_ms / 1000
+            while self._pending_texts < self.config.max_batch_size and (remaining := deadline - time.monotonic()) > 0:
+                self._wake.clear()
+                try:
+                    await asyncio.wait_for(self._wake.wait(), remaining)
+                except asyncio.TimeoutError:
+                    break
+
+            batch = [(texts, future) for texts, future in self.__take_batch__() if not future.done()]
+            if not batch:
+                continue
+            texts = [text for caller_texts, _ in batch for text in caller_texts]
+            EMBEDDING_BATCH_SIZE.observe(len(texts))
+            try:
+                vectors = await run_encoder(lambda: model_registry.get().embed_documents(texts))
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            start = 0
+            for caller_texts, future in batch:
+                if not future.done():
+                    future.set_result(vectors[start:start + len(caller_texts)])
+                start += len(caller_texts)
+
+
+class EmbeddingServer:
+    """
+        Serves a MicroBatcher on a Unix socket. Requests of one connection are answered as they complete, matched
+        by their id.
+    """
+
+    def __init__(self, service_config: EmbeddingServiceConfig):
+        self.config = service_config
+        self.batcher = MicroBatcher(service_config)
+        self._server = None
+
+    async def __answer__(self, request, writer, write_lock):
+        try:
+            if request.get("op") == "info":
+                await run_encoder(model_registry.load)
+                frame = encode_frame(dict(id=request["id"], version=model_registry.version))
+            else:
+                vectors = await self.batcher.aembed(request["texts"])
+                frame = encode_frame(dict(id=request["id"], version=model_registry.version), vectors)
+        except Exception as e:
+            logger.error(f"Failed while embedding request {request.get('id')}, {e}", exc_info=True)
+            frame = encode_frame(dict(id=request.get("id"), error=str(e)))
+        async with write_lock:
+            writer.write(frame)
+            await writer.drain()
+
+    async def __handle__(self, reader, writer):
+        write_lock = asyncio.Lock()
+        tasks = set()
+        try:
+            while True:
+                request, _ = await read_frame(reader)
+                task = asyncio.create_task(self.__answer__(request, writer, write_lock))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            for task in tasks:
+                task.cancel()
+            writer.close()
+
+    async def serve(self):
+        if os.path.exists(self.config.socket_path):
+            os.remove(self.config.socket_path)
+        os.makedirs(os.path.dirname(self.config.socket_path) or ".", exist_ok=True)
+        executors.start()
+        self.batcher.start()
+        await run_encoder(model_registry.load)
+        self._server = await asyncio.start_unix_server(self.__handle__, path=self.config.socket_path)
+        logger.info(f"Embedding server listening on {self.config.socket_path}, model {model_registry.version}")
+        async with self._server:
+            await self._server.serve_forever()
+
+
+class EmbeddingClient:
+    """
+        Async client of the EmbeddingServer, all the requests of the process are multiplexed on one connection.
+    """
+
+    def __init__(self, service_config: EmbeddingServiceConfig):
+        self.config = service_config
+        self._reader = None
+        self._writer = None
+        self._reader_task = None
+        self._responses: dict[int, asyncio.Future] = {}
+        self._next_id = 0
+        self._lock = None
+
+    async def __connect__(self):
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            if self._writer is None or self._writer.is_closing():
+                self._reader, self._writer = await asyncio.open_unix_connection(self.config.socket_path)
+                self._reader_task = asyncio.create_task(self.__read_responses__(self._reader))
+
+    async def __read_responses__(self, reader):
+        error = ConnectionError("Embedding server connection closed")
+        try:
+            while True:
+                header, payload = await read_frame(reader)
+                if (future := self._responses.pop(header.get("id"), None)) is not None and not future.done():
+                    future.set_result((header, payload))
+        except (asyncio.IncompleteReadError, ConnectionError) as e:
+            error = ConnectionError(f"Embedding server connection lost, {e}")
+        finally:
+            # The requests in flight fail, the next one reconnects
+            self._writer = None
+            for future in self._responses.values():
+                if not future.done():
+                    future.set_exception(error)
+            self._responses.clear()
+
+    def is_connected(self):
+        return self._writer is not None and not self._writer.is_closing()
+
+    async def request(self, timeout=None, **request):
+        """
+            Sends `request` and waits for its response, at most `timeout` or EMBEDDING_SERVICE.timeout_seconds.
+        """
+        await self.__connect__()
+        self._next_id += 1
+        request_id = self._next_id
+        future = asyncio.get_running_loop().create_future()
+        self._responses[request_id] = future
+        try:
+            self._writer.write(encode_frame(dict(request, id=request_id)))
+            await self._writer.drain()
+            return await asyncio.wait_for(future, timeout or self.config.timeout_seconds)
+        finally:
+            # A response arriving after the timeout is dropped
+            self._responses.pop(request_id, None)
+
+    async def aclose(self):
+        if self._writer is not None:
+            self._writer.close()
+        if self._reader_task is not None:
+            self._reader_task.cancel()
+            await asyncio.gather(self._reader_task, return_exceptions=True)
+        self._writer, self._reader_task = None, None
+
+
+class RemoteEmbeddings:
+    """
+        Blocking embed_documents/embed_query over the embedding server for the callers running in threads, such as
+        ingestion. One short-lived connection per call.
+    """
+
+    def __init__(self, service_config: EmbeddingServiceConfig):
+        self.config = service_config
+
+    def __request__(self, **request):
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(self.config.timeout_seconds)
+            sock.connect(self.config.socket_path)
+            sock.sendall(encode_frame(dict(request, id=0)))
+            reader = sock.makefile("rb")
+            (length,) = HEADER.unpack(reader.read(HEADER.size))
+            header = json.loads(reader.read(length))
+            return header, reader.read(payload_size(header))
+
+    def embed_documents(self, texts: list[str]):
+        if not texts:
+            return []
+        return decode_vectors(*self.__request__(op="embed", texts=texts))
+
+    def embed_query(self, text: str):
+        return self.embed_documents([text])[0]
+
+    def version(self):
+        return self.__request__(op="info")[0].get("version", "")
+
+
+class EmbeddingService:
+    """
+        Entry point of the query encoding, in-process micro-batching or the shared embedding server according to
+        EMBEDDING_SERVICE.mode.
+    """
+
+    def __init__(self, service_config: EmbeddingServiceConfig):
+        self.config = service_config
+        self.is_remote = service_config.mode == "client"
+        self.batcher = MicroBatcher(service_config)
+        self.client = EmbeddingClient(service_config)
+        self.remote_embeddings = RemoteEmbeddings(service_config)
+        self.remote_version = ""
+
+    @property
+    def version(self):
+        return self.remote_version if self.is_remote else model_registry.version
+
+    def get_embeddings(self):
+        if not self.is_remote:
+            return model_registry.get()
+        if not self.remote_version:
+            self.remote_version = self.remote_embeddings.version()
+        return self.remote_embeddings
+
+    def is_ready(self):
+        if self.is_remote:
+            # The server answered and the connection to it is still up
+            return bool(self.remote_version) and self.client.is_connected()
+        return model_registry.is_ready()
+
+    async def ais_ready(self):
+        """
+            is_ready, in client mode a lost connection is reopened first, the embedding server may have restarted.
+        """
+        if self.is_remote and not self.is_ready():
+            try:
+                header, _ = await self.client.request(op="info", timeout=READY_TIMEOUT_SECONDS)
+                self.remote_version = header.get("version", "")
+            except (OSError, asyncio.TimeoutError) as e:
+                logger.info(f"Embedding server on {self.config.socket_path} is not reachable, {e}")
+        return self.is_ready()
+
+    async def aversion(self):
+        """
+            Version of the encoder, waits for it to be loaded (or for the server to answer) on first use.
+        """
+        if self.is_remote and not self.remote_version:
+            header, _ = await self.client.request(op="info")
+            self.remote_version = header.get("version", "")
+        elif not self.is_remote and not model_registry.is_ready():
+            await run_encoder(model_registry.load)
+        return self.version
+
+    async def aembed(self, texts: list[str]):
+        if not self.is_remote:
+            return await self.batcher.aembed(texts)
+        header, payload = await self.client.request(op="embed", texts=texts)
+        self.remote_version = header.get("version", self.remote_version)
+        return decode_vectors(header, payload)
+
+    async def start(self):
+        """
+            Loads and warms up the encoder, in client mode waits for the embedding server instead and never loads the
+            model in this process.
+        """
+        if not self.is_remote:
+            self.batcher.start()
+            return await self.aversion()
+        while True:
+            try:
+                return await self.aversion()
+            except OSError as e:
+                logger.info(f"Waiting for the embedding server on {self.config.socket_path}, {e}")
+                await asyncio.sleep(1)
+
+    async def stop(self):
+        await self.batcher.stop()
+        await self.client.aclose()
+
+
+embedding_service = EmbeddingService(EmbeddingServiceConfig(**(config.get("EMBEDDING_SERVICE") or {})))
+
+
+if __name__ == "__main__":
+    asyncio.run(EmbeddingServer(embedding_service.config).serve())
@@ -0,0 +1,100 @@
+import asyncio
+import contextvars
+import functools
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+from fastapi.logger import logger
+from src.config.config_client import config
+
+
+class AgentExecutors:
+    """
+        Bounded pools that keep blocking work off the event loop.
+        io: file and network I/O, encoder: dedicated SBERT thread, ingestion: embedding generation,
+        parser: worker processes for PDF parsing. Ingestion threads run at INGESTION_NICENESS.
+    """
+
+    io_pool_size = int(config.get("IO_POOL_SIZE", 8))
+    ingestion_workers = int(config.get("INGESTION_WORKERS", 1))
+    parser_pool_size = int(config.get("PARSER_POOL_SIZE", 0)) or os.cpu_count() or 1
+    ingestion_niceness = int(config.get("INGESTION_NICENESS", 10))
+
+    def __init__(self):
+        self._io = None
+        self._encoder = None
+        self._ingestion = None
+        self._parser = None
+        self._lock = threading.Lock()
+
+    def __get_pool__(self, name, factory):
+        if getattr(self, name) is None:
+            with self._lock:
+                if getattr(self, name) is None:
+                    setattr(self, name, factory())
+        return getattr(self, name)
+
+    @property
+    def io(self):
+        return self.__get_pool__("_io", lambda: ThreadPoolExecutor(max_workers=self.io_pool_size,
+                                                                   thread_name_prefix="agent-io"))
+
+    @property
+    def encoder(self):
+        return self.__get_pool__("_encoder", lambda: ThreadPoolExecutor(max_workers=1,
+                                                                        thread_name_prefix="agent-encoder"))
+
+    def __lower_priority__(self):
+        # Linux schedules threads individually, ingestion yields the CPU to the query path of every tenant
+        try:
+            os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), self.ingestion_niceness)
+        except (AttributeError, OSError) as e:
+            logger.debug(f"Ingestion thread priority unchanged, {e}")
+
+    @property
+    def ingestion(self):
+        return self.__get_pool__("_ingestion", lambda: ThreadPoolExecutor(max_workers=self.ingestion_workers,
+                                                                          thread_name_prefix="agent-ingestion",
+                                                                          initializer=self.__lower_priority__))
+
+    @property
+    def parser(self):
+        # Spawned workers do not inherit the model, the vector DB connections or the event loop threads
+        return self.__get_pool__("_parser", lambda: ProcessPoolExecutor(
+            max_workers=self.parser_pool_size, mp_context=multiprocessing.get_context("spawn")))
+
+    def start(self):
+        logger.info(f"Starting executors io={self.io_pool_size}, parser={self.parser_pool_size}")
+        return self.io, self.encoder, self.ingestion
+
+    def shutdown(self):
+        with self._lock:
+            for name in ("_io", "_encoder", "_ingestion", "_parser"):
+                pool = getattr(self, name)
+                if pool is not None:
+                    pool.shutdown(wait=False, cancel_futures=True)
+                    setattr(self, name, None)
+
+
+executors = AgentExecutors()
+
+
+async def __run_in__(pool, func, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    # Carries the request context (stage timings) into the worker thread
+    context = contextvars.copy_context()
+    return await loop.run_in_executor(pool, functools.partial(context.run, func, *args, **kwargs))
+
+
+async def run_io(func, *args, **kwargs):
+    return await __run_in__(executors.io, func, *args, **kwargs)
+
+
+async def run_encoder(func, *args, **kwargs):
+    return await __run_in__(executors.encoder, func, *args, **kwargs)
+
+
+async def run_ingestion(func, *args, **kwargs):
+    return await __run_in__(executors.ingestion, func, *args, **kwargs)
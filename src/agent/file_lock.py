@@ -0,0 +1,38 @@
+import fcntl
+import os
+from contextlib import contextmanager
+
+from src.config.config_client import config
+
+locks_path = os.path.join(config.get("VECTOR_DB_PATH", "data_weaviate"), "locks")
+
+
+class FileLockBusy(Exception):
+    pass
+
+
+@contextmanager
+def file_lock(path, shared=False, blocking=True):
+    """
+        flock on `path`, shared between the processes of the host (gunicorn workers, the CLI tools) and the threads of
+        a process, each acquisition opens its own descriptor. Not reentrant. With blocking=False, FileLockBusy is
+        raised when the lock is held elsewhere.
+    """
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path, "a+") as f:
+        flags = (fcntl.LOCK_SH if shared else fcntl.LOCK_EX) | (0 if blocking else fcntl.LOCK_NB)
+        try:
+            fcntl.flock(f.fileno(), flags)
+        except BlockingIOError:
+            raise FileLockBusy(path)
+        try:
+            yield
+        finally:
+            fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+
+def named_lock(name, shared=False, blocking=True):
+    """
+        file_lock on VECTOR_DB_PATH/locks/<name>.lock.
+    """
+    return file_lock(os.path.join(locks_path, f"{name.lower()}.lock"), shared=shared, blocking=blocking)
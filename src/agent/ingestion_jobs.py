@@ -0,0 +1,216 @@
+import asyncio
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from fastapi.logger import logger
+
+from src.agent.embedding_generation import GenerateEmbedding
+from src.agent.executors import executors, run_ingestion, run_io
+from src.agent.file_lock import FileLockBusy
+from src.agent.maintenance import CollectionMaintenance
+from src.agent.reindex import Reindexer, ReindexValidationError
+from src.agent.utils import AgentException
+from src.config.config_client import config
+from src.schemas.pydantic_models import IngestionJobStatus, ReindexConfig, Tenant
+from src.startup_constants import INGESTION_QUEUE_FULL, INGESTION_JOB_NOT_FOUND, REINDEX_IN_PROGRESS
+
+
+class IngestionJobStore:
+    """
+        Status of the ingestion jobs of every worker process, in VECTOR_DB_PATH/ingestion_jobs.sqlite, so that a job
+        can be polled on any worker. Keeps the max_jobs most recent ones.
+    """
+
+    def __init__(self, path, max_jobs):
+        self.path = path
+        self.max_jobs = max_jobs
+        self._local = threading.local()
+
+    def __connection__(self):
+        if getattr(self._local, "connection", None) is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            connection = sqlite3.connect(self.path, timeout=5, isolation_level=None, check_same_thread=False)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("CREATE TABLE IF NOT EXISTS jobs (job_id TEXT PRIMARY KEY, created_at REAL, status TEXT)")
+            self._local.connection = connection
+        return self._local.connection
+
+    def save(self, job: IngestionJobStatus, new=False):
+        connection = self.__connection__()
+        connection.execute("INSERT OR REPLACE INTO jobs VALUES (?, ?, ?)",
+                           (job.job_id, job.created_at, job.model_dump_json()))
+        if new:
+            connection.execute("DELETE FROM jobs WHERE job_id IN (SELECT job_id FROM jobs "
+                               "ORDER BY created_at DESC LIMIT -1 OFFSET ?)", (self.max_jobs,))
+
+    def get(self, job_id):
+        row = self.__connection__().execute("SELECT status FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+        return IngestionJobStatus.model_validate_json(row[0]) if row else None
+
+
+class IngestionJobQueue:
+    """
+        Bounded queue of ingestion jobs processed in the background by INGESTION_WORKERS workers.
+        Submissions are rejected once INGESTION_QUEUE_SIZE jobs are waiting.
+        The jobs run in the worker process that queued them, their status is shared through IngestionJobStore and
+        saved every progress_interval_seconds while they run.
+    """
+
+    queue_size = int(config.get("INGESTION_QUEUE_SIZE", 32))
+    max_job_history = int(config.get("INGESTION_JOB_HISTORY", 1000))
+    progress_interval_seconds = float(config.get("INGESTION_PROGRESS_INTERVAL", 2))
+    reindex_config = ReindexConfig(**(config.get("REINDEX") or {}))
+
+    def __init__(self):
+        self._queue = None
+        self._workers = []
+        self._jobs: OrderedDict[str, IngestionJobStatus] = OrderedDict()
+        self.store = IngestionJobStore(os.path.join(config.get("VECTOR_DB_PATH", "data_weaviate"),
+                                                    "ingestion_jobs.sqlite"), self.max_job_history)
+
+    def start(self):
+        self._queue = asyncio.Queue(maxsize=self.queue_size)
+        self._workers = [asyncio.create_task(self.__worker__(), name=f"ingestion-worker-{k}")
+                         for k in range(executors.ingestion_workers)]
+        logger.info(f"Started {len(self._workers)} ingestion workers, queue size {self.queue_size}")
+
+    async def stop(self):
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+
+    def __record__(self, job):
+        self.store.save(job, new=True)
+        self._jobs[job.job_id] = job
+        while len(self._jobs) > self.max_job_history:
+            self._jobs.popitem(last=False)
+        return job
+
+    def submit(self, tenant: Tenant, file_paths=None, file_name=None, force=False):
+        if self._queue is None:
+            self.start()
+        job = IngestionJobStatus(job_id=uuid.uuid4().hex, project_id=tenant.project_id, status="queued",
+                                 file_name=file_name, created_at=time.time())
+        try:
+            self._queue.put_nowait((job, tenant, file_paths, force))
+        except asyncio.QueueFull:
+            raise AgentException(code=429, message=INGESTION_QUEUE_FULL, display_message=INGESTION_QUEUE_FULL)
+
+        logger.info(f"Ingestion job {job.job_id} queued for {file_name or 'the download folder'} "
+                    f"of {tenant.index_name}")
+        return self.__record__(job)
+
+    def __submit_collection_job__(self, tenant: Tenant, kind, force=False):
+        if self._queue is None:
+            self.start()
+        job = IngestionJobStatus(job_id=uuid.uuid4().hex, kind=kind, project_id=tenant.project_id,
+                                 status="queued", created_at=time.time())
+        try:
+            self._queue.put_nowait((job, tenant, None, force))
+        except asyncio.QueueFull:
+            raise AgentException(code=429, message=INGESTION_QUEUE_FULL, display_message=INGESTION_QUEUE_FULL)
+
+        logger.info(f"{kind.capitalize()} job {job.job_id} queued for {tenant.index_name}")
+        return self.__record__(job)
+
+    def submit_reindex(self, tenant: Tenant):
+        """
+            Queues the rebuild of the tenant's collection into a new version, see Reindexer. Refused while another
+            worker re-indexes it.
+        """
+        if Reindexer.is_running(tenant):
+            raise AgentException(code=409, message=f"{REINDEX_IN_PROGRESS} {tenant.index_name}",
+                                 display_message=REINDEX_IN_PROGRESS)
+        return self.__submit_collection_job__(tenant, "reindex")
+
+    def submit_maintenance(self, tenant: Tenant, fix=False):
+        """
+            Queues the check (and with `fix` the clean up) and the compaction of the tenant's collection, see
+            CollectionMaintenance.
+        """
+        return self.__submit_collection_job__(tenant, "maintenance", force=fix)
+
+    def skip(self, tenant: Tenant, file_name):
+        """
+            Records a job for an upload whose content is already indexed, nothing is queued.
+        """
+        now = time.time()
+        return self.__record__(IngestionJobStatus(job_id=uuid.uuid4().hex, project_id=tenant.project_id,
+                                                  status="skipped", file_name=file_name, created_at=now,
+                                                  started_at=now, finished_at=now))
+
+    def get(self, job_id, tenant: Tenant):
+        # Jobs of this process are read live, the others as last saved by their worker process. They are only
+        # visible to the project that submitted them.
+        if (job := self._jobs.get(job_id) or self.store.get(job_id)) and job.project_id == tenant.project_id:
+            return job
+        raise AgentException(code=404, message=INGESTION_JOB_NOT_FOUND, display_message=INGESTION_JOB_NOT_FOUND)
+
+    def queue_depth(self):
+        return self._queue.qsize() if self._queue else 0
+
+    async def __save_progress__(self, job, finished: asyncio.Event):
+        # Stopped through `finished` rather than cancelled, a save already running in the executor would complete
+        # after the final status and overwrite it
+        while not finished.is_set():
+            try:
+                await run_io(self.store.save, job)
+            except Exception as e:
+                logger.error(f"Failed while saving the status of ingestion job {job.job_id}, {e}")
+            try:
+                await asyncio.wait_for(finished.wait(), self.progress_interval_seconds)
+            except asyncio.TimeoutError:
+                pass
+
+    async def __worker__(self):
+        while True:
+            job, tenant, file_paths, force = await self._queue.get()
+            job.status = "running"
+            job.started_at = time.time()
+            finished = asyncio.Event()
+            progress_task = asyncio.create_task(self.__save_progress__(job, finished))
+            try:
+                if job.kind == "reindex":
+                    reindexer = Reindexer(tenant, self.reindex_config, progress=job)
+                    job.report = await run_ingestion(reindexer.run, wait_for_gc=False)
+                    job.status = "completed"
+                elif job.kind == "maintenance":
+                    job.report = await run_ingestion(CollectionMaintenance(tenant, fix=force).run)
+                    job.status = "completed"
+                else:
+                    ingested_files = await run_ingestion(GenerateEmbedding(tenant=tenant, file_paths=file_paths,
+                                                                         force=force, progress=job).execute)
+                    job.files_ingested = ingested_files
+                    job.status = "completed" if ingested_files else "skipped"
+            except asyncio.CancelledError:
+                job.status = "failed"
+                job.error = "Ingestion cancelled"
+                raise
+            except ReindexValidationError as e:
+                job.status = "failed"
+                job.error = str(e)
+                job.report = e.report
+            except FileLockBusy:
+                job.status = "failed"
+                job.error = REINDEX_IN_PROGRESS
+            except Exception as e:
+                logger.error(f"Ingestion job {job.job_id} failed, {e}", exc_info=True)
+                job.status = "failed"
+                job.error = str(e)
+            finally:
+                job.finished_at = time.time()
+                finished.set()
+                await asyncio.gather(progress_task, return_exceptions=True)
+                try:
+                    await run_io(self.store.save, job)
+                except Exception as e:
+                    logger.error(f"Failed while saving the status of ingestion job {job.job_id}, {e}")
+                self._queue.task_done()
+
+
+ingestion_queue = IngestionJobQueue()
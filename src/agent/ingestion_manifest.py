@@ -0,0 +1,124 @@
+import hashlib
+import json
+import os
+import threading
+import time
+
+from fastapi.logger import logger
+from src.config.config_client import config
+
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+def compute_file_hash(file_path):
+    file_hash = hashlib.sha256()
+    with open(file_path, "rb") as file_object:
+        while chunk := file_object.read(HASH_CHUNK_SIZE):
+            file_hash.update(chunk)
+    return file_hash.hexdigest()
+
+
+class IngestionManifest:
+    """
+        Persistent record of the files ingested into a collection, keyed by file content hash.
+        Each entry remembers the source file, the ids of the chunks it produced and the other files with the same
+        content, which were not embedded again.
+        Chunks are also recorded by the hash of their text, with the number of entries that reference them: a chunk
+        whose text is already stored for another file is not written again, its id is added to the entry instead,
+        and the chunk is only deleted once no entry references it.
+    """
+
+    vector_db_path = config.get('VECTOR_DB_PATH', 'data_weaviate')
+    _lock = threading.Lock()
+
+    def __init__(self, collection_name):
+        self.collection_name = collection_name.lower()
+        self.manifest_path = os.path.join(self.vector_db_path, f"{self.collection_name}_manifest.json")
+        manifest = self.__load__()
+        self.entries: dict[str, dict] = manifest.get("files", {})
+        # chunk text hash -> [chunk id, number of entries referencing it]
+        self.chunks: dict[str, list] = manifest.get("chunks", {})
+        self._chunk_hashes = {chunk_id: chunk_hash for chunk_hash, (chunk_id, _) in self.chunks.items()}
+
+    def __load__(self):
+        if not os.path.exists(self.manifest_path):
+            return {}
+        try:
+            with open(self.manifest_path) as f:
+                return json.load(f)
+        except Exception as e:
+            logger.error(f"Failed while reading ingestion manifest {self.manifest_path}, {e}", exc_info=True)
+            return {}
+
+    def save(self):
+        with self._lock:
+            os.makedirs(os.path.dirname(self.manifest_path) or ".", exist_ok=True)
+            tmp_path = f"{self.manifest_path}.tmp"
+            with open(tmp_path, "w") as f:
+                json.dump({"collection": self.collection_name, "files": self.entries, "chunks": self.chunks}, f)
+            os.replace(tmp_path, self.manifest_path)
+
+    def get(self, file_hash):
+        return self.entries.get(file_hash)
+
+    def find_by_source(self, source):
+        for file_hash, entry in self.entries.items():
+            if entry.get("source") == source:
+                return file_hash, entry
+        return None, None
+
+    def record(self, file_hash, source, chunk_ids, duplicate_sources=(), shared_chunk_ids=()):
+        self.entries[file_hash] = dict(source=source, chunk_ids=list(chunk_ids), ingested_at=time.time(),
+                                       duplicate_sources=list(duplicate_sources),
+                                       shared_chunk_ids=list(shared_chunk_ids))
+
+    def record_duplicate(self, file_hash, source):
+        duplicate_sources = self.entries[file_hash].setdefault("duplicate_sources", [])
+        if source not in duplicate_sources:
+            duplicate_sources.append(source)
+
+    def remove(self, file_hash):
+        return self.entries.pop(file_hash, None)
+
+    def chunk_ids(self):
+        """
+            Ids of the chunks referenced by the entries, each shared chunk once.
+        """
+        return {chunk_id for entry in self.entries.values() for chunk_id in entry["chunk_ids"]}
+
+    def find_chunk(self, chunk_hash):
+        if chunk := self.chunks.get(chunk_hash):
+            return chunk[0]
+        return None
+
+    def add_chunks(self, chunks):
+        # (text hash, id) of the chunks written, the first chunk stored with a text is the one shared
+        for chunk_hash, chunk_id in chunks:
+            if chunk_hash not in self.chunks:
+                self.chunks[chunk_hash] = [chunk_id, 1]
+                self._chunk_hashes[chunk_id] = chunk_hash
+
+    def share_chunks(self, chunk_ids):
+        for chunk_id in chunk_ids:
+            if (chunk_hash := self._chunk_hashes.get(chunk_id)) is not None:
+                self.chunks[chunk_hash][1] += 1
+
+    def release_chunks(self, chunk_ids):
+        """
+            Drops one reference to each of `chunk_ids`, returns the ids no entry references anymore, to be deleted.
+        """
+        released = []
+        for chunk_id in chunk_ids:
+            if (chunk_hash := self._chunk_hashes.get(chunk_id)) is not None:
+                self.chunks[chunk_hash][1] -= 1
+                if self.chunks[chunk_hash][1] > 0:
+                    continue
+                del self.chunks[chunk_hash], self._chunk_hashes[chunk_id]
+            released.append(chunk_id)
+        return released
+
+    def forget_chunks(self, chunk_ids):
+        # Chunks deleted from the collection are not shared anymore
+        for chunk_id in chunk_ids:
+            if (chunk_hash := self._chunk_hashes.pop(chunk_id, None)) is not None:
+                del self.chunks[chunk_hash]
@@ -0,0 +1,343 @@
+import heapq
+import json
+import math
+import os
+import random
+import re
+import threading
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+
+from fastapi.logger import logger
+from langchain_core.documents.base import Document
+from stop_words import get_stop_words
+
+from src.agent.file_lock import file_lock
+from src.config.config_client import config
+
+cachedStopWords = get_stop_words("english")
+stopwords_dict = Counter(cachedStopWords)
+
+# Words, numbers and identifiers such as AC-2, CC6.1 or POL/2024/17 are kept as one token
+TOKEN_PATTERN = re.compile(r"\w+(?:[-./:]\w+)*")
+
+
+def tokenize(text):
+    tokens = []
+    for token in TOKEN_PATTERN.findall(text.lower()):
+        if token in stopwords_dict:
+            continue
+        tokens.append(token)
+        # The parts of an identifier match too, with a lower weight through their higher document frequency
+        if not token.isalnum():
+            tokens.extend(part for part in re.split(r"[-./:]", token) if part and part not in stopwords_dict)
+    return tokens
+
+
+class KeywordIndex:
+    """
+        BM25 inverted index of one collection, kept in memory and persisted as an append-only JSON lines log of
+        added chunks and deleted ids. The log is replayed on first use and compacted when deletions dominate it.
+        Every gunicorn worker holds its own copy: appends and compactions take an exclusive file lock, and the
+        records other workers appended are replayed when the size of the log changes, the whole log when a
+        compaction replaced it.
+    """
+
+    k1 = 1.2
+    b = 0.75
+
+    def __init__(self, log_path):
+        self.log_path = log_path
+        self._lock = threading.RLock()
+        self._loaded = False
+        self.postings: dict[str, dict[str, int]] = defaultdict(dict)
+        self.doc_lengths: dict[str, int] = {}
+        # Byte offset of the add record of every live chunk, its text and metadata are read on demand
+        self.offsets: dict[str, int] = {}
+        self.total_length = 0
+        self.log_records = 0
+        # The log as last read: open file, inode and number of bytes replayed
+        self._log_file = None
+        self._log_inode = None
+        self._log_size = 0
+
+    @property
+    def lock_path(self):
+        return f"{self.log_path}.lock"
+
+    def exists(self):
+        return os.path.exists(self.log_path)
+
+    def __log_stat__(self):
+        try:
+            stat = os.stat(self.log_path)
+        except FileNotFoundError:
+            return None, 0
+        return stat.st_ino, stat.st_size
+
+    def __load__(self):
+        if self._loaded and self.__log_stat__() == (self._log_inode, self._log_size):
+            return
+        with self._lock:
+            if self._loaded and self.__log_stat__() == (self._log_inode, self._log_size):
+                return
+            if not self.exists():
+                self.__refresh__()
+                return
+            with file_lock(self.lock_path, shared=True):
+                self.__refresh__()
+
+    def __refresh__(self):
+        """
+            Replays the records appended since the log was last read, under the file lock.
+        """
+        inode, size = self.__log_stat__()
+        if inode != self._log_inode or size < self._log_size:
+            was_loaded = self._loaded
+            self.__reset__()
+            if inode is not None:
+                self._log_file = open(self.log_path, "rb")
+                self._log_inode = os.fstat(self._log_file.fileno()).st_ino
+            if was_loaded:
+                logger.info(f"Keyword index {self.log_path} was replaced, reloading it")
+        if self._log_file is not None and size > self._log_size:
+            # Read ahead of the replay, removing a chunk reads its add record through the same file
+            tail = os.pread(self._log_file.fileno(), size - self._log_size, self._log_size)
+            for line in tail.splitlines(keepends=True):
+                if not line.endswith(b"\n"):
+                    break
+                record = json.loads(line)
+                if "delete" in record:
+                    self.__remove__(record["delete"])
+                else:
+                    self.__index__(record["id"], Counter(tokenize(record["text"])), self._log_size)
+                self._log_size += len(line)
+                self.log_records += 1
+        if not self._loaded:
+            self._loaded = True
+            logger.info(f"Loaded keyword index {self.log_path} with {len(self.doc_lengths)} chunks")
+
+    @contextmanager
+    def __writing__(self):
+        """
+            Exclusive access to the log across threads and processes, with the records of other workers replayed.
+        """
+        with self._lock, file_lock(self.lock_path):
+            self.__refresh__()
+            yield
+            # The log was created by this write
+            if self._log_file is None and self.exists():
+                self._log_file = open(self.log_path, "rb")
+                self._log_inode = os.fstat(self._log_file.fileno()).st_ino
+
+    def __reset__(self):
+        if self._log_file is not None:
+            self._log_file.close()
+        self._log_file = None
+        self._log_inode = None
+        self._log_size = 0
+        self.postings = defaultdict(dict)
+        self.doc_lengths = {}
+        self.offsets = {}
+        self.total_length = 0
+        self.log_records = 0
+
+    def __index__(self, doc_id, term_counts, offset):
+        for term, count in term_counts.items():
+            self.postings[term][doc_id] = count
+        length = sum(term_counts.values())
+        self.doc_lengths[doc_id] = length
+        self.total_length += length
+        self.offsets[doc_id] = offset
+
+    def __remove__(self, ids):
+        for doc_id in ids:
+            if (offset := self.offsets.pop(doc_id, None)) is None:
+                continue
+            self.total_length -= self.doc_lengths.pop(doc_id)
+            for term in set(tokenize(self.__read_record__(offset)["text"])):
+                postings = self.postings.get(term)
+                if postings is not None:
+                    postings.pop(doc_id, None)
+                    if not postings:
+                        del self.postings[term]
+
+    def __read_record__(self, offset):
+        # Under self._lock, the file stays the one the offsets point into until the next refresh
+        self._log_file.seek(offset)
+        return json.loads(self._log_file.readline())
+
+    def __append__(self, records):
+        os.makedirs(os.path.dirname(self.log_path) or ".", exist_ok=True)
+        with open(self.log_path, "ab") as f:
+            offsets = []
+            for record in records:
+                offsets.append(f.tell())
+                f.write(json.dumps(record, default=str).encode() + b"\n")
+            self._log_size = f.tell()
+        self.log_records += len(offsets)
+        return offsets
+
+    def add(self, ids, docs):
+        term_counts = [Counter(tokenize(doc.page_content)) for doc in docs]
+        with self.__writing__():
+            self.__add__(ids, docs, term_counts)
+
+    def __add__(self, ids, docs, term_counts):
+        # A chunk a backfill already indexed is not added twice
+        rows = [(doc_id, doc, doc_term_counts) for doc_id, doc, doc_term_counts in zip(ids, docs, term_counts)
+                if doc_id not in self.offsets]
+        offsets = self.__append__(dict(id=doc_id, text=doc.page_content, metadata=doc.metadata)
+                                  for doc_id, doc, _ in rows)
+        for (doc_id, _, doc_term_counts), offset in zip(rows, offsets):
+            self.__index__(doc_id, doc_term_counts, offset)
+        return len(rows)
+
+    def backfill(self, rows, batch_size=1000):
+        """
+            Indexes the (id, text, metadata) rows of the vector store that the index is missing, for the
+            collections ingested before it existed. Returns the number of chunks added.
+        """
+        added = 0
+        with self.__writing__():
+            ids, docs = [], []
+            for doc_id, text, metadata in rows:
+                if doc_id not in self.offsets:
+                    ids.append(doc_id)
+                    docs.append(Document(page_content=text, metadata=metadata))
+                if len(ids) >= batch_size:
+                    added += self.__add__(ids, docs, [Counter(tokenize(doc.page_content)) for doc in docs])
+                    ids, docs = [], []
+            # The log is created even when nothing is missing, it marks the collection as backfilled
+            added += self.__add__(ids, docs, [Counter(tokenize(doc.page_content)) for doc in docs])
+        logger.info(f"Backfilled keyword index {self.log_path} with {added} chunks")
+        return added
+
+    def delete(self, ids):
+        with self.__writing__():
+            ids = [doc_id for doc_id in ids if doc_id in self.offsets]
+            if not ids:
+                return
+            # The records are still needed to find the postings of the deleted chunks
+            self.__remove__(ids)
+            self.__append__([dict(delete=ids)])
+            if self.log_records > 2 * len(self.offsets) + 1000:
+                self.__compact__()
+
+    def compact(self):
+        """
+            Rewrites the log with the live chunks only, returns the number of log records removed.
+        """
+        with self.__writing__():
+            return self.__compact__()
+
+    def __compact__(self):
+        if not self.exists():
+            return 0
+        tmp_path = f"{self.log_path}.tmp"
+        offsets = {}
+        with open(tmp_path, "wb") as f:
+            for doc_id, offset in self.offsets.items():
+                offsets[doc_id] = f.tell()
+                f.write(json.dumps(self.__read_record__(offset)).encode() + b"\n")
+        os.replace(tmp_path, self.log_path)
+        removed = self.log_records - len(offsets)
+        self._log_file.close()
+        self._log_file = open(self.log_path, "rb")
+        self._log_inode = os.fstat(self._log_file.fileno()).st_ino
+        self._log_size = os.fstat(self._log_file.fileno()).st_size
+        self.offsets = offsets
+        self.log_records = len(offsets)
+        return removed
+
+    def count(self):
+        self.__load__()
+        return len(self.doc_lengths)
+
+    def ids(self):
+        self.__load__()
+        with self._lock:
+            return set(self.offsets)
+
+    def sample(self, count, seed=0):
+        """
+            Up to `count` random chunks of the collection, as Documents with their metadata and id.
+        """
+        self.__load__()
+        with self._lock:
+            doc_ids = sorted(self.offsets)
+            doc_ids = random.Random(seed).sample(doc_ids, min(count, len(doc_ids)))
+            records = [self.__read_record__(self.offsets[doc_id]) for doc_id in doc_ids]
+        return [Document(page_content=record["text"], metadata=dict(record["metadata"], id=record["id"]))
+                for record in records]
+
+    def search(self, query, limit):
+        """
+            Top chunks by BM25 score, returns a list of (Document, score).
+        """
+        self.__load__()
+        query_terms = Counter(tokenize(query))
+        scores = defaultdict(float)
+        # Ingestion batches update the postings concurrently
+        with self._lock:
+            n_docs = len(self.doc_lengths)
+            if not n_docs or limit <= 0:
+                return []
+            average_length = self.total_length / n_docs
+            for term, query_count in query_terms.items():
+                postings = self.postings.get(term)
+                if not postings:
+                    continue
+                idf = math.log(1 + (n_docs - len(postings) + 0.5) / (len(postings) + 0.5))
+                for doc_id, count in postings.items():
+                    norm = self.k1 * (1 - self.b + self.b * self.doc_lengths[doc_id] / average_length)
+                    scores[doc_id] += query_count * idf * count * (self.k1 + 1) / (count + norm)
+
+            results = []
+            for doc_id, score in heapq.nlargest(limit, scores.items(), key=lambda item: item[1]):
+                record = self.__read_record__(self.offsets[doc_id])
+                results.append((Document(page_content=record["text"], metadata=dict(record["metadata"], id=doc_id)),
+                                score))
+        return results
+
+    def unload(self):
+        with self._lock:
+            self.__reset__()
+            self._loaded = False
+
+    def drop(self):
+        with self._lock, file_lock(self.lock_path):
+            if os.path.exists(self.log_path):
+                os.remove(self.log_path)
+            self.__reset__()
+            self._loaded = True
+
+
+class KeywordIndexRegistry:
+    """
+        One KeywordIndex per collection under VECTOR_DB_PATH/keyword_index, created on first use.
+    """
+
+    index_path = os.path.join(config.get("VECTOR_DB_PATH", "data_weaviate"), "keyword_index")
+
+    def __init__(self):
+        self._indexes: dict[str, KeywordIndex] = {}
+        self._lock = threading.Lock()
+
+    def get(self, index_name) -> KeywordIndex:
+        index_name = index_name.lower()
+        if (index := self._indexes.get(index_name)) is None:
+            with self._lock:
+                if (index := self._indexes.get(index_name)) is None:
+                    index = KeywordIndex(os.path.join(self.index_path, f"{index_name}.jsonl"))
+                    self._indexes[index_name] = index
+        return index
+
+    def offload(self, index_name):
+        with self._lock:
+            index = self._indexes.pop(index_name.lower(), None)
+        if index is not None:
+            index.unload()
+
+
+keyword_indexes = KeywordIndexRegistry()
@@ -0,0 +1,218 @@
+import asyncio
+import hashlib
+import os
+import random
+import time
+from contextlib import nullcontext
+
+import httpx
+import openai
+from fastapi.logger import logger
+from langchain_openai import ChatOpenAI
+
+from src.agent.metrics import LLM_COALESCED, LLM_RETRIES, record_llm_usage
+from src.config.config_client import config
+from src.schemas.pydantic_models import LLMGatewayConfig
+
+RETRYABLE_ERRORS = (openai.RateLimitError, openai.InternalServerError, openai.APIConnectionError,
+                    openai.APITimeoutError)
+
+
+class TokenBucket:
+    """
+        Paces usage to `rate_per_minute`, refilled continuously. Amounts can be reconciled after the fact, which may
+        leave the bucket in debt until it refills.
+    """
+
+    def __init__(self, rate_per_minute):
+        self.rate_per_second = rate_per_minute / 60
+        self.capacity = float(rate_per_minute)
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def __refill__(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate_per_second)
+        self.updated_at = now
+
+    async def acquire(self, amount):
+        amount = min(amount, self.capacity)
+        # Callers are served in order, the lock is held while waiting for the refill
+        async with self._lock:
+            self.__refill__()
+            while self.tokens < amount:
+                await asyncio.sleep((amount - self.tokens) / self.rate_per_second)
+                self.__refill__()
+            self.tokens -= amount
+
+    def reconcile(self, difference):
+        self.__refill__()
+        self.tokens -= difference
+
+
+class LLMGateway:
+    """
+        Process wide entry point to the chat model, created in the application lifespan.
+        Calls share one pooled HTTP client and are bounded by a global semaphore and a per-request semaphore, paced by
+        requests and tokens per minute, retried with jittered exponential backoff on 429/5xx. Identical prompts in
+        flight at the same time are sent once.
+        requests_per_minute and tokens_per_minute are the limits of the API account, each of the WEB_CONCURRENCY
+        worker processes paces its calls to its share of them.
+    """
+
+    def __init__(self, gateway_config: LLMGatewayConfig):
+        self.config = gateway_config
+        self.model = None
+        self.model_key = ""
+        self._http_client = None
+        self._semaphore = None
+        self._requests = None
+        self._tokens = None
+        self._in_flight: dict[str, asyncio.Future] = {}
+
+    @staticmethod
+    def __create_model__(http_client):
+        model_type = config.get("DOCUMENT_AGENT_LLM_TYPE", "OPENAI_GPT_4o_MINI")
+        openai_keys = config.get(model_type, {})
+        return ChatOpenAI(
+            openai_api_key=openai_keys.get("OPENAI_API_KEY"),
+            # A compatible endpoint such as benchmarks/mock_openai_server.py, the OpenAI API when empty
+            openai_api_base=openai_keys.get("OPENAI_BASE_URL") or config.get("OPENAI_BASE_URL") or None,
+            model_name=openai_keys.get("MODEL_NAME"),
+            temperature=openai_keys.get("TEMPERATURE"),
+            http_async_client=http_client,
+            # Retries are done by the gateway, with the rate limiters in the loop
+            max_retries=0,
+            # Streamed answers end with a chunk carrying the token usage, reconciled with the token bucket
+            stream_usage=True,
+        )
+
+    def start(self, model=None):
+        self._http_client = httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=self.config.max_connections,
+                                max_keepalive_connections=self.config.max_connections),
+            timeout=httpx.Timeout(self.config.timeout_seconds))
+        self.model = model or self.__create_model__(self._http_client)
+        self.model_key = f"{getattr(self.model, 'model_name', '')}|{getattr(self.model, 'temperature', '')}"
+        self._semaphore = asyncio.Semaphore(self.config.max_concurrency)
+        processes = max(1, int(os.environ.get("WEB_CONCURRENCY", 1)))
+        self._requests = TokenBucket(self.config.requests_per_minute / processes)
+        self._tokens = TokenBucket(self.config.tokens_per_minute / processes)
+        logger.info(f"LLM gateway started, concurrency={self.config.max_concurrency}, "
+                    f"rpm={self.config.requests_per_minute}, tpm={self.config.tokens_per_minute}, "
+                    f"shared by {processes} processes")
+        return self
+
+    async def aclose(self):
+        if self._http_client is not None:
+            await self._http_client.aclose()
+            self._http_client = None
+        self.model = None
+
+    def request_semaphore(self):
+        """
+            Bounds the concurrent LLM calls of one request, created per request.
+        """
+        return asyncio.Semaphore(self.config.per_request_concurrency)
+
+    def __estimate_tokens__(self, prompt):
+        # About 4 characters per token, corrected with the reported usage once the call returns
+        return len(prompt) // 4 + self.config.expected_completion_tokens
+
+    async def __pace__(self, estimated_tokens):
+        await self._requests.acquire(1)
+        await self._tokens.acquire(estimated_tokens)
+
+    def __backoff__(self, attempt, error):
+        retry_after = None
+        if isinstance(error, openai.APIStatusError):
+            retry_after = error.response.headers.get("retry-after")
+        try:
+            if retry_after is not None:
+                return min(float(retry_after), self.config.backoff_max_seconds)
+        except ValueError:
+            pass
+        # Full jitter, concurrent callers that failed together retry spread out
+        return random.uniform(0, min(self.config.backoff_max_seconds,
+                                     self.config.backoff_base_seconds * 2 ** attempt))
+
+    async def __call_with_retries__(self, call, estimated_tokens):
+        for attempt in range(self.config.max_retries + 1):
+            await self.__pace__(estimated_tokens)
+            try:
+                async with self._semaphore:
+                    return await call()
+            except RETRYABLE_ERRORS as e:
+                if attempt == self.config.max_retries:
+                    raise
+                LLM_RETRIES.labels(reason=type(e).__name__).inc()
+                wait = self.__backoff__(attempt, e)
+                logger.info(f"LLM call failed with {type(e).__name__}, retry {attempt + 1} in {wait:.2f}s")
+                await asyncio.sleep(wait)
+
+    async def __invoke__(self, prompt):
+        estimated_tokens = self.__estimate_tokens__(prompt)
+        response = await self.__call_with_retries__(lambda: self.model.ainvoke(prompt), estimated_tokens)
+        record_llm_usage(response)
+        if usage := getattr(response, "usage_metadata", None):
+            self._tokens.reconcile(usage.get("total_tokens", estimated_tokens) - estimated_tokens)
+        return response
+
+    def __forget__(self, key, future):
+        self._in_flight.pop(key, None)
+        # Retrieved here too, the callers waiting on it may all have gone away
+        if not future.cancelled():
+            future.exception()
+
+    def __ensure_started__(self):
+        # Scripts and tests that do not run the application lifespan
+        if self.model is None:
+            self.start()
+
+    async def ainvoke(self, prompt, request_semaphore: asyncio.Semaphore = None):
+        self.__ensure_started__()
+        async with request_semaphore or nullcontext():
+            key = hashlib.sha256(f"{self.model_key}|{prompt}".encode()).hexdigest()
+            if (in_flight := self._in_flight.get(key)) is not None:
+                LLM_COALESCED.inc()
+            else:
+                in_flight = asyncio.ensure_future(self.__invoke__(prompt))
+                self._in_flight[key] = in_flight
+                in_flight.add_done_callback(lambda future: self.__forget__(key, future))
+            # A caller that goes away does not cancel the call the others are waiting on
+            return await asyncio.shield(in_flight)
+
+    async def astream(self, prompt, request_semaphore: asyncio.Semaphore = None):
+        """
+            Streams the answer chunks, a failed call is only retried until its first chunk arrived. The tokens paced
+            for each attempt are reconciled with its reported usage, or with an estimate of what was streamed.
+        """
+        self.__ensure_started__()
+        async with request_semaphore or nullcontext():
+            estimated_tokens = self.__estimate_tokens__(prompt)
+            for attempt in range(self.config.max_retries + 1):
+                await self.__pace__(estimated_tokens)
+                streamed, used_tokens, streamed_characters = False, 0, 0
+                try:
+                    async with self._semaphore:
+                        async for chunk in self.model.astream(prompt):
+                            streamed = True
+                            record_llm_usage(chunk)
+                            if usage := getattr(chunk, "usage_metadata", None):
+                                used_tokens += usage.get("total_tokens", 0)
+                            streamed_characters += len(chunk.content or "")
+                            yield chunk
+                    return
+                except RETRYABLE_ERRORS as e:
+                    if streamed or attempt == self.config.max_retries:
+                        raise
+                    LLM_RETRIES.labels(reason=type(e).__name__).inc()
+                    await asyncio.sleep(self.__backoff__(attempt, e))
+                finally:
+                    if not used_tokens and streamed:
+                        used_tokens = (len(prompt) + streamed_characters) // 4
+                    self._tokens.reconcile(used_tokens - estimated_tokens)
+
+
+llm_gateway = LLMGateway(LLMGatewayConfig(**(config.get("LLM_GATEWAY") or {})))
@@ -0,0 +1,453 @@
+import json
+import os
+import threading
+import uuid
+from contextlib import contextmanager
+from typing import Optional
+
+import numpy as np
+from fastapi.logger import logger
+from langchain_core.documents.base import Document
+
+from src.agent.file_lock import file_lock
+
+
+def __atomic_save__(path, array):
+    with open(f"{path}.tmp", "wb") as f:
+        np.save(f, array)
+    os.replace(f"{path}.tmp", path)
+
+
+def normalize_rows(vectors):
+    vectors = np.array(vectors, dtype=np.float32, ndmin=2)
+    vectors /= np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+    return vectors
+
+
+class IndexSegment:
+    """
+        Immutable block of rows: a memory-mapped float32 matrix of normalized vectors, the row ids, and a JSON lines
+        file with the text and metadata of each row addressed through byte offsets.
+        The records file is read through a descriptor opened with the segment, so a segment that a compaction removed
+        stays readable until the last snapshot using it is gone.
+    """
+
+    def __init__(self, index_path, name):
+        self.name = name
+        self.vectors = np.load(os.path.join(index_path, f"{name}.npy"), mmap_mode="r")
+        self.ids = np.load(os.path.join(index_path, f"{name}.ids.npy"))
+        self.offsets = np.load(os.path.join(index_path, f"{name}.offsets.npy"))
+        self.records_path = os.path.join(index_path, f"{name}.jsonl")
+        self._records_fd = os.open(self.records_path, os.O_RDONLY)
+        self._records_size = os.fstat(self._records_fd).st_size
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __del__(self):
+        if getattr(self, "_records_fd", None) is not None:
+            os.close(self._records_fd)
+            self._records_fd = None
+
+    def read_record(self, row):
+        start = int(self.offsets[row])
+        end = int(self.offsets[row + 1]) if row + 1 < len(self.offsets) else self._records_size
+        return json.loads(os.pread(self._records_fd, end - start, start))
+
+    def read_records(self):
+        return [json.loads(line) for line in os.pread(self._records_fd, self._records_size, 0).splitlines()]
+
+    @staticmethod
+    def files(name):
+        return [f"{name}{suffix}" for suffix in (".npy", ".ids.npy", ".offsets.npy", ".jsonl")]
+
+    @staticmethod
+    def write(index_path, name, ids, texts, metadatas, vectors):
+        offsets = []
+        records_path = os.path.join(index_path, f"{name}.jsonl")
+        with open(f"{records_path}.tmp", "wb") as f:
+            for text, metadata in zip(texts, metadatas):
+                offsets.append(f.tell())
+                f.write(json.dumps(dict(text=text, metadata=metadata), default=str).encode() + b"\n")
+        os.replace(f"{records_path}.tmp", records_path)
+        __atomic_save__(os.path.join(index_path, f"{name}.offsets.npy"), np.asarray(offsets, dtype=np.int64))
+        __atomic_save__(os.path.join(index_path, f"{name}.ids.npy"), np.asarray(ids, dtype="U36"))
+        __atomic_save__(os.path.join(index_path, f"{name}.npy"), vectors)
+
+
+class IndexSnapshot:
+    """
+        One state of the collection: its segments, the live rows of each and the IVF index over them. Readers take
+        the current snapshot once per search, writers publish a new one, a snapshot is never modified.
+    """
+
+    def __init__(self, segments=(), alive=(), tombstones=frozenset(), ivf=None, stamp=None):
+        self.segments = tuple(segments)
+        self.alive = tuple(alive)
+        self.tombstones = frozenset(tombstones)
+        self.ivf = ivf
+        # (mtime, inode) of the index.json it was read from or written to
+        self.stamp = stamp
+
+    def rows(self):
+        return sum(len(segment) for segment in self.segments)
+
+    def count(self):
+        return sum(int(alive.sum()) for alive in self.alive)
+
+
+class IVFIndex:
+    """
+        Inverted file index over the first `rows` rows of the collection: k-means centroids and, per list, the global
+        row numbers assigned to it. A search only scores the rows of the n_probe closest lists.
+        Each build is saved under a new file name, recorded in index.json.
+    """
+
+    def __init__(self, centroids, lists, rows, name=None):
+        self.centroids = centroids
+        self.lists = lists
+        self.rows = rows
+        self.name = name
+
+    @classmethod
+    def build(cls, segments, n_lists, iterations=10, sample_size=100000, seed=42):
+        rng = np.random.default_rng(seed)
+        rows = sum(len(segment) for segment in segments)
+        sample_rows = np.sort(rng.choice(rows, size=min(sample_size, rows), replace=False))
+        sample = np.concatenate([segment.vectors[rows_in_segment] for segment, rows_in_segment
+                                 in zip(segments, split_rows(segments, sample_rows)) if len(rows_in_segment)])
+        centroids = sample[rng.choice(len(sample), size=n_lists, replace=False)].copy()
+        for _ in range(iterations):
+            assignments = np.argmax(sample @ centroids.T, axis=1)
+            for k in range(n_lists):
+                if len(members := np.flatnonzero(assignments == k)):
+                    centroid = sample[members].mean(axis=0)
+                    centroids[k] = centroid / (np.linalg.norm(centroid) or 1.0)
+
+        # Assignment is done segment by segment, the vectors stay memory-mapped
+        assignments = np.concatenate([np.argmax(segment.vectors @ centroids.T, axis=1) for segment in segments])
+        order = np.argsort(assignments, kind="stable")
+        boundaries = np.searchsorted(assignments[order], np.arange(n_lists + 1))
+        return cls(centroids, [order[boundaries[k]:boundaries[k + 1]] for k in range(n_lists)], rows)
+
+    def candidates(self, query_vector, n_probe):
+        probes = np.argsort(-(self.centroids @ query_vector))[:n_probe]
+        return np.sort(np.concatenate([self.lists[k] for k in probes]))
+
+    def save(self, path):
+        with open(f"{path}.tmp", "wb") as f:
+            np.savez(f, centroids=self.centroids, rows=np.asarray(self.rows),
+                     lengths=np.asarray([len(rows) for rows in self.lists]), members=np.concatenate(self.lists))
+        os.replace(f"{path}.tmp", path)
+
+    @classmethod
+    def load(cls, path):
+        data = np.load(path)
+        return cls(data["centroids"], np.split(data["members"], np.cumsum(data["lengths"])[:-1]), int(data["rows"]),
+                   os.path.basename(path))
+
+
+def split_rows(segments, global_rows):
+    """
+        Splits sorted global row numbers into the local row numbers of each segment.
+    """
+    boundaries = np.cumsum([0] + [len(segment) for segment in segments])
+    positions = np.searchsorted(global_rows, boundaries)
+    return [global_rows[positions[k]:positions[k + 1]] - boundaries[k] for k in range(len(segments))]
+
+
+class LocalVectorIndex:
+    """
+        In-process vector index persisted under one folder per collection and loaded lazily.
+        Rows are appended in memory-mapped segments and deletions are tombstones. Exact top-k is a matrix product with
+        argpartition per segment, an IVF index is built once the collection reaches ivf_threshold rows.
+        Trailing segments smaller than merge_segment_rows are merged into one once merge_factor of them, or
+        merge_segment_rows rows, have accumulated.
+        Every gunicorn worker holds its own instance: writes take an exclusive file lock and start from the state on
+        disk, readers reload index.json when its modification time changes.
+    """
+
+    def __init__(self, index_path, ivf_threshold=200000, n_probe=8, merge_segment_rows=16384, merge_factor=8):
+        self.index_path = index_path
+        self.ivf_threshold = ivf_threshold
+        self.n_probe = n_probe
+        self.merge_segment_rows = merge_segment_rows
+        self.merge_factor = merge_factor
+        self._lock = threading.RLock()
+        self._snapshot: Optional[IndexSnapshot] = None
+
+    @property
+    def state_path(self):
+        return os.path.join(self.index_path, "index.json")
+
+    @property
+    def lock_path(self):
+        return os.path.join(self.index_path, ".lock")
+
+    def exists(self):
+        return os.path.exists(self.state_path)
+
+    def is_loaded(self):
+        return self._snapshot is not None
+
+    def __state_stamp__(self):
+        try:
+            stat = os.stat(self.state_path)
+        except FileNotFoundError:
+            return None
+        return stat.st_mtime_ns, stat.st_ino
+
+    def __read_state__(self, previous: Optional[IndexSnapshot]) -> IndexSnapshot:
+        """
+            Snapshot of the state on disk, reusing the segments and the IVF index of `previous` it still contains.
+            Called under the file lock, so the state and its files are consistent.
+        """
+        stamp = self.__state_stamp__()
+        if stamp is None:
+            return IndexSnapshot()
+        if previous is not None and previous.stamp == stamp:
+            return previous
+        with open(self.state_path) as f:
+            state = json.load(f)
+        loaded = {segment.name: segment for segment in previous.segments} if previous else {}
+        segments = [loaded.get(name) or IndexSegment(self.index_path, name) for name in state["segments"]]
+        tombstones = frozenset(state.get("tombstones", []))
+        alive = [~np.isin(segment.ids, list(tombstones)) for segment in segments]
+
+        # Indexes saved before IVF files were versioned record `true`
+        ivf_name = "ivf.npz" if state.get("ivf") is True else state.get("ivf")
+        ivf = previous.ivf if previous and previous.ivf and previous.ivf.name == ivf_name else None
+        if ivf_name and ivf is None:
+            ivf = IVFIndex.load(os.path.join(self.index_path, ivf_name))
+        return IndexSnapshot(segments, alive, tombstones, ivf, stamp)
+
+    def __load__(self) -> IndexSnapshot:
+        """
+            Current snapshot, reloaded when another process changed index.json since it was read.
+        """
+        snapshot = self._snapshot
+        if snapshot is not None and snapshot.stamp == self.__state_stamp__():
+            return snapshot
+        with self._lock:
+            if self._snapshot is None or self._snapshot.stamp != self.__state_stamp__():
+                loaded = self._snapshot is None
+                if not self.exists():
+                    self._snapshot = IndexSnapshot()
+                    return self._snapshot
+                with file_lock(self.lock_path, shared=True):
+                    self._snapshot = self.__read_state__(self._snapshot)
+                if loaded:
+                    logger.info(f"Loaded local vector index {self.index_path} with {self._snapshot.count()} rows")
+        return self._snapshot
+
+    @contextmanager
+    def __writing__(self):
+        """
+            Exclusive access to the index across threads and processes, yields the state on disk.
+        """
+        with self._lock, file_lock(self.lock_path):
+            self._snapshot = self.__read_state__(self._snapshot)
+            yield self._snapshot
+
+    def __publish__(self, snapshot: IndexSnapshot, stale_segments=(), stale_ivf=None):
+        """
+            Persists and swaps in the new snapshot, under __writing__. The files of the segments and of the IVF index
+            it no longer uses are removed, searches holding the previous snapshot keep reading them through their open
+            descriptors, and other processes reload the state under the file lock.
+        """
+        os.makedirs(self.index_path, exist_ok=True)
+        with open(f"{self.state_path}.tmp", "w") as f:
+            json.dump(dict(segments=[segment.name for segment in snapshot.segments],
+                           tombstones=sorted(snapshot.tombstones), ivf=snapshot.ivf.name if snapshot.ivf else None), f)
+        os.replace(f"{self.state_path}.tmp", self.state_path)
+        snapshot.stamp = self.__state_stamp__()
+        self._snapshot = snapshot
+        for segment in stale_segments:
+            for file_name in IndexSegment.files(segment.name):
+                os.remove(os.path.join(self.index_path, file_name))
+        if stale_ivf is not None and stale_ivf is not snapshot.ivf:
+            os.remove(os.path.join(self.index_path, stale_ivf.name))
+
+    def count(self):
+        return self.__load__().count()
+
+    def add(self, docs, vectors, ids=None):
+        ids = ids or [str(uuid.uuid4()) for _ in docs]
+        os.makedirs(self.index_path, exist_ok=True)
+        # The segment files have a new name, they are written before taking the lock
+        name = f"segment_{uuid.uuid4().hex[:12]}"
+        IndexSegment.write(self.index_path, name, ids, [doc.page_content for doc in docs],
+                           [doc.metadata for doc in docs], normalize_rows(vectors))
+        segment = IndexSegment(self.index_path, name)
+        with self.__writing__() as snapshot:
+            segments = list(snapshot.segments) + [segment]
+            alive = list(snapshot.alive) + [np.ones(len(segment), dtype=bool)]
+            segments, alive, stale = self.__merge_tail__(segments, alive, snapshot.ivf)
+            ivf = self.__maybe_build_ivf__(segments, snapshot.ivf)
+            self.__publish__(IndexSnapshot(segments, alive, snapshot.tombstones, ivf), stale, snapshot.ivf)
+        return ids
+
+    def __merge_tail__(self, segments, alive, ivf):
+        """
+            Merges the trailing segments smaller than merge_segment_rows into one once there are merge_factor of them
+            or they hold merge_segment_rows rows, dropping their deleted rows. Segments covered by the IVF index keep
+            their rows in place.
+        """
+        first = len(segments)
+        rows = sum(len(segment) for segment in segments)
+        tail_rows = 0
+        while first > 0 and len(segments[first - 1]) < self.merge_segment_rows:
+            rows -= len(segments[first - 1])
+            if ivf is not None and rows < ivf.rows:
+                break
+            first -= 1
+            tail_rows += len(segments[first])
+        run = len(segments) - first
+        if run < 2 or (run < self.merge_factor and tail_rows < self.merge_segment_rows):
+            return segments, alive, []
+        stale = segments[first:]
+        if not any(mask.any() for mask in alive[first:]):
+            return segments[:first], alive[:first], stale
+        merged = self.__rewrite__(stale, alive[first:])
+        logger.info(f"Merged {run} segments of {self.index_path} into {merged.name} with {len(merged)} rows")
+        return segments[:first] + [merged], alive[:first] + [np.ones(len(merged), dtype=bool)], stale
+
+    def delete(self, ids):
+        ids = set(ids)
+        with self.__writing__() as snapshot:
+            alive = [mask & ~np.isin(segment.ids, list(ids)) for segment, mask in zip(snapshot.segments,
+                                                                                         snapshot.alive)]
+            self.__publish__(IndexSnapshot(snapshot.segments, alive, snapshot.tombstones | ids, snapshot.ivf))
+
+    def iter_rows(self):
+        """
+            Yields the id and the record (text and metadata) of every live row, reading each segment sequentially.
+        """
+        snapshot = self.__load__()
+        for segment, alive in zip(snapshot.segments, snapshot.alive):
+            for row, record in enumerate(segment.read_records()):
+                if alive[row]:
+                    yield str(segment.ids[row]), record
+
+    def compact(self):
+        """
+            Rewrites the segments that contain deleted rows without them and clears the tombstones, returns the
+            number of rows removed and segments rewritten.
+        """
+        with self.__writing__() as snapshot:
+            segments, alive, stale, removed, rewritten = [], [], [], 0, 0
+            for segment, mask in zip(snapshot.segments, snapshot.alive):
+                if mask.all():
+                    segments.append(segment)
+                    alive.append(mask)
+                    continue
+                stale.append(segment)
+                removed += int((~mask).sum())
+                if not mask.any():
+                    continue
+                segments.append(self.__rewrite__([segment], [mask]))
+                alive.append(np.ones(len(segments[-1]), dtype=bool))
+                rewritten += 1
+            if not stale:
+                return dict(rows_removed=0, segments_rewritten=0)
+
+            # The IVF lists address rows by position, they are rebuilt over the compacted segments in the same snapshot
+            self.__publish__(IndexSnapshot(segments, alive, frozenset(), self.__maybe_build_ivf__(segments, None)),
+                             stale, snapshot.ivf)
+        logger.info(f"Compacted {self.index_path}, removed {removed} rows, rewrote {rewritten} segments")
+        return dict(rows_removed=removed, segments_rewritten=rewritten)
+
+    def __rewrite__(self, segments, masks):
+        """
+            Writes the live rows of `segments` into one new segment.
+        """
+        ids, texts, metadatas, vectors = [], [], [], []
+        for segment, mask in zip(segments, masks):
+            rows = np.flatnonzero(mask)
+            records = segment.read_records()
+            ids += [str(doc_id) for doc_id in segment.ids[rows]]
+            texts += [records[row]["text"] for row in rows]
+            metadatas += [records[row]["metadata"] for row in rows]
+            vectors.append(np.asarray(segment.vectors[rows]))
+        name = f"segment_{uuid.uuid4().hex[:12]}"
+        IndexSegment.write(self.index_path, name, ids, texts, metadatas, np.concatenate(vectors))
+        return IndexSegment(self.index_path, name)
+
+    def __maybe_build_ivf__(self, segments, ivf):
+        rows = sum(len(segment) for segment in segments)
+        if rows < self.ivf_threshold or (ivf and rows < 1.2 * ivf.rows):
+            return ivf
+        logger.info(f"Building IVF index over {rows} rows of {self.index_path}")
+        ivf = IVFIndex.build(segments, n_lists=int(np.sqrt(rows)))
+        ivf.name = f"ivf_{uuid.uuid4().hex[:12]}.npz"
+        ivf.save(os.path.join(self.index_path, ivf.name))
+        return ivf
+
+    @staticmethod
+    def __top_k__(scores, limit):
+        k = min(limit, len(scores))
+        top = np.argpartition(-scores, k - 1)[:k]
+        return top[np.argsort(-scores[top])]
+
+    def __search_segment__(self, segment, alive, query_vectors, limit, rows=None):
+        vectors = segment.vectors if rows is None else segment.vectors[rows]
+        alive = alive if rows is None else alive[rows]
+        scores = np.where(alive, query_vectors @ vectors.T, -np.inf)
+        tops = [self.__top_k__(query_scores, limit) for query_scores in scores]
+        return [(query_scores[top], top if rows is None else rows[top]) for query_scores, top in zip(scores, tops)]
+
+    def search_many(self, embedded_queries, limit):
+        """
+            Top-k of several queries at once, returns per query a list of (Document, cosine distance).
+        """
+        # Segments, live rows and IVF lists of one snapshot, a concurrent write publishes a new one
+        snapshot = self.__load__()
+        segments = snapshot.segments
+        if not segments or limit <= 0:
+            return [[] for _ in embedded_queries]
+        query_vectors = normalize_rows(embedded_queries)
+
+        # (score, segment number, local row) candidates per query
+        candidates = [[] for _ in query_vectors]
+        if snapshot.ivf is None:
+            for segment_number, (segment, alive) in enumerate(zip(segments, snapshot.alive)):
+                for k, (scores, rows) in enumerate(self.__search_segment__(segment, alive, query_vectors, limit)):
+                    candidates[k].extend((float(score), segment_number, int(row)) for score, row in zip(scores, rows))
+        else:
+            total_rows = snapshot.rows()
+            for k, query_vector in enumerate(query_vectors):
+                global_rows = np.concatenate([snapshot.ivf.candidates(query_vector, self.n_probe),
+                                              np.arange(snapshot.ivf.rows, total_rows)])
+                for segment_number, rows in enumerate(split_rows(segments, global_rows)):
+                    if len(rows):
+                        scores, rows = self.__search_segment__(segments[segment_number], snapshot.alive[segment_number],
+                                                               query_vector[None, :], limit, rows)[0]
+                        candidates[k].extend((float(score), segment_number, int(row))
+                                             for score, row in zip(scores, rows))
+
+        results = []
+        for query_candidates in candidates:
+            best = sorted((candidate for candidate in query_candidates if candidate[0] != -np.inf), reverse=True)
+            results.append([(self.__read_document__(segments[segment_number], row), 1.0 - score)
+                            for score, segment_number, row in best[:limit]])
+        return results
+
+    @staticmethod
+    def __read_document__(segment, row):
+        record = segment.read_record(row)
+        return Document(page_content=record["text"], metadata=dict(record["metadata"], id=str(segment.ids[row])))
+
+    def search(self, embedded_query, limit):
+        return self.search_many([embedded_query], limit)[0]
+
+    def unload(self):
+        with self._lock:
+            self._snapshot = None
+
+    def drop(self):
+        with self._lock:
+            if os.path.exists(self.index_path):
+                for file_name in os.listdir(self.index_path):
+                    os.remove(os.path.join(self.index_path, file_name))
+                os.rmdir(self.index_path)
+            self._snapshot = IndexSnapshot()
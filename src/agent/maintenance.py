@@ -0,0 +1,238 @@
+"""
+    Reports the orphaned and duplicated chunks of a collection, removes them with --fix, and compacts its indexes:
+
+    python -m src.agent.maintenance --project-id acme --fix
+"""
+import argparse
+import asyncio
+import hashlib
+import os
+import re
+import time
+from contextlib import ExitStack
+
+from fastapi.logger import logger
+
+from src.agent.collection_aliases import collection_aliases
+from src.agent.embedding_generation import GenerateEmbedding
+from src.agent.executors import executors
+from src.agent.file_lock import FileLockBusy
+from src.agent.ingestion_manifest import IngestionManifest
+from src.agent.keyword_index import keyword_indexes
+from src.agent.reindex import Reindexer, drop_collection
+from src.agent.retrieval_cache import retrieval_cache
+from src.agent.tenants import tenants
+from src.agent.utils import AgentException, get_upload_location
+from src.agent.vector_db_client import backfill_keyword_index, delete_documents_by_filter, delete_documents_by_ids, \
+    vector_backend
+from src.config.config_client import config
+from src.schemas.pydantic_models import DocumentPurgeResult, ReindexConfig, Tenant
+from src.startup_constants import DOCUMENT_NOT_FOUND
+
+
+def list_collection_versions(index_name):
+    """
+        Collections of the vector store, the keyword indexes and the manifests that belong to `index_name`: the
+        collection itself and its re-indexed versions `<index_name>_v<N>`.
+    """
+    pattern = re.compile(rf"^{re.escape(index_name.lower())}(_v\d+)?$")
+    names = set(vector_backend.list_collections())
+    if os.path.isdir(keyword_indexes.index_path):
+        names |= {file_name[:-len(".jsonl")] for file_name in os.listdir(keyword_indexes.index_path)
+                  if file_name.endswith(".jsonl")}
+    if os.path.isdir(IngestionManifest.vector_db_path):
+        names |= {file_name[:-len("_manifest.json")] for file_name in os.listdir(IngestionManifest.vector_db_path)
+                  if file_name.endswith("_manifest.json")}
+    return sorted(name for name in names if pattern.match(name))
+
+
+class CollectionMaintenance:
+    """
+        Checks the live collection of a tenant against its ingestion manifest and keyword index:
+
+        * orphan rows, chunks of the vector store that no manifest entry owns (an ingestion interrupted before its
+          manifest was saved), keyword rows without a vector and vectors without a keyword row,
+        * duplicate rows, chunks of the same source with the same normalized text,
+        * stale files, manifest entries whose upload is gone, and incomplete files, whose chunks are missing,
+        * orphan collections, versions left behind by a re-index.
+
+        With `fix` they are deleted (incomplete files are re-embedded by their next ingestion), then the indexes are
+        compacted. Ingestion of the collection is paused while it runs, in every worker process, and chunks written
+        after the scan started are left alone. Orphan collections are only looked for when no re-index of the
+        collection runs and its last switch is older than REINDEX.gc_delay_seconds, re-indexes wait until the repair
+        is done.
+    """
+
+    gc_delay_seconds = ReindexConfig(**(config.get("REINDEX") or {})).gc_delay_seconds
+
+    def __init__(self, tenant: Tenant, fix=False):
+        self.tenant = tenant
+        self.fix = fix
+        self.collection_name = collection_aliases.resolve(tenant.index_name)
+
+    def __resolve__(self):
+        self.collection_name = collection_aliases.resolve(self.tenant.index_name)
+        return self.collection_name
+
+    def scan(self, manifest: IngestionManifest, with_collections=True):
+        scan_start = time.time()
+        owners = manifest.chunk_ids()
+        rows, orphan_rows, duplicate_rows, seen = set(), [], [], {}
+        if vector_backend.exists(self.collection_name):
+            for doc_id, properties in vector_backend.iter_rows(self.collection_name):
+                rows.add(doc_id)
+                # Written by an ingestion that has not recorded its manifest entry yet
+                if float(properties.get("ingested_at") or 0) >= scan_start:
+                    continue
+                if doc_id not in owners:
+                    orphan_rows.append(doc_id)
+                    continue
+                text = " ".join(str(properties.get("text", "")).lower().split())
+                key = (properties.get("source"), hashlib.sha1(text.encode()).digest())
+                if key in seen:
+                    duplicate_rows.append(doc_id)
+                else:
+                    seen[key] = doc_id
+
+        keyword_ids = keyword_indexes.get(self.collection_name).ids()
+        stale_files = sorted(file_hash for file_hash, entry in manifest.entries.items()
+                             if not os.path.exists(entry["source"]))
+        incomplete_files = sorted(file_hash for file_hash, entry in manifest.entries.items()
+                                  if file_hash not in stale_files and not set(entry["chunk_ids"]) <= rows)
+        orphan_collections = []
+        swapped_at = collection_aliases.swapped_at(self.tenant.index_name) or 0
+        if with_collections and time.time() - swapped_at >= self.gc_delay_seconds:
+            orphan_collections = [name for name in list_collection_versions(self.tenant.index_name)
+                                  if name != self.collection_name.lower() and not tenants.is_in_use(name)]
+        return dict(rows=len(rows), orphan_rows=orphan_rows, duplicate_rows=duplicate_rows,
+                    keyword_orphan_rows=sorted(keyword_ids - rows), keyword_missing_rows=sorted(rows - keyword_ids),
+                    stale_files=stale_files,
+                    incomplete_files=incomplete_files, orphan_collections=orphan_collections)
+
+    def repair(self, manifest: IngestionManifest, findings):
+        if findings["keyword_missing_rows"]:
+            backfill_keyword_index(self.collection_name)
+        deleted_rows = findings["orphan_rows"] + findings["duplicate_rows"]
+        # Duplicates owned by the manifest are removed from their entries
+        duplicates = set(findings["duplicate_rows"])
+        for entry in manifest.entries.values():
+            if duplicates & set(entry["chunk_ids"]):
+                entry["chunk_ids"] = [chunk_id for chunk_id in entry["chunk_ids"] if chunk_id not in duplicates]
+                entry["shared_chunk_ids"] = [chunk_id for chunk_id in entry.get("shared_chunk_ids", [])
+                                             if chunk_id not in duplicates]
+        for file_hash in findings["stale_files"] + findings["incomplete_files"]:
+            # Chunks shared with other files stay
+            deleted_rows += manifest.release_chunks(manifest.get(file_hash)["chunk_ids"])
+            manifest.remove(file_hash)
+        manifest.forget_chunks(deleted_rows)
+        if deleted_rows:
+            delete_documents_by_ids(deleted_rows, self.collection_name)
+        keyword_indexes.get(self.collection_name).delete(findings["keyword_orphan_rows"])
+        manifest.save()
+        for collection_name in findings["orphan_collections"]:
+            drop_collection(collection_name)
+        if deleted_rows or findings["stale_files"] or findings["incomplete_files"]:
+            retrieval_cache.bump_collection_version(self.collection_name)
+        return len(deleted_rows)
+
+    def compact(self):
+        vector = vector_backend.compact(self.collection_name) if vector_backend.exists(self.collection_name) else None
+        return dict(vector=vector, keyword_records_removed=keyword_indexes.get(self.collection_name).compact())
+
+    def run(self):
+        """
+            Returns the report: counts of what was found, what was deleted and the time of each step.
+        """
+        seconds = {}
+        # The collection is resolved under the lock, a re-index may switch it while this waits
+        with GenerateEmbedding.collection_lock(self.tenant.index_name), \
+                tenants.in_use(self.__resolve__()), ExitStack() as stack:
+            # The versions of a running re-index are not orphans, one starting now waits for the repair
+            try:
+                stack.enter_context(Reindexer.lock(self.tenant))
+                reindex_idle = True
+            except FileLockBusy:
+                reindex_idle = False
+            manifest = IngestionManifest(self.collection_name)
+            start_time = time.perf_counter()
+            findings = self.scan(manifest, with_collections=reindex_idle)
+            seconds["scan"] = round(time.perf_counter() - start_time, 3)
+
+            deleted_rows = 0
+            if self.fix:
+                start_time = time.perf_counter()
+                deleted_rows = self.repair(manifest, findings)
+                seconds["repair"] = round(time.perf_counter() - start_time, 3)
+
+            start_time = time.perf_counter()
+            compaction = self.compact()
+            seconds["compact"] = round(time.perf_counter() - start_time, 3)
+
+        report = dict(collection=self.collection_name, fixed=self.fix,
+                      rows=vector_backend.count(self.collection_name) if findings["rows"] else 0,
+                      manifest_rows=len(manifest.chunk_ids()),
+                      keyword_rows=keyword_indexes.get(self.collection_name).count(),
+                      **{key: len(value) for key, value in findings.items() if key != "rows"},
+                      orphan_collection_names=findings["orphan_collections"], deleted_rows=deleted_rows,
+                      compaction=compaction, seconds=seconds)
+        logger.info(f"Maintenance of {self.collection_name}: {report}")
+        return report
+
+
+def purge_document(tenant: Tenant, file_name):
+    """
+        Deletes the chunks of an uploaded document, its manifest entries and the upload itself.
+    """
+    if not file_name or os.path.basename(file_name) != file_name:
+        raise AgentException(code=400, message=f"Invalid file name {file_name}", display_message=DOCUMENT_NOT_FOUND)
+    file_location = get_upload_location(file_name, tenant.upload_dir)
+    # The collection is resolved under the lock, a re-index may switch it while this waits
+    with GenerateEmbedding.collection_lock(tenant.index_name), \
+            tenants.in_use(collection_name := collection_aliases.resolve(tenant.index_name)):
+        manifest = IngestionManifest(collection_name)
+        entries = {file_hash: entry for file_hash, entry in manifest.entries.items()
+                   if os.path.normpath(entry["source"]) == os.path.normpath(file_location)}
+        # The chunks the document wrote that other files still reference are kept, the delete filter only lists
+        # those. The chunks it shared with other files are written under their source, they are deleted by id once
+        # no file references them.
+        kept_ids, chunk_ids = set(), []
+        for file_hash, entry in entries.items():
+            own_ids = set(entry["chunk_ids"]) - set(entry.get("shared_chunk_ids", []))
+            kept_ids |= own_ids - set(manifest.release_chunks(own_ids))
+            chunk_ids += manifest.release_chunks(entry.get("shared_chunk_ids", []))
+            manifest.remove(file_hash)
+        if chunk_ids:
+            delete_documents_by_ids(chunk_ids, collection_name)
+        # Chunks are deleted by source, including the ones of an interrupted ingestion the manifest does not own
+        for source in {file_location} | {entry["source"] for entry in entries.values()}:
+            chunk_ids += delete_documents_by_filter(collection_name, keep_ids=kept_ids, source=source)
+        if entries:
+            manifest.save()
+        file_deleted = os.path.exists(file_location)
+        if file_deleted:
+            os.remove(file_location)
+    if not (chunk_ids or entries or file_deleted):
+        raise AgentException(code=404, message=f"Document {file_name} not found in {collection_name}",
+                             display_message=DOCUMENT_NOT_FOUND)
+    retrieval_cache.bump_collection_version(collection_name)
+    return DocumentPurgeResult(file_name=file_name, chunks_deleted=len(set(chunk_ids)), file_deleted=file_deleted)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Report and remove the orphaned and duplicated chunks of a "
+                                                 "collection, then compact it")
+    parser.add_argument("--project-id", default=None, help="Project to check, the shared collection when omitted")
+    parser.add_argument("--fix", action="store_true", help="Delete what is found, the default only reports it")
+    args = parser.parse_args()
+
+    executors.start()
+    vector_backend.start()
+    try:
+        print(CollectionMaintenance(tenants.resolve(args.project_id), fix=args.fix).run())
+    finally:
+        asyncio.run(vector_backend.aclose())
+        executors.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,125 @@
+import os
+import time
+from contextlib import contextmanager, nullcontext
+from contextvars import ContextVar
+
+from fastapi.logger import logger
+from prometheus_client import CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Gauge, Histogram, REGISTRY, \
+    generate_latest
+from prometheus_client import multiprocess
+
+from src.config.config_client import config
+from src.schemas.pydantic_models import TracingConfig
+
+STAGE_DURATION = Histogram("agent_stage_duration_seconds", "Duration of each processing stage", ["stage"],
+                           buckets=(.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60, 300))
+STAGE_ERRORS = Counter("agent_errors_total", "Errors raised per processing stage", ["stage"])
+PAGES_PARSED = Counter("agent_pages_parsed_total", "PDF pages parsed")
+CHUNKS_EMBEDDED = Counter("agent_chunks_embedded_total", "Chunks embedded and written to the vector store")
+CHUNKS_DEDUPLICATED = Counter("agent_chunks_deduplicated_total", "Duplicate chunks dropped before embedding", ["kind"])
+CACHE_HITS = Counter("agent_cache_hits_total", "Cache hits", ["cache", "tier"])
+CACHE_MISSES = Counter("agent_cache_misses_total", "Cache misses", ["cache"])
+LLM_TOKENS = Counter("agent_llm_tokens_total", "Tokens used by the LLM calls", ["type"])
+LLM_RETRIES = Counter("agent_llm_retries_total", "LLM calls retried after a rate limit or server error", ["reason"])
+LLM_COALESCED = Counter("agent_llm_coalesced_total", "LLM calls answered by an identical call already in flight")
+ACTIVE_TENANTS = Gauge("agent_active_tenants", "Tenants with their indexes loaded", multiprocess_mode="livesum")
+SLACK_OUTBOX_DEPTH = Gauge("agent_slack_outbox_depth", "Requests waiting for Slack delivery", multiprocess_mode="livesum")
+EMBEDDING_QUEUE_DEPTH = Gauge("agent_embedding_queue_depth", "Query texts waiting for the next encoder batch",
+                              multiprocess_mode="livesum")
+EMBEDDING_BATCH_SIZE = Histogram("agent_embedding_batch_size", "Query texts encoded per forward pass",
+                                 buckets=(1, 2, 4, 8, 16, 32, 64, 128, 256))
+CONTEXT_TOKENS = Histogram("agent_context_tokens", "Tokens of the retrieved context sent to the LLM per question",
+                           buckets=(64, 128, 256, 512, 1024, 2048, 4096, 8192, 16384))
+
+# (start, end) of the stages of the current request by stage name, rendered in the Server-Timing header
+request_timings: ContextVar = ContextVar("request_timings", default=None)
+
+
+def __get_tracer__(tracing_config: TracingConfig):
+    if not tracing_config.enabled:
+        return None
+    try:
+        from opentelemetry import trace
+        from opentelemetry.sdk.trace import TracerProvider
+        from opentelemetry.sdk.trace.export import BatchSpanProcessor, ConsoleSpanExporter
+    except ImportError:
+        logger.error("TRACING is enabled but opentelemetry-sdk is not installed, spans are not exported")
+        return None
+
+    os.makedirs(os.path.dirname(tracing_config.exporter_path) or ".", exist_ok=True)
+    span_file = open(tracing_config.exporter_path, "a")
+    provider = TracerProvider()
+    provider.add_span_processor(BatchSpanProcessor(ConsoleSpanExporter(
+        out=span_file, formatter=lambda span: span.to_json(indent=None) + os.linesep)))
+    trace.set_tracer_provider(provider)
+    return trace.get_tracer("agent-document")
+
+
+tracer = __get_tracer__(TracingConfig(**(config.get("TRACING") or {})))
+
+
+@contextmanager
+def stage(name):
+    """
+        Times a processing stage with a monotonic clock, records it in the stage histogram, in the Server-Timing
+        header of the current request and, when tracing is enabled, in an OpenTelemetry span.
+    """
+    start_time = time.perf_counter()
+    with tracer.start_as_current_span(name) if tracer else nullcontext():
+        try:
+            yield
+        except Exception:
+            STAGE_ERRORS.labels(stage=name).inc()
+            raise
+        finally:
+            elapsed_time = time.perf_counter() - start_time
+            STAGE_DURATION.labels(stage=name).observe(elapsed_time)
+            if (timings := request_timings.get()) is not None:
+                timings.setdefault(name, []).append((start_time, start_time + elapsed_time))
+
+
+def record_error(name):
+    STAGE_ERRORS.labels(stage=name).inc()
+
+
+def record_cache_lookup(cache, hit, tier=""):
+    if hit:
+        CACHE_HITS.labels(cache=cache, tier=tier).inc()
+    else:
+        CACHE_MISSES.labels(cache=cache).inc()
+
+
+def record_llm_usage(response):
+    if usage := getattr(response, "usage_metadata", None):
+        LLM_TOKENS.labels(type="prompt").inc(usage.get("input_tokens", 0))
+        LLM_TOKENS.labels(type="completion").inc(usage.get("output_tokens", 0))
+
+
+def wall_time(intervals):
+    """
+        Seconds covered by the union of the (start, end) intervals, a stage running for several questions at once is
+        counted once.
+    """
+    covered, covered_end = 0.0, None
+    for start, end in sorted(intervals):
+        if covered_end is None or start > covered_end:
+            covered += end - start
+            covered_end = end
+        elif end > covered_end:
+            covered += end - covered_end
+            covered_end = end
+    return covered
+
+
+def format_server_timing(timings, total_time):
+    return ", ".join([f"{name};dur={wall_time(intervals) * 1000:.2f}" for name, intervals in timings.items()] +
+                     [f"total;dur={total_time * 1000:.2f}"])
+
+
+def render_metrics():
+    registry = REGISTRY
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        # Aggregates the samples written by every uvicorn worker
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    return generate_latest(registry), CONTENT_TYPE_LATEST
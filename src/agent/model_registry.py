@@ -0,0 +1,109 @@
+import threading
+import time
+
+from fastapi.logger import logger
+
+from src.config.config_client import config
+from src.schemas.pydantic_models import SBertConfig
+
+WARMUP_TEXT = "Warm up the sentence encoder before the first request."
+
+
+def load_torch_model(sbert_config: SBertConfig):
+    # sentence-transformers pulls in torch, imported on first load rather than with the application
+    from langchain_community.embeddings import SentenceTransformerEmbeddings
+
+    return SentenceTransformerEmbeddings(model_name=sbert_config.model_path)
+
+
+def load_embeddings_model(sbert_config: SBertConfig):
+    """
+        Returns the encoder of SBERT_CONFIG.backend and the backend actually loaded. The ONNX backends fall back to
+        torch when onnxruntime is missing or when their embeddings drift from the torch ones below min_parity_cosine.
+    """
+    if sbert_config.backend != "torch":
+        try:
+            from src.agent.onnx_encoder import load_onnx_encoder
+
+            encoder, parity = load_onnx_encoder(sbert_config.model_path, sbert_config.backend,
+                                                lambda: load_torch_model(sbert_config))
+            if parity["min_cosine"] >= sbert_config.min_parity_cosine:
+                logger.info(f"Sentence Embeddings Model loaded version: {sbert_config.version} "
+                            f"({sbert_config.backend})")
+                return encoder, sbert_config.backend
+            logger.error(f"The {sbert_config.backend} encoder drifts from torch, cosine {parity['min_cosine']} below "
+                         f"{sbert_config.min_parity_cosine}, falling back to torch")
+        except ImportError as e:
+            logger.error(f"SBERT_CONFIG.backend {sbert_config.backend} requires onnx and onnxruntime, falling back "
+                         f"to torch, {e}")
+    logger.info(f"Sentence Embeddings Model loaded version: {sbert_config.version}")
+    return load_torch_model(sbert_config), "torch"
+
+
+class ModelRegistry:
+    """
+        Process wide holder of the sentence encoder, loaded on first use or by `load`.
+        Under `gunicorn -c gunicorn.conf.py` the master loads it before forking, and the workers share its weights
+        copy-on-write. Every process warms it up with one encode before it reports ready.
+    """
+
+    def __init__(self, sbert_config: SBertConfig):
+        self.config = sbert_config
+        # Encoder the collections are built with, recorded with their alias by a re-index
+        self.encoder = dict(model=sbert_config.model_path, version=sbert_config.version)
+        self.model = None
+        self.version = ""
+        self.backend = None
+        self.warmed_up = False
+        self.error = None
+        self.load_seconds = None
+        self._lock = threading.Lock()
+
+    def load(self, warmup=True):
+        if self.model is None:
+            with self._lock:
+                if self.model is None:
+                    start_time = time.perf_counter()
+                    try:
+                        self.model, self.backend = load_embeddings_model(self.config)
+                    except Exception as e:
+                        self.error = str(e)
+                        raise
+                    # Cached query embeddings of one backend are not reused by another
+                    self.version = self.config.version if self.backend == "torch" \
+                        else f"{self.config.version}-{self.backend}"
+                    self.error = None
+                    self.load_seconds = round(time.perf_counter() - start_time, 3)
+        if warmup:
+            self.warmup()
+        return self.model
+
+    def warmup(self):
+        if self.warmed_up:
+            return
+        with self._lock:
+            if not self.warmed_up:
+                start_time = time.perf_counter()
+                self.model.embed_query(WARMUP_TEXT)
+                self.warmed_up = True
+                logger.info(f"Sentence encoder warmed up in {time.perf_counter() - start_time:.3f}s")
+
+    def set(self, model, version):
+        """
+            Replaces the encoder, used by the benchmarks to plug in their own embeddings.
+        """
+        with self._lock:
+            self.model, self.version, self.warmed_up, self.error = model, version, True, None
+
+    def get(self):
+        return self.model if self.model is not None else self.load()
+
+    def is_ready(self):
+        return self.model is not None and self.warmed_up
+
+    def clear(self):
+        with self._lock:
+            self.model, self.version, self.warmed_up = None, "", False
+
+
+model_registry = ModelRegistry(SBertConfig(**config.get("SBERT_CONFIG")))
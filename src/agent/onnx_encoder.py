@@ -0,0 +1,262 @@
+"""
+    Exports the sentence encoder to ONNX and measures its parity against torch, once per model. gunicorn.conf.py runs
+    it before the workers start, it can also run as a build step:
+
+    python -m src.agent.onnx_encoder
+"""
+import hashlib
+import json
+import os
+import time
+
+import numpy as np
+from fastapi.logger import logger
+
+from src.agent.file_lock import file_lock
+
+ONNX_FOLDER = "onnx"
+OPSET_VERSION = 14
+PARITY_SENTENCES = [
+    "What is the data retention policy for customer records?",
+    "Access to production systems is reviewed quarterly by the security team.",
+    "Does the company encrypt data at rest and in transit?",
+    "AC-2 account management controls apply to all privileged users.",
+    "The incident response plan is tested at least once a year, and the results are reported to management.",
+    "Vendors are assessed before onboarding and re-assessed annually based on their risk tier.",
+]
+
+
+def get_onnx_paths(model_path):
+    folder = os.path.join(model_path, ONNX_FOLDER)
+    return dict(folder=folder, onnx=os.path.join(folder, "model.onnx"), int8=os.path.join(folder, "model-int8.onnx"),
+                manifest=os.path.join(folder, "export.json"), lock=os.path.join(folder, ".export.lock"))
+
+
+def get_tmp_path(path):
+    # Per process, two processes exporting at once never write the same file
+    return f"{path}.{os.getpid()}.tmp"
+
+
+def get_model_fingerprint(model_path):
+    # Size and modification time of the weights, the export is redone when the model is replaced
+    digest = hashlib.sha256()
+    for file_name in sorted(os.listdir(model_path)):
+        if file_name.endswith((".bin", ".safetensors", ".json")):
+            stat = os.stat(os.path.join(model_path, file_name))
+            digest.update(f"{file_name}|{stat.st_size}|{stat.st_mtime_ns}".encode())
+    return digest.hexdigest()
+
+
+def read_manifest(model_path):
+    manifest_path = get_onnx_paths(model_path)["manifest"]
+    if not os.path.exists(manifest_path):
+        return {}
+    with open(manifest_path) as f:
+        return json.load(f)
+
+
+def write_manifest(model_path, manifest):
+    manifest_path = get_onnx_paths(model_path)["manifest"]
+    with open(get_tmp_path(manifest_path), "w") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(get_tmp_path(manifest_path), manifest_path)
+
+
+def export_onnx(model_path, quantize=False):
+    """
+        Exports the transformer of the sentence-transformers model at `model_path` to ONNX, and quantizes its weights
+        to int8 when `quantize` is set. The files are cached in model_path/onnx and reused while the model is
+        unchanged. Returns the path of the requested ONNX file. Called under the export lock.
+    """
+    paths = get_onnx_paths(model_path)
+    manifest = read_manifest(model_path)
+    fingerprint = get_model_fingerprint(model_path)
+    if manifest.get("fingerprint") != fingerprint:
+        manifest = dict(fingerprint=fingerprint, opset=OPSET_VERSION)
+
+    os.makedirs(paths["folder"], exist_ok=True)
+    if not os.path.exists(paths["onnx"]) or "onnx" not in manifest:
+        import torch
+        from sentence_transformers import SentenceTransformer
+
+        class TransformerOutput(torch.nn.Module):
+            def __init__(self, model):
+                super().__init__()
+                self.model = model
+
+            def forward(self, input_ids, attention_mask):
+                return self.model(input_ids=input_ids, attention_mask=attention_mask).last_hidden_state
+
+        start_time = time.perf_counter()
+        sentence_model = SentenceTransformer(model_path, device="cpu")
+        inputs = sentence_model.tokenizer(["Export the sentence encoder"], return_tensors="pt")
+        dynamic_axes = {name: {0: "batch", 1: "sequence"} for name in ("input_ids", "attention_mask",
+                                                                       "last_hidden_state")}
+        with torch.no_grad():
+            torch.onnx.export(TransformerOutput(sentence_model[0].auto_model.eval()),
+                              (inputs["input_ids"], inputs["attention_mask"]), get_tmp_path(paths["onnx"]),
+                              input_names=["input_ids", "attention_mask"], output_names=["last_hidden_state"],
+                              dynamic_axes=dynamic_axes, opset_version=OPSET_VERSION, do_constant_folding=True)
+        os.replace(get_tmp_path(paths["onnx"]), paths["onnx"])
+        manifest["onnx"] = dict(seconds=round(time.perf_counter() - start_time, 2),
+                                size_mb=round(os.path.getsize(paths["onnx"]) / 2 ** 20, 1))
+        manifest.pop("onnx-int8", None)
+        logger.info(f"Exported {model_path} to {paths['onnx']}")
+
+    if quantize and (not os.path.exists(paths["int8"]) or "onnx-int8" not in manifest):
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+
+        start_time = time.perf_counter()
+        # Dynamic quantization: int8 weights, activations quantized per batch at run time
+        quantize_dynamic(paths["onnx"], get_tmp_path(paths["int8"]), weight_type=QuantType.QInt8)
+        os.replace(get_tmp_path(paths["int8"]), paths["int8"])
+        manifest["onnx-int8"] = dict(seconds=round(time.perf_counter() - start_time, 2),
+                                     size_mb=round(os.path.getsize(paths["int8"]) / 2 ** 20, 1))
+        logger.info(f"Quantized {paths['onnx']} to {paths['int8']}")
+
+    write_manifest(model_path, manifest)
+    return paths["int8"] if quantize else paths["onnx"]
+
+
+class OnnxSentenceEncoder:
+    """
+        Sentence encoder on ONNX Runtime with the SentenceTransformerEmbeddings interface. Tokenization, pooling and
+        normalization follow the sentence-transformers configuration saved with the model.
+    """
+
+    def __init__(self, model_path, onnx_path, batch_size=32, intra_op_threads=0):
+        import onnxruntime
+        from transformers import AutoTokenizer
+
+        self.tokenizer = AutoTokenizer.from_pretrained(model_path)
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        options.intra_op_num_threads = intra_op_threads
+        self.session = onnxruntime.InferenceSession(onnx_path, options, providers=["CPUExecutionProvider"])
+        self.batch_size = batch_size
+        self.max_seq_length, self.pooling, self.normalize = self.__read_sentence_config__(model_path)
+
+    @staticmethod
+    def __read_sentence_config__(model_path):
+        def read_json(*path, default=None):
+            file_path = os.path.join(model_path, *path)
+            if not os.path.exists(file_path):
+                return default
+            with open(file_path) as f:
+                return json.load(f)
+
+        max_seq_length = read_json("sentence_bert_config.json", default={}).get("max_seq_length", 512)
+        modules = read_json("modules.json", default=[])
+        pooling_config = next((read_json(module["path"], "config.json", default={}) for module in modules
+                               if module["type"].endswith("Pooling")), {})
+        pooling = "cls" if pooling_config.get("pooling_mode_cls_token") else \
+            "max" if pooling_config.get("pooling_mode_max_tokens") else "mean"
+        normalize = any(module["type"].endswith("Normalize") for module in modules)
+        return max_seq_length, pooling, normalize
+
+    def __pool__(self, token_embeddings, attention_mask):
+        if self.pooling == "cls":
+            return token_embeddings[:, 0]
+        mask = attention_mask[..., None].astype(token_embeddings.dtype)
+        if self.pooling == "max":
+            return np.where(mask > 0, token_embeddings, -1e9).max(axis=1)
+        return (token_embeddings * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+
+    def __encode_batch__(self, texts):
+        inputs = self.tokenizer(texts, padding=True, truncation=True, max_length=self.max_seq_length,
+                                return_tensors="np")
+        attention_mask = inputs["attention_mask"].astype(np.int64)
+        token_embeddings = self.session.run(None, dict(input_ids=inputs["input_ids"].astype(np.int64),
+                                                       attention_mask=attention_mask))[0]
+        embeddings = self.__pool__(token_embeddings, attention_mask)
+        if self.normalize:
+            embeddings = embeddings / np.clip(np.linalg.norm(embeddings, axis=1, keepdims=True), 1e-12, None)
+        return embeddings
+
+    def encode(self, texts):
+        # Sorted by length like sentence-transformers, a batch pads to its longest text only
+        order = np.argsort([-len(text) for text in texts], kind="stable")
+        embeddings = np.empty((len(texts), 0), dtype=np.float32)
+        for start in range(0, len(texts), self.batch_size):
+            batch = self.__encode_batch__([texts[k] for k in order[start:start + self.batch_size]])
+            if not start:
+                embeddings = np.empty((len(texts), batch.shape[1]), dtype=np.float32)
+            embeddings[order[start:start + self.batch_size]] = batch
+        return embeddings
+
+    def embed_documents(self, texts):
+        return self.encode([text.replace("\n", " ") for text in texts]).tolist()
+
+    def embed_query(self, text):
+        return self.embed_documents([text])[0]
+
+
+def check_parity(reference_encoder, encoder, sentences=None):
+    """
+        Cosine similarity between the torch and the ONNX embeddings of the same sentences.
+    """
+    sentences = sentences or PARITY_SENTENCES
+    reference = np.asarray(reference_encoder.embed_documents(sentences))
+    embeddings = np.asarray(encoder.embed_documents(sentences))
+    cosine = (reference * embeddings).sum(axis=1) / (np.linalg.norm(reference, axis=1) *
+                                                      np.linalg.norm(embeddings, axis=1))
+    return dict(sentences=len(sentences), min_cosine=round(float(cosine.min()), 6),
+                mean_cosine=round(float(cosine.mean()), 6), max_drift=round(float(1 - cosine.min()), 6))
+
+
+def get_prepared(model_path, backend):
+    """
+        The export of `backend` and its parity when both are done for the current model files, None otherwise.
+    """
+    paths = get_onnx_paths(model_path)
+    onnx_path = paths["int8"] if backend == "onnx-int8" else paths["onnx"]
+    manifest = read_manifest(model_path)
+    if manifest.get("fingerprint") != get_model_fingerprint(model_path) or not os.path.exists(onnx_path) or \
+            "parity" not in manifest.get(backend, {}):
+        return None
+    return onnx_path, manifest[backend]["parity"]
+
+
+def prepare_onnx(model_path, backend, torch_loader):
+    """
+        Exports the ONNX model of `backend` and measures its parity against the torch model, unless the export
+        manifest already has both. One process does it under the export lock, the others wait and reuse it, torch is
+        only loaded by the process that exports.
+    """
+    if prepared := get_prepared(model_path, backend):
+        return prepared
+    os.makedirs(get_onnx_paths(model_path)["folder"], exist_ok=True)
+    with file_lock(get_onnx_paths(model_path)["lock"]):
+        if prepared := get_prepared(model_path, backend):
+            return prepared
+        onnx_path = export_onnx(model_path, quantize=backend == "onnx-int8")
+        manifest = read_manifest(model_path)
+        manifest[backend]["parity"] = check_parity(torch_loader(), OnnxSentenceEncoder(model_path, onnx_path))
+        write_manifest(model_path, manifest)
+        return onnx_path, manifest[backend]["parity"]
+
+
+def load_onnx_encoder(model_path, backend, torch_loader):
+    """
+        Loads the ONNX encoder of `backend`, exported and checked by `prepare_onnx` first when that was not done yet.
+    """
+    onnx_path, parity = prepare_onnx(model_path, backend, torch_loader)
+    encoder = OnnxSentenceEncoder(model_path, onnx_path)
+    logger.info(f"Loaded {backend} encoder {onnx_path}, parity {parity}")
+    return encoder, parity
+
+
+def main():
+    from src.agent.model_registry import load_torch_model, model_registry
+
+    sbert_config = model_registry.config
+    if sbert_config.backend == "torch":
+        print("SBERT_CONFIG.backend is torch, nothing to export")
+        return
+    onnx_path, parity = prepare_onnx(sbert_config.model_path, sbert_config.backend,
+                                     lambda: load_torch_model(sbert_config))
+    print(json.dumps(dict(backend=sbert_config.backend, onnx_path=onnx_path, parity=parity)))
+
+
+if __name__ == "__main__":
+    main()
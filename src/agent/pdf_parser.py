@@ -0,0 +1,18 @@
+from langchain_core.documents import Document
+from pypdf import PdfReader
+
+
+def count_pdf_pages(file_path):
+    return len(PdfReader(file_path).pages)
+
+
+def parse_pdf_pages(file_path, first_page, last_page):
+    """
+        Extracts the text of pages [first_page, last_page) of a PDF.
+        Runs inside the parser process pool so it only imports pypdf and the Document class.
+    """
+    pdf_reader = PdfReader(file_path)
+    total_pages = len(pdf_reader.pages)
+    return [Document(page_content=pdf_reader.pages[page_number].extract_text().strip(),
+                     metadata=dict(source=file_path, page=page_number, total_pages=total_pages))
+            for page_number in range(first_page, min(last_page, total_pages))]
@@ -0,0 +1,232 @@
+"""
+    Rebuilds a collection into a new versioned collection while the current one keeps serving, then switches the alias
+    once the new one is validated:
+
+    python -m src.agent.reindex --project-id acme --max-chunks-per-second 100
+"""
+import argparse
+import asyncio
+import os
+import threading
+import time
+
+from fastapi.logger import logger
+
+from src.agent.collection_aliases import collection_aliases
+from src.agent.embedding_generation import GenerateEmbedding
+from src.agent.executors import executors
+from src.agent.file_lock import FileLockBusy, named_lock
+from src.agent.ingestion_manifest import IngestionManifest
+from src.agent.keyword_index import keyword_indexes
+from src.agent.model_registry import model_registry
+from src.agent.tenants import tenants
+from src.agent.utils import get_embeddings_model
+from src.agent.vector_db_client import delete_documents_by_ids, get_row_count, is_schema_exists, vector_backend
+from src.config.config_client import config
+from src.schemas.pydantic_models import ReindexConfig, Tenant
+
+
+def drop_collection(collection_name):
+    """
+        Drops the vector and keyword indexes and the ingestion manifest of a collection.
+    """
+    vector_backend.drop(collection_name)
+    vector_backend.offload(collection_name)
+    keyword_indexes.get(collection_name).drop()
+    keyword_indexes.offload(collection_name)
+    manifest_path = IngestionManifest(collection_name).manifest_path
+    if os.path.exists(manifest_path):
+        os.remove(manifest_path)
+    logger.info(f"Dropped collection {collection_name}")
+
+
+class ReindexValidationError(Exception):
+    def __init__(self, message, report):
+        super().__init__(message)
+        self.report = report
+
+
+class Reindexer:
+    """
+        Re-embeds the source files of a tenant into `<collection>_v<N+1>` at REINDEX.max_chunks_per_second, while
+        the queries keep using the live collection. The new collection is validated (row counts against its manifest
+        and its keyword index, recall of sampled chunks of the live collection), catches up with the files ingested
+        during the build, and the alias is switched. The previous collection is dropped after gc_delay_seconds, once
+        the queries in flight are done with it. The encoder that built the new collection is recorded with the alias,
+        queries embedded by another one are refused.
+        One re-index of a collection runs at a time across the worker processes, a second one raises FileLockBusy.
+    """
+
+    def __init__(self, tenant: Tenant, reindex_config: ReindexConfig, progress=None):
+        self.tenant = tenant
+        self.config = reindex_config
+        self.progress = progress
+        self.__resolve__()
+
+    def __resolve__(self):
+        self.live_name = collection_aliases.resolve(self.tenant.index_name)
+        self.shadow_name = collection_aliases.next_name(self.tenant.index_name)
+        self.shadow_tenant = self.tenant.model_copy(update=dict(index_name=self.shadow_name))
+
+    def __generate__(self, max_chunks_per_second):
+        return GenerateEmbedding(tenant=self.shadow_tenant, progress=self.progress,
+                                 max_chunks_per_second=max_chunks_per_second).execute()
+
+    def build(self):
+        # Leftover of a failed build
+        self.collect_garbage(self.shadow_name)
+        start_time = time.perf_counter()
+        files = self.__generate__(self.config.max_chunks_per_second)
+        logger.info(f"Built {self.shadow_name} from {len(files)} files in {time.perf_counter() - start_time:.1f}s")
+        return files
+
+    def measure_recall(self):
+        """
+            Searches the new collection with the beginning of chunks sampled from the live one, a sample is found
+            when a chunk of the same source and page is in the top results.
+        """
+        samples = keyword_indexes.get(self.live_name).sample(self.config.sample_queries, seed=self.config.seed)
+        if not samples:
+            return None
+        queries = [sample.page_content[:self.config.sample_query_chars] for sample in samples]
+        vectors = get_embeddings_model().embed_documents(queries)
+        found = 0
+        for sample, vector in zip(samples, vectors):
+            results = vector_backend.search(self.shadow_name, vector, self.config.sample_top_k)
+            found += any((doc.metadata.get("source"), str(doc.metadata.get("page"))) ==
+                         (sample.metadata.get("source"), str(sample.metadata.get("page"))) for doc in results)
+        return round(found / len(samples), 4)
+
+    def validate(self, with_recall=True):
+        # Chunks shared by several files are stored once
+        expected = len(IngestionManifest(self.shadow_name).chunk_ids())
+        report = dict(live_collection=self.live_name, new_collection=self.shadow_name,
+                      live_rows=get_row_count(self.live_name) if is_schema_exists(self.live_name) else 0,
+                      new_rows=get_row_count(self.shadow_name) if is_schema_exists(self.shadow_name) else 0,
+                      expected_rows=expected, keyword_rows=keyword_indexes.get(self.shadow_name).count())
+        if with_recall:
+            report["recall"] = self.measure_recall()
+
+        if not report["new_rows"]:
+            raise ReindexValidationError(f"{self.shadow_name} is empty", report)
+        if report["new_rows"] != expected or report["keyword_rows"] != expected:
+            raise ReindexValidationError(f"{self.shadow_name} has {report['new_rows']} rows and "
+                                         f"{report['keyword_rows']} keyword rows, {expected} expected", report)
+        if report.get("recall") is not None and report["recall"] < self.config.min_recall:
+            raise ReindexValidationError(f"Recall of {self.shadow_name} is {report['recall']}, below "
+                                         f"{self.config.min_recall}", report)
+        return report
+
+    @staticmethod
+    def lock(tenant: Tenant):
+        return named_lock(f"{tenant.index_name}.reindex", blocking=False)
+
+    @classmethod
+    def is_running(cls, tenant: Tenant):
+        try:
+            with cls.lock(tenant):
+                return False
+        except FileLockBusy:
+            return True
+
+    def reconcile(self):
+        """
+            Removes from the new collection the files purged, replaced or deleted during the build: the entries whose
+            source is gone from disk or that the live manifest records with other content. Returns the number of
+            files removed, the catch-up ingests the current version of the replaced ones.
+        """
+        live_manifest, manifest = IngestionManifest(self.live_name), IngestionManifest(self.shadow_name)
+        live_hashes = {entry["source"]: file_hash for file_hash, entry in live_manifest.entries.items()}
+        removed_files = [file_hash for file_hash, entry in manifest.entries.items()
+                         if not os.path.exists(entry["source"]) or
+                         live_hashes.get(entry["source"], file_hash) != file_hash]
+        deleted_ids = []
+        for file_hash in removed_files:
+            entry = manifest.remove(file_hash)
+            deleted_ids += manifest.release_chunks(entry["chunk_ids"])
+        for entry in manifest.entries.values():
+            entry["duplicate_sources"] = [source for source in entry.get("duplicate_sources", [])
+                                          if os.path.exists(source)]
+        if deleted_ids:
+            delete_documents_by_ids(deleted_ids, self.shadow_name)
+        manifest.save()
+        if removed_files:
+            logger.info(f"Removed {len(removed_files)} files changed during the build from {self.shadow_name}")
+        return len(removed_files)
+
+    def swap(self):
+        # Live ingestion is paused for the catch-up and the switch, the queries are not
+        with GenerateEmbedding.collection_lock(self.tenant.index_name):
+            files_removed = self.reconcile()
+            caught_up = self.__generate__(0)
+            report = self.validate(with_recall=False)
+            previous = collection_aliases.swap(self.tenant.index_name, self.shadow_name,
+                                               encoder=model_registry.encoder)
+        return previous, dict(report, files_caught_up=caught_up, files_removed=files_removed)
+
+    def collect_garbage(self, collection_name):
+        if collection_name.lower() == collection_aliases.resolve(self.tenant.index_name).lower():
+            raise ValueError(f"{collection_name} is live, it cannot be dropped")
+        drop_collection(collection_name)
+
+    def run(self, wait_for_gc=True):
+        """
+            Builds, validates and switches, returns the validation report. The new collection is dropped when the
+            validation fails and the live one is left untouched.
+        """
+        start_time = time.perf_counter()
+        with self.lock(self.tenant):
+            # Another worker may have switched the collection since this re-index was created
+            self.__resolve__()
+            with tenants.in_use(self.live_name), tenants.in_use(self.shadow_name):
+                files = self.build()
+                try:
+                    report = self.validate()
+                    previous, swap_report = self.swap()
+                except ReindexValidationError as e:
+                    logger.error(f"Re-index of {self.tenant.index_name} failed validation, {e}, report {e.report}")
+                    if not self.config.keep_failed:
+                        self.collect_garbage(self.shadow_name)
+                    raise
+        report = dict(report, files=len(files), files_caught_up=swap_report["files_caught_up"],
+                      files_removed=swap_report["files_removed"],
+                      new_rows=swap_report["new_rows"], previous_collection=previous,
+                      seconds=round(time.perf_counter() - start_time, 2))
+
+        if previous != self.shadow_name and not self.config.keep_previous:
+            if wait_for_gc:
+                time.sleep(self.config.gc_delay_seconds)
+                self.collect_garbage(previous)
+            else:
+                self.schedule_garbage_collection(previous)
+        return report
+
+    def schedule_garbage_collection(self, collection_name):
+        timer = threading.Timer(self.config.gc_delay_seconds, self.collect_garbage, [collection_name])
+        timer.daemon = True
+        timer.start()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Rebuild a collection into a new version and switch to it")
+    parser.add_argument("--project-id", default=None, help="Project to re-index, the shared collection when omitted")
+    parser.add_argument("--max-chunks-per-second", type=float, default=None)
+    parser.add_argument("--gc-delay-seconds", type=float, default=None)
+    args = parser.parse_args()
+
+    reindex_config = ReindexConfig(**(config.get("REINDEX") or {}))
+    if args.max_chunks_per_second is not None:
+        reindex_config.max_chunks_per_second = args.max_chunks_per_second
+    if args.gc_delay_seconds is not None:
+        reindex_config.gc_delay_seconds = args.gc_delay_seconds
+    executors.start()
+    vector_backend.start()
+    try:
+        print(Reindexer(tenants.resolve(args.project_id), reindex_config).run())
+    finally:
+        asyncio.run(vector_backend.aclose())
+        executors.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,256 @@
+import hashlib
+import os
+import pickle
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+from fastapi.logger import logger
+
+from src.agent.executors import run_io
+from src.agent.metrics import record_cache_lookup
+from src.config.config_client import config
+from src.schemas.pydantic_models import RetrievalCacheConfig
+
+
+class LRUCache:
+    """
+        Bounded in-process cache, the least recently used key is evicted first.
+    """
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self._lock:
+            if key not in self._entries:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return self._entries[key]
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class SQLiteCache:
+    """
+        Bounded cache shared by the uvicorn workers of a host through a SQLite file. The least recently used keys
+        are evicted in batches, once a process has written max_entries / 100 keys since its last eviction.
+    """
+
+    def __init__(self, path, max_entries, table):
+        self.path = path
+        self.max_entries = max_entries
+        self.table = table
+        self.eviction_batch = max(1, max_entries // 100)
+        self.hits = 0
+        self.misses = 0
+        self._writes = 0
+        self._local = threading.local()
+        with self.__connection__() as connection:
+            connection.execute(f"CREATE TABLE IF NOT EXISTS {self.table} "
+                               f"(key TEXT PRIMARY KEY, value BLOB, accessed_at REAL)")
+            connection.execute(f"CREATE INDEX IF NOT EXISTS {self.table}_accessed_at ON {self.table} (accessed_at)")
+
+    def __connection__(self):
+        if getattr(self._local, "connection", None) is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            connection = sqlite3.connect(self.path, timeout=5, isolation_level=None, check_same_thread=False)
+            connection.execute("PRAGMA journal_mode=WAL")
+            self._local.connection = connection
+        return self._local.connection
+
+    def get(self, key):
+        connection = self.__connection__()
+        row = connection.execute(f"SELECT value FROM {self.table} WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        connection.execute(f"UPDATE {self.table} SET accessed_at = julianday('now') WHERE key = ?", (key,))
+        self.hits += 1
+        return pickle.loads(row[0])
+
+    def set(self, key, value):
+        connection = self.__connection__()
+        connection.execute(f"INSERT OR REPLACE INTO {self.table} VALUES (?, ?, julianday('now'))",
+                           (key, pickle.dumps(value)))
+        self._writes += 1
+        if self._writes >= self.eviction_batch:
+            self._writes = 0
+            # The access time of the max_entries-th most recent key, found through the index
+            connection.execute(f"DELETE FROM {self.table} WHERE accessed_at < (SELECT accessed_at FROM {self.table} "
+                               f"ORDER BY accessed_at DESC LIMIT 1 OFFSET ?)", (self.max_entries - 1,))
+
+    def __len__(self):
+        return self.__connection__().execute(f"SELECT COUNT(*) FROM {self.table}").fetchone()[0]
+
+
+class CollectionVersions:
+    """
+        Version counter per collection, bumped by ingestion so that cached results of a collection become stale.
+        Kept in the SQLite file when the cache is shared between workers, a version read from it is reused for
+        ttl_seconds, so the bump of another worker is seen at most that late.
+    """
+
+    def __init__(self, sqlite_path=None, ttl_seconds=1.0):
+        self.sqlite_path = sqlite_path
+        self.ttl_seconds = ttl_seconds
+        self._versions = {}
+        # collection -> (version, monotonic time it was read)
+        self._read_at = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        if self.sqlite_path:
+            with self.__connection__() as connection:
+                connection.execute("CREATE TABLE IF NOT EXISTS collection_versions "
+                                   "(collection TEXT PRIMARY KEY, version INTEGER)")
+
+    def __connection__(self):
+        if getattr(self._local, "connection", None) is None:
+            os.makedirs(os.path.dirname(self.sqlite_path) or ".", exist_ok=True)
+            self._local.connection = sqlite3.connect(self.sqlite_path, timeout=5, check_same_thread=False)
+        return self._local.connection
+
+    def cached(self, collection):
+        """
+            The version of `collection` when it is known without reading the SQLite file, None otherwise.
+        """
+        collection = collection.lower()
+        if not self.sqlite_path:
+            return self._versions.get(collection, 0)
+        version, read_at = self._read_at.get(collection, (None, 0))
+        return version if time.monotonic() - read_at < self.ttl_seconds else None
+
+    def get(self, collection):
+        if (version := self.cached(collection)) is not None:
+            return version
+        collection = collection.lower()
+        with self.__connection__() as connection:
+            row = connection.execute("SELECT version FROM collection_versions WHERE collection = ?",
+                                     (collection,)).fetchone()
+        version = row[0] if row else 0
+        self._read_at[collection] = (version, time.monotonic())
+        return version
+
+    def bump(self, collection):
+        collection = collection.lower()
+        with self._lock:
+            if not self.sqlite_path:
+                self._versions[collection] = self._versions.get(collection, 0) + 1
+                return self._versions[collection]
+            with self.__connection__() as connection:
+                connection.execute("INSERT INTO collection_versions VALUES (?, 1) ON CONFLICT(collection) "
+                                   "DO UPDATE SET version = version + 1", (collection,))
+                version = connection.execute("SELECT version FROM collection_versions WHERE collection = ?",
+                                             (collection,)).fetchone()[0]
+            self._read_at[collection] = (version, time.monotonic())
+            return version
+
+
+class RetrievalCache:
+    """
+        Caches text -> query embedding (keyed by the SBERT model version) and
+        (embedding, collection, collection version, top_k) -> search results.
+        The async methods run the lookups of the SQLite backend in the io pool, off the event loop.
+    """
+
+    def __init__(self, cache_config: RetrievalCacheConfig):
+        self.config = cache_config
+        if cache_config.backend == "sqlite":
+            self.embeddings = SQLiteCache(cache_config.sqlite_path, cache_config.max_entries, "query_embeddings")
+            self.results = SQLiteCache(cache_config.sqlite_path, cache_config.max_entries, "search_results")
+            self.versions = CollectionVersions(cache_config.sqlite_path, cache_config.version_ttl_seconds)
+        else:
+            self.embeddings = LRUCache(cache_config.max_entries)
+            self.results = LRUCache(cache_config.max_entries)
+            self.versions = CollectionVersions()
+
+    @staticmethod
+    def __embedding_key__(text, model_version):
+        return hashlib.sha256(f"{model_version}|{text}".encode()).hexdigest()
+
+    def __results_key__(self, embedded_query, collection, top_k, search_type):
+        vector_hash = hashlib.sha256(np.asarray(embedded_query, dtype=np.float32).tobytes()).hexdigest()
+        version = self.versions.get(collection)
+        return f"{collection.lower()}|{version}|{top_k}|{search_type}|{vector_hash}"
+
+    def get_embedding(self, text, model_version):
+        if not self.config.enabled:
+            return None
+        embedded_query = self.embeddings.get(self.__embedding_key__(text, model_version))
+        record_cache_lookup("query_embedding", hit=embedded_query is not None)
+        return embedded_query
+
+    def set_embedding(self, text, model_version, embedded_query):
+        if self.config.enabled:
+            self.embeddings.set(self.__embedding_key__(text, model_version), list(embedded_query))
+
+    def get_results(self, embedded_query, collection, top_k, search_type="near_vector"):
+        if not self.config.enabled:
+            return None
+        results = self.results.get(self.__results_key__(embedded_query, collection, top_k, search_type))
+        record_cache_lookup("search_results", hit=results is not None)
+        return results
+
+    def set_results(self, embedded_query, collection, top_k, results, search_type="near_vector"):
+        if self.config.enabled:
+            self.results.set(self.__results_key__(embedded_query, collection, top_k, search_type), results)
+
+    def collection_version(self, collection):
+        return self.versions.get(collection)
+
+    async def __run__(self, func, *args):
+        if self.config.backend == "sqlite":
+            return await run_io(func, *args)
+        return func(*args)
+
+    async def aget_embedding(self, text, model_version):
+        return await self.__run__(self.get_embedding, text, model_version)
+
+    async def aset_embedding(self, text, model_version, embedded_query):
+        return await self.__run__(self.set_embedding, text, model_version, embedded_query)
+
+    async def aget_results(self, embedded_query, collection, top_k, search_type="near_vector"):
+        return await self.__run__(self.get_results, embedded_query, collection, top_k, search_type)
+
+    async def aset_results(self, embedded_query, collection, top_k, results, search_type="near_vector"):
+        return await self.__run__(self.set_results, embedded_query, collection, top_k, results, search_type)
+
+    async def acollection_version(self, collection):
+        if (version := self.versions.cached(collection)) is not None:
+            return version
+        return await run_io(self.versions.get, collection)
+
+    def bump_collection_version(self, collection):
+        version = self.versions.bump(collection)
+        logger.info(f"Collection {collection} is now at version {version}, cached results invalidated")
+        return version
+
+    def stats(self):
+        stats = {}
+        for name, cache in (("embeddings", self.embeddings), ("results", self.results)):
+            lookups = cache.hits + cache.misses
+            stats[name] = dict(size=len(cache), hits=cache.hits, misses=cache.misses,
+                               hit_rate=round(cache.hits / lookups, 4) if lookups else 0.0)
+        return stats
+
+    async def astats(self):
+        return await self.__run__(self.stats)
+
+
+retrieval_cache = RetrievalCache(RetrievalCacheConfig(**(config.get("RETRIEVAL_CACHE") or {})))
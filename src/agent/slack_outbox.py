@@ -0,0 +1,285 @@
+import asyncio
+import glob
+import json
+import os
+import random
+import time
+import uuid
+from collections import deque
+
+from fastapi.logger import logger
+from slack_sdk.errors import SlackApiError
+from slack_sdk.web.async_client import AsyncWebClient
+
+from src.agent.executors import run_io
+from src.agent.metrics import SLACK_OUTBOX_DEPTH, stage, record_error
+from src.config.config_client import config
+from src.schemas.pydantic_models import SlackOutboxConfig
+
+# Errors of the token or the channel, retrying does not help
+TERMINAL_ERRORS = ("not_authed", "invalid_auth", "account_inactive", "token_revoked", "channel_not_found",
+                   "is_archived", "not_in_channel")
+
+
+def format_answer(message):
+    return "\n".join([f"\n\nQuestion: *{message.get('question')}*",
+                      message.get("answer")]).replace("**", "*").replace("- ", "• ")
+
+
+def is_process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class SlackOutbox:
+    """
+        Delivers the answers of a request to Slack in the background, as one parent message with one threaded reply
+        per answer. Every request is spooled to disk before it is queued, and the spool file records the replies
+        already posted, so a crash or a failed attempt resumes without duplicates. Failed attempts are requeued with
+        a not-before time, after an exponential backoff or the Retry-After of a rate limit, and the worker moves on
+        to the next request meanwhile. Nothing is posted without a SLACK_TOKEN.
+        The spool files are read and written in the I/O executor. The requests that do not fit in the queue are
+        remembered by id and read back once it drains, the spool directory is only listed every
+        claim_interval_seconds, for the files of the processes that are gone.
+    """
+
+    channel = config.get("SLACK_CHANNEL", "all-slack")
+    username = config.get("SLACK_USERNAME", "Team Zania")
+    token = config.get("SLACK_TOKEN") or None
+
+    def __init__(self, outbox_config: SlackOutboxConfig):
+        self.config = outbox_config
+        self._queue = None
+        self._worker = None
+        self._client = None
+        self._claimer = None
+        # Ids of the requests queued, being delivered, waiting for their retry or spooled while the queue is full, the
+        # timers of the retries, the ids spooled while the queue is full, and the spool writes of enqueue in flight
+        self._pending = set()
+        self._delayed = {}
+        self._spooled = deque()
+        self._spooling = set()
+
+    @property
+    def failed_dir(self):
+        return os.path.join(self.config.spool_dir, "failed")
+
+    def __spool_path__(self, item_id):
+        # Spool files carry the pid of the process delivering them, the others leave them alone
+        return os.path.join(self.config.spool_dir, f"{item_id}.{os.getpid()}.json")
+
+    def __write_spool__(self, item):
+        os.makedirs(self.config.spool_dir, exist_ok=True)
+        path = self.__spool_path__(item["id"])
+        with open(f"{path}.tmp", "w") as f:
+            json.dump(item, f)
+        os.replace(f"{path}.tmp", path)
+
+    def __remove_spool__(self, item, failed=False):
+        path = self.__spool_path__(item["id"])
+        if failed:
+            os.makedirs(self.failed_dir, exist_ok=True)
+            os.replace(path, os.path.join(self.failed_dir, os.path.basename(path)))
+        elif os.path.exists(path):
+            os.remove(path)
+
+    def __read_spool__(self, item_id):
+        try:
+            with open(self.__spool_path__(item_id)) as f:
+                return json.load(f)
+        except (OSError, ValueError) as e:
+            logger.error(f"Failed while reading Slack spool file of request {item_id}, {e}")
+            return None
+
+    def __claim_spool__(self, own=False):
+        """
+            Takes over the spool files of processes that are gone, oldest first. With `own`, the files already
+            carrying the pid of this process too, left by a process that had the same pid.
+        """
+        items = []
+        for path in glob.glob(os.path.join(self.config.spool_dir, "*.json")):
+            item_id, pid = os.path.basename(path).rsplit(".", 2)[:2]
+            if (int(pid) == os.getpid() and not own) or (int(pid) != os.getpid() and is_process_alive(int(pid))):
+                continue
+            try:
+                os.replace(path, self.__spool_path__(item_id))
+                with open(self.__spool_path__(item_id)) as f:
+                    items.append(json.load(f))
+            except (OSError, ValueError) as e:
+                logger.error(f"Failed while reading Slack spool file {path}, {e}")
+        return sorted(items, key=lambda item: item["created_at"])
+
+    def start(self):
+        if not self.token:
+            logger.warning("SLACK_TOKEN is not configured, answers are not posted to Slack")
+            return
+        self._queue = asyncio.Queue(maxsize=self.config.queue_size)
+        self._client = AsyncWebClient(token=self.token,
+                                      base_url=config.get("SLACK_API_URL") or "https://slack.com/api/")
+        self._worker = asyncio.create_task(self.__worker__(), name="slack-outbox")
+        self._claimer = asyncio.create_task(self.__claim_loop__(), name="slack-outbox-claim")
+        logger.info("Slack outbox started")
+
+    async def stop(self):
+        # Undelivered requests stay in the spool for the next start
+        await asyncio.gather(*self._spooling, return_exceptions=True)
+        for timer in self._delayed.values():
+            timer.cancel()
+        self._delayed.clear()
+        for task in (self._claimer, self._worker):
+            if task:
+                task.cancel()
+                await asyncio.gather(task, return_exceptions=True)
+        self._worker = self._claimer = None
+        self._pending.clear()
+        self._spooled.clear()
+
+    async def join(self):
+        """
+            Waits until every request is delivered or given up, including the ones waiting for their retry or for room
+            in the queue.
+        """
+        while self._queue is not None:
+            await self._queue.join()
+            if not (self._delayed or self._spooled or self._spooling):
+                return
+            await asyncio.sleep(0.05)
+
+    def __put__(self, item):
+        self._pending.add(item["id"])
+        try:
+            self._queue.put_nowait(item)
+            SLACK_OUTBOX_DEPTH.set(self._queue.qsize())
+        except asyncio.QueueFull:
+            record_error("slack")
+            self._spooled.append(item["id"])
+            logger.error(f"Slack outbox is full, request {item['id']} stays spooled until the queue drains")
+
+    async def __drain_spooled__(self):
+        # Reads back the requests spooled while the queue was full, as long as there is room
+        while self._spooled and not self._queue.full():
+            item_id = self._spooled.popleft()
+            if item := await run_io(self.__read_spool__, item_id):
+                self.__put__(item)
+            else:
+                self._pending.discard(item_id)
+
+    async def __claim_loop__(self):
+        own = True
+        while True:
+            try:
+                items = await run_io(self.__claim_spool__, own)
+                for item in items:
+                    if item["id"] not in self._pending:
+                        self.__put__(item)
+                if items:
+                    logger.info(f"Slack outbox took over {len(items)} spooled requests")
+            except Exception as e:
+                logger.error(f"Failed while claiming the Slack spool, {e}")
+            own = False
+            await asyncio.sleep(self.config.claim_interval_seconds)
+
+    async def __spool__(self, item):
+        try:
+            await run_io(self.__write_spool__, item)
+        except Exception as e:
+            record_error("slack")
+            logger.error(f"Failed while spooling Slack request {item['id']}, it is delivered without a spool file, {e}")
+        self.__put__(item)
+
+    def __requeue__(self, item):
+        self._delayed.pop(item["id"], None)
+        self._pending.discard(item["id"])
+        self.__put__(item)
+
+    def __delay__(self, item):
+        self._pending.add(item["id"])
+        self._delayed[item["id"]] = asyncio.get_running_loop().call_later(
+            max(0.0, item["not_before"] - time.time()), self.__requeue__, item)
+
+    def enqueue(self, messages: list[dict]):
+        """
+            Spools and queues the answers of a request, returns without waiting for Slack.
+        """
+        answers = [dict(question=message.get("question"), answer=message.get("answer"))
+                   for message in messages if message.get("answer")]
+        if not answers or not self.token:
+            return None
+        if self._queue is None:
+            self.start()
+        item = dict(id=uuid.uuid4().hex, created_at=time.time(), answers=answers, thread_ts=None, posted=0,
+                    attempts=0, not_before=0)
+        self._pending.add(item["id"])
+        # Spooled in the I/O executor, then queued
+        task = asyncio.create_task(self.__spool__(item))
+        self._spooling.add(task)
+        task.add_done_callback(self._spooling.discard)
+        return item["id"]
+
+    async def __post__(self, **kwargs):
+        response = await self._client.chat_postMessage(channel=self.channel, username=self.username, **kwargs)
+        return response["ts"]
+
+    async def __deliver__(self, item):
+        if item["thread_ts"] is None:
+            questions = "\n".join(f"• {answer['question']}" for answer in item["answers"])
+            item["thread_ts"] = await self.__post__(text=f"Answers to {len(item['answers'])} questions:\n{questions}")
+            await run_io(self.__write_spool__, item)
+        while item["posted"] < len(item["answers"]):
+            answer = item["answers"][item["posted"]]
+            await self.__post__(text=format_answer(answer), thread_ts=item["thread_ts"])
+            logger.info(f"Slack Message posted for question: {answer['question']}")
+            item["posted"] += 1
+            await run_io(self.__write_spool__, item)
+
+    def __backoff__(self, item, error):
+        if isinstance(error, SlackApiError) and error.response.status_code == 429:
+            retry_after = error.response.headers.get("Retry-After") or error.response.headers.get("retry-after")
+            if retry_after:
+                return float(retry_after)
+        return random.uniform(0, min(self.config.backoff_max_seconds,
+                                     self.config.backoff_base_seconds * 2 ** item["attempts"]))
+
+    async def __worker__(self):
+        while True:
+            item = await self._queue.get()
+            SLACK_OUTBOX_DEPTH.set(self._queue.qsize())
+            try:
+                if item.get("not_before", 0) > time.time():
+                    self.__delay__(item)
+                    continue
+                try:
+                    with stage("slack"):
+                        await self.__deliver__(item)
+                    await run_io(self.__remove_spool__, item)
+                    self._pending.discard(item["id"])
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    item["attempts"] += 1
+                    record_error("slack")
+                    terminal = isinstance(e, SlackApiError) and e.response.get("error") in TERMINAL_ERRORS
+                    if terminal or item["attempts"] >= self.config.max_attempts:
+                        logger.error(f"SLACK : Giving up on request {item['id']} after {item['attempts']} "
+                                     f"attempts, {e}")
+                        await run_io(self.__remove_spool__, item, failed=True)
+                        self._pending.discard(item["id"])
+                        continue
+                    wait = self.__backoff__(item, e)
+                    logger.error(f"SLACK : Failed while posting messages, retry {item['attempts']} in "
+                                 f"{wait:.2f}s, {e}")
+                    item["not_before"] = time.time() + wait
+                    await run_io(self.__write_spool__, item)
+                    self.__delay__(item)
+            finally:
+                self._queue.task_done()
+                if self._queue.empty():
+                    await self.__drain_spooled__()
+
+
+slack_outbox = SlackOutbox(SlackOutboxConfig(**(config.get("SLACK_OUTBOX") or {})))
@@ -0,0 +1,114 @@
+import asyncio
+import os
+import re
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+from fastapi.logger import logger
+
+from src.agent.executors import run_io
+from src.agent.keyword_index import keyword_indexes
+from src.agent.metrics import ACTIVE_TENANTS
+from src.agent.utils import AgentException
+from src.agent.vector_db_client import get_index_name, vector_backend
+from src.config.config_client import config
+from src.schemas.pydantic_models import Tenant, TenantConfig
+from src.startup_constants import PROJECT_ID_NOT_VALID
+
+# Weaviate collection names start with a letter and only contain letters, digits and underscores
+PROJECT_ID_PATTERN = re.compile(r"^[A-Za-z][A-Za-z0-9_]{0,63}$")
+PROJECTS_FOLDER = "projects"
+
+
+class TenantRegistry:
+    """
+        Resolves the X-ProjectID header to the collection and upload folder of the project. Requests without the
+        header use the original collection and folder.
+        A tenant's indexes are loaded by its first query or ingestion, and offloaded once it has been idle for
+        TENANTS.idle_seconds, so memory follows the active tenants. On the Weaviate backend only the keyword index is
+        offloaded, the vectors stay loaded in the Weaviate server.
+    """
+
+    collection_name = "zania"
+    download_folder = config.get("DOWNLOAD_FOLDER", "download_data")
+
+    def __init__(self, tenant_config: TenantConfig):
+        self.config = tenant_config
+        self._last_used: dict[str, float] = {}
+        self._in_use = Counter()
+        self._lock = threading.Lock()
+        self._offload_task = None
+
+    def resolve(self, project_id=None) -> Tenant:
+        if not project_id:
+            return Tenant(index_name=self.collection_name, upload_dir=self.download_folder)
+        if not PROJECT_ID_PATTERN.match(project_id):
+            raise AgentException(code=400, message=f"Invalid project id {project_id}",
+                                 display_message=PROJECT_ID_NOT_VALID)
+        return Tenant(project_id=project_id.lower(), index_name=get_index_name(project_id, self.collection_name),
+                      upload_dir=os.path.join(self.download_folder, PROJECTS_FOLDER, project_id.lower()))
+
+    def touch(self, index_name):
+        with self._lock:
+            self._last_used[index_name] = time.monotonic()
+            ACTIVE_TENANTS.set(len(self._last_used))
+
+    @contextmanager
+    def in_use(self, index_name):
+        """
+            Keeps the tenant loaded for the duration of the block, used around ingestion jobs.
+        """
+        with self._lock:
+            self._in_use[index_name] += 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._in_use[index_name] -= 1
+                if not self._in_use[index_name]:
+                    del self._in_use[index_name]
+            self.touch(index_name)
+
+    def is_in_use(self, index_name):
+        with self._lock:
+            return self._in_use[index_name] > 0 if index_name in self._in_use else False
+
+    def active_tenants(self):
+        with self._lock:
+            return sorted(self._last_used)
+
+    def offload_idle(self):
+        now = time.monotonic()
+        with self._lock:
+            idle = [index_name for index_name, last_used in self._last_used.items()
+                    if now - last_used > self.config.idle_seconds and index_name not in self._in_use]
+            for index_name in idle:
+                del self._last_used[index_name]
+            ACTIVE_TENANTS.set(len(self._last_used))
+        for index_name in idle:
+            vector_backend.offload(index_name)
+            keyword_indexes.offload(index_name)
+            logger.info(f"Offloaded idle tenant {index_name}")
+        return idle
+
+    async def __offload_loop__(self):
+        while True:
+            await asyncio.sleep(self.config.offload_interval_seconds)
+            try:
+                await run_io(self.offload_idle)
+            except Exception as e:
+                logger.error(f"Failed while offloading idle tenants, {e}", exc_info=True)
+
+    def start(self):
+        self._offload_task = asyncio.create_task(self.__offload_loop__(), name="tenant-offloader")
+
+    async def stop(self):
+        if self._offload_task:
+            self._offload_task.cancel()
+            await asyncio.gather(self._offload_task, return_exceptions=True)
+            self._offload_task = None
+
+
+tenants = TenantRegistry(TenantConfig(**(config.get("TENANTS") or {})))
@@ -1,12 +1,22 @@
+import hashlib
 import os
+import tempfile
+from itertools import islice
 from logging import getLogger
 from fastapi import File, UploadFile
-from slack_sdk import WebClient
+from src.agent.chunker import clean_page
+from src.agent.ingestion_manifest import compute_file_hash
+from src.agent.embedding_service import embedding_service
 from src.config.config_client import config
+from src.schemas.pydantic_models import SavedUpload
+from src.startup_constants import UPLOAD_TOO_LARGE
 from langchain_core.documents import Document
 
 logger = getLogger(__name__)
 
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+MAX_UPLOAD_SIZE = int(config.get("MAX_UPLOAD_SIZE_MB", 200)) * 1024 * 1024
+
 DOCUMENT_ANSWER_PROMPT = """Use the following pieces of context to answer the question at the end.
  If you don't know the answer, just say  Oops! We are unable to find any relevant information from the documents to answer your question, don't try to make up an answer.
 
@@ -26,67 +36,71 @@ Answer:
 """
 
 
-async def slack_message_post(messages: list[dict]):
-    try:
-        client = WebClient(token=config.get("SLACK_TOKEN", None))
-        for message in messages:
-            if llm_answer := message.get("answer"):
-                client.chat_postMessage(
-                    channel=config.get("SLACK_CHANNEL", "all-slack"),
-                    text="\n".join([f"\n\nQuestion: *{message.get('question')}*",
-                                    llm_answer]).replace("**", "*").replace("- ", "• "),
-                    username=config.get("SLACK_USERNAME", "Team Zania"),
-                )
-                logger.info(f"Slack Message posted for question: {message.get('question')}")
-            else:
-                logger.error(f"Empty LLM Message for question: {message.get('question')}")
-                continue
-    except Exception as e:
-        logger.error(f"SLACK : Failed while posting messages to, {e}", exc_info=True)
+def get_embeddings_model():
+    return embedding_service.get_embeddings()
 
 
-def get_embeddings_model():
-    from src.main import sentence_encoder_models
-
-    return sentence_encoder_models["SBERT"]
-
-
-def save_upload_file(uploaded_file: UploadFile = File(...), overwrite: bool = False):
-    file_location = f"{config.get('DOWNLOAD_FOLDER', 'download_data/')}/{uploaded_file.filename}"
-    if os.path.exists(file_location) and overwrite:
-        logger.info(f"The file '{file_location}' exists., Overwriting It")
-        os.remove(file_location)
-        with open(file_location, "wb+") as file_object:
-            file_object.write(uploaded_file.file.read())
-        return True
-    elif os.path.exists(file_location):
-        logger.info(f"The file '{file_location}' exists.")
-        return False
-    else:
-        os.makedirs(os.path.dirname(file_location), exist_ok=True)
-        with open(file_location, "wb+") as file_object:
-            file_object.write(uploaded_file.file.read())
+def get_embeddings_model_version():
+    return embedding_service.version
+
+
+def get_upload_location(filename, upload_dir=None):
+    return f"{upload_dir or config.get('DOWNLOAD_FOLDER', 'download_data/')}/{filename}"
+
+
+def save_upload_file(uploaded_file: UploadFile = File(...), overwrite: bool = False,
+                     upload_dir: str = None) -> SavedUpload:
+    """
+        Streams the upload to a temporary file next to its destination in UPLOAD_CHUNK_SIZE chunks while hashing it,
+        then renames it into place. A file whose content hash is unchanged is left untouched.
+    """
+    file_location = get_upload_location(uploaded_file.filename, upload_dir)
+    os.makedirs(os.path.dirname(file_location), exist_ok=True)
+    file_hash = hashlib.sha256()
+    file_size = 0
+    file_descriptor, tmp_location = tempfile.mkstemp(dir=os.path.dirname(file_location), prefix=".upload-",
+                                                     suffix=".tmp")
+    try:
+        with os.fdopen(file_descriptor, "wb") as file_object:
+            while chunk := uploaded_file.file.read(UPLOAD_CHUNK_SIZE):
+                file_size += len(chunk)
+                if file_size > MAX_UPLOAD_SIZE:
+                    raise AgentException(code=413, message=f"Upload {uploaded_file.filename} exceeds "
+                                                           f"{MAX_UPLOAD_SIZE} bytes",
+                                         display_message=UPLOAD_TOO_LARGE)
+                file_hash.update(chunk)
+                file_object.write(chunk)
+
+        content_hash = file_hash.hexdigest()
+        if os.path.exists(file_location) and compute_file_hash(file_location) == content_hash:
+            os.remove(tmp_location)
+            logger.info(f"The file '{file_location}' exists with the same content.")
+            return SavedUpload(file_location=file_location, content_hash=content_hash, size=file_size,
+                               changed=overwrite)
+
+        os.replace(tmp_location, file_location)
         logger.info(f"info: file {uploaded_file.filename}, saved _at : {file_location}")
-        return True
+        return SavedUpload(file_location=file_location, content_hash=content_hash, size=file_size, changed=True)
+    except BaseException:
+        if os.path.exists(tmp_location):
+            os.remove(tmp_location)
+        raise
 
 
-def get_documents(documents, file_path, splitter):
-    copilot_documents = []
+def iter_batches(items, batch_size):
+    iterator = iter(items)
+    while batch := list(islice(iterator, batch_size)):
+        yield batch
+
+
+def iter_documents(documents, file_path, splitter):
     for doc in documents:
-        content = doc.page_content
-        content = content.replace("-", "")
-        content = content.replace("_", "")
-        doc_meta_data = doc.metadata
-        doc_meta_data.pop("Creator", None)
-        doc_meta_data.pop("ModDate", None)
-        doc_meta_data.pop("Producer", None)
-        doc_meta_data.pop("CreationDate", None)
-        doc_meta_data["agent"] = "Document"
-        doc_meta_data["file_path"] = file_path
-        document = Document(page_content=content, metadata=doc_meta_data)
-        split_documents = splitter.split_documents([document])
-        copilot_documents.extend(split_documents)
-    return copilot_documents
+        content, doc_meta_data = clean_page(doc, file_path)
+        yield from splitter.split_documents([Document(page_content=content, metadata=doc_meta_data)])
+
+
+def get_documents(documents, file_path, splitter):
+    return list(iter_documents(documents, file_path, splitter))
 
 
 class AgentException(Exception):
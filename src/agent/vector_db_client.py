@@ -1,33 +1,56 @@
+import asyncio
 import os
+import threading
 import time
 import uuid
-from collections import Counter
+from contextlib import contextmanager
 
 import weaviate
 import weaviate.classes as wvc
+from weaviate.exceptions import UnexpectedStatusCodeError, WeaviateClosedClientError, WeaviateConnectionError, \
+    WeaviateGRPCUnavailableError, WeaviateStartUpError, WeaviateTimeoutError
 from weaviate.gql.get import HybridFusion
 from fastapi.logger import logger
 from langchain_core.documents.base import Document
 from langchain_weaviate import WeaviateVectorStore
-from retrying import retry
-from stop_words import get_stop_words
 
 from src.config.config_client import get_config
-from src.agent.utils import get_embeddings_model
+from src.agent.embedding_service import embedding_service
+from src.agent.executors import run_io
+from src.agent.keyword_index import keyword_indexes, stopwords_dict
+from src.agent.local_vector_index import LocalVectorIndex
+from src.agent.metrics import stage
+from src.agent.retrieval_cache import retrieval_cache
+from src.agent.utils import get_embeddings_model, get_embeddings_model_version
+from src.schemas.pydantic_models import LocalIndexConfig
 from src.startup_constants import EMBEDDINGS_MODEL_NOT_AVAILABLE
 
 weaviate_http_host = get_config().get("WEAVIATE_HTTP_HOST", "localhost")
 weaviate_http_port = get_config().get("WEAVIATE_HTTP_PORT", "8080")
 weaviate_grpc_host = get_config().get("WEAVIATE_GRPC_HOST", "localhost")
 weaviate_grpc_port = get_config().get("WEAVIATE_GRPC_PORT", "50051")
-cachedStopWords = get_stop_words("english")
-stopwords_dict = Counter(cachedStopWords)
+vector_db_path = get_config().get("VECTOR_DB_PATH", "data_weaviate")
+vector_backend_name = get_config().get("VECTOR_BACKEND", "weaviate")
+weaviate_embedded_port = 8079
+weaviate_embedded_grpc_port = 50050
+hybrid_pushdown = str(get_config().get("HYBRID_PUSHDOWN", False)).lower() == "true"
+# Each side of an in-process hybrid search contributes this many times the requested number of candidates
+hybrid_candidates_factor = 4
+# Ids per delete_many request, Weaviate caps the objects of one request at QUERY_MAXIMUM_RESULTS (10000)
+delete_batch_size = 5000
+# Metadata that chunks can be bulk deleted by, `content_hash` identifies the ingestion of one file version
+DELETE_FILTER_KEYS = ("source", "file_path", "content_hash")
+
+CONNECTION_ERRORS = (WeaviateClosedClientError, WeaviateConnectionError, WeaviateGRPCUnavailableError,
+                     WeaviateStartUpError, WeaviateTimeoutError)
+
+
+def is_local_profile():
+    return os.getenv("ENVIRONMENT_NAME") == "local"
 
 
-@retry(stop_max_attempt_number=3, wait_fixed=2000, wrap_exception=True)
 def get_vector_db_client():
-    profile = os.getenv("ENVIRONMENT_NAME")
-    if profile != "local":
+    if not is_local_profile():
         return weaviate.connect_to_custom(http_host=weaviate_http_host, http_port=weaviate_http_port,
                                           grpc_host=weaviate_grpc_host, grpc_port=weaviate_grpc_port,
                                           http_secure=False, grpc_secure=False,
@@ -36,22 +59,152 @@ def get_vector_db_client():
                                                                                              ),
                                           skip_init_checks=True)
     else:
-        return weaviate.connect_to_embedded(persistence_data_path="data_weaviate", binary_path="data_weaviate/cache")
-
-
-def is_schema_exists(index_name):
-    with get_vector_db_client() as client:
-        return client.collections.exists(index_name)
+        return weaviate.connect_to_embedded(persistence_data_path=vector_db_path, binary_path=f"{vector_db_path}/cache",
+                                            port=weaviate_embedded_port, grpc_port=weaviate_embedded_grpc_port)
 
 
-def get_row_count(index_name):
-    with get_vector_db_client() as client:
-        index_name = index_name.lower()
-        collection = client.collections.get(index_name)
-        if collection:
-            response = collection.aggregate.over_all(total_count=True)
-            row_count = response.total_count
-            return row_count
+def get_async_vector_db_client():
+    if not is_local_profile():
+        return weaviate.use_async_with_custom(http_host=weaviate_http_host, http_port=int(weaviate_http_port),
+                                              grpc_host=weaviate_grpc_host, grpc_port=int(weaviate_grpc_port),
+                                              http_secure=False, grpc_secure=False,
+                                              additional_config=weaviate.config.AdditionalConfig(timeout=(30, 300)),
+                                              skip_init_checks=True)
+    else:
+        # The embedded server is started by the sync client, the async client attaches to it
+        return weaviate.use_async_with_local(host="127.0.0.1", port=weaviate_embedded_port,
+                                             grpc_port=weaviate_embedded_grpc_port, skip_init_checks=True)
+
+
+class VectorDBClientManager:
+    """
+        Owns the process wide sync and async Weaviate clients.
+        Created once in the application lifespan, reconnects when a client is found closed or broken.
+    """
+
+    max_connect_attempts = int(get_config().get("VECTOR_DB_CONNECT_ATTEMPTS", 3))
+    connect_wait = float(get_config().get("VECTOR_DB_CONNECT_WAIT", 2))
+
+    def __init__(self):
+        self._client = None
+        self._async_client = None
+        # Loop the async client was connected on, its close has to run there
+        self._async_loop = None
+        self._lock = threading.Lock()
+        self._async_lock = None
+
+    def __connect__(self):
+        for attempt in range(1, self.max_connect_attempts + 1):
+            try:
+                client = get_vector_db_client()
+                logger.info("Vector DB client connected")
+                return client
+            except Exception as e:
+                logger.error(f"Vector DB connection attempt {attempt} failed, {e}")
+                if attempt == self.max_connect_attempts:
+                    raise
+                time.sleep(self.connect_wait)
+
+    def connect(self):
+        return self.get_client()
+
+    def get_client(self):
+        client = self._client
+        if client is not None and client.is_connected():
+            return client
+        with self._lock:
+            if self._client is None or not self._client.is_connected():
+                self.__close_client__(self._client)
+                self._client = self.__connect__()
+            return self._client
+
+    async def get_async_client(self):
+        client = self._async_client
+        if client is not None and client.is_connected():
+            return client
+        if self._async_lock is None:
+            self._async_lock = asyncio.Lock()
+        async with self._async_lock:
+            if self._async_client is None or not self._async_client.is_connected():
+                self.__drop_async_client__()
+                # The async client relies on the sync one to start the embedded server in local mode
+                await asyncio.to_thread(self.get_client)
+                for attempt in range(1, self.max_connect_attempts + 1):
+                    try:
+                        async_client = get_async_vector_db_client()
+                        await async_client.connect()
+                        self._async_client, self._async_loop = async_client, asyncio.get_running_loop()
+                        break
+                    except Exception as e:
+                        logger.error(f"Async vector DB connection attempt {attempt} failed, {e}")
+                        if attempt == self.max_connect_attempts:
+                            raise
+                        await asyncio.sleep(self.connect_wait)
+            return self._async_client
+
+    def invalidate(self):
+        with self._lock:
+            self.__close_client__(self._client)
+            self._client = None
+        self.__drop_async_client__()
+
+    def __drop_async_client__(self):
+        """
+            Forgets the async client and schedules its close on its loop, which releases its connections and gRPC
+            channel. Called from the loop or from the threads of the sync sessions.
+        """
+        client, loop = self._async_client, self._async_loop
+        self._async_client = self._async_loop = None
+        if client is None or loop is None or loop.is_closed():
+            return
+        try:
+            asyncio.run_coroutine_threadsafe(self.__aclose_client__(client), loop)
+        except RuntimeError as e:
+            logger.error(f"Failed while closing async vector DB client, {e}")
+
+    def is_healthy(self):
+        try:
+            return self._client is not None and self._client.is_ready()
+        except Exception as e:
+            logger.error(f"Vector DB health check failed, {e}")
+            return False
+
+    @staticmethod
+    def __close_client__(client):
+        try:
+            if client is not None:
+                client.close()
+        except Exception as e:
+            logger.error(f"Failed while closing vector DB client, {e}")
+
+    @staticmethod
+    async def __aclose_client__(client):
+        try:
+            await client.close()
+        except Exception as e:
+            logger.error(f"Failed while closing async vector DB client, {e}")
+
+    async def aclose(self):
+        if self._async_client is not None:
+            await self.__aclose_client__(self._async_client)
+            self._async_client = self._async_loop = None
+        with self._lock:
+            self.__close_client__(self._client)
+            self._client = None
+
+
+vector_db_client_manager = VectorDBClientManager()
+
+
+@contextmanager
+def vector_db_session():
+    client = vector_db_client_manager.get_client()
+    try:
+        yield client
+    except CONNECTION_ERRORS:
+        # Drop the broken connection, the next session reconnects
+        vector_db_client_manager.invalidate()
+        raise
 
 
 def get_vector_store(client, collection_name, embeddings):
@@ -64,10 +217,292 @@ def get_vector_store(client, collection_name, embeddings):
     return copilot_vectorstore
 
 
+def __get_object_properties__(doc, text_key="text"):
+    properties = {text_key: doc.page_content}
+    for key, value in doc.metadata.items():
+        properties[key] = value.isoformat() if hasattr(value, "isoformat") else value
+    return properties
+
+
+def insert_embeddings_batch(client, index_name, docs, vectors, doc_ids=None, batch_size=100, batch_mode="fixed"):
+    collection = client.collections.get(index_name)
+    batch_context = collection.batch.dynamic() if batch_mode == "dynamic" \
+        else collection.batch.fixed_size(batch_size=batch_size)
+    doc_ids = doc_ids or [str(uuid.uuid4()) for _ in docs]
+    with stage("vector_db_write"), batch_context as batch:
+        for doc, vector, doc_id in zip(docs, vectors, doc_ids):
+            batch.add_object(properties=__get_object_properties__(doc), uuid=doc_id, vector=vector)
+
+    failed_ids = set()
+    for failed_object in collection.batch.failed_objects:
+        failed_ids.add(str(failed_object.original_uuid))
+        logger.error(f"Failed to add object {failed_object.original_uuid} to {index_name}, {failed_object.message}")
+    return [doc_id for doc_id in doc_ids if doc_id not in failed_ids]
+
+
 def get_index_name(project_id, collection_name):
     return f"{project_id.lower()}_{collection_name.lower()}"
 
 
+class WeaviateBackend:
+    """
+        Vector backend on the Weaviate server (or the embedded server in the local profile).
+    """
+
+    name = "weaviate"
+
+    def start(self):
+        vector_db_client_manager.connect()
+
+    def is_ready(self):
+        return vector_db_client_manager.is_healthy()
+
+    async def aclose(self):
+        await vector_db_client_manager.aclose()
+
+    def exists(self, index_name):
+        with vector_db_session() as client:
+            return client.collections.exists(index_name.lower())
+
+    def count(self, index_name):
+        with vector_db_session() as client:
+            collection = client.collections.get(index_name.lower())
+            if collection:
+                response = collection.aggregate.over_all(total_count=True)
+                return response.total_count
+
+    def prepare(self, index_name, embeddings):
+        # Creates the collection schema on first use. The properties chunks are deleted by are tokenized as whole
+        # values: with the default word tokenization, an equal filter on a path matches every path with the same words
+        with vector_db_session() as client:
+            if client.collections.exists(index_name.lower()):
+                return
+            try:
+                client.collections.create(
+                    index_name.lower(), vectorizer_config=wvc.config.Configure.Vectorizer.none(),
+                    properties=[wvc.config.Property(name="text", data_type=wvc.config.DataType.TEXT)] +
+                               [wvc.config.Property(name=key, data_type=wvc.config.DataType.TEXT,
+                                                    tokenization=wvc.config.Tokenization.FIELD)
+                                for key in DELETE_FILTER_KEYS])
+            except UnexpectedStatusCodeError:
+                # Another worker created it first
+                if not client.collections.exists(index_name.lower()):
+                    raise
+
+    def insert(self, index_name, docs, vectors, doc_ids, batch_size=100, batch_mode="fixed"):
+        with vector_db_session() as client:
+            return insert_embeddings_batch(client, index_name.lower(), docs, vectors, doc_ids, batch_size, batch_mode)
+
+    def search(self, index_name, embedded_query, limit, with_distances=False):
+        with vector_db_session() as client:
+            collection = client.collections.get(index_name)
+            response = collection.query.near_vector(near_vector=embedded_query, limit=limit,
+                                                    return_metadata=wvc.query.MetadataQuery(distance=True))
+        return __parse_vector_search_response__(response, with_distances)
+
+    async def asearch(self, index_name, embedded_query, limit, with_distances=False):
+        client = await vector_db_client_manager.get_async_client()
+        try:
+            collection = client.collections.get(index_name)
+            response = await collection.query.near_vector(near_vector=embedded_query, limit=limit,
+                                                          return_metadata=wvc.query.MetadataQuery(distance=True))
+        except CONNECTION_ERRORS:
+            vector_db_client_manager.invalidate()
+            raise
+        return __parse_vector_search_response__(response, with_distances)
+
+    async def ahybrid_search(self, index_name, query, embedded_query, limit, alpha):
+        client = await vector_db_client_manager.get_async_client()
+        try:
+            collection = client.collections.get(index_name)
+            response = await collection.query.hybrid(query=query, query_properties=["source^2", "text"],
+                                                     vector=embedded_query, alpha=alpha,
+                                                     fusion_type=HybridFusion.RELATIVE_SCORE, limit=limit,
+                                                     return_metadata=wvc.query.MetadataQuery(score=True))
+        except CONNECTION_ERRORS:
+            vector_db_client_manager.invalidate()
+            raise
+        return __parse_hybrid_search_response__(response)
+
+    def offload(self, index_name):
+        # Not supported, a collection per project keeps its shards loaded in the Weaviate server. Unloading them
+        # requires the projects to be tenants of one multi-tenant collection, set COLD when idle
+        pass
+
+    def delete(self, index_name, ids):
+        ids = list(ids)
+        with vector_db_session() as client:
+            collection = client.collections.get(index_name)
+            for start in range(0, len(ids), delete_batch_size):
+                collection.data.delete_many(where=wvc.query.Filter.by_id().contains_any(
+                    ids[start:start + delete_batch_size]))
+
+    def delete_where(self, index_name, filters, keep_ids=()):
+        """
+            Deletes the objects whose properties equal `filters` with delete_many, except `keep_ids`, returns their
+            ids. Collections created before the filter properties were field tokenized are scanned for the exact
+            values and their objects deleted by id.
+        """
+        where = None
+        for key, value in filters.items():
+            condition = wvc.query.Filter.by_property(key).equal(value)
+            where = condition if where is None else where & condition
+        if keep_ids:
+            where = where & wvc.query.Filter.all_of([wvc.query.Filter.by_id().not_equal(doc_id)
+                                                     for doc_id in keep_ids])
+        deleted_ids = []
+        with vector_db_session() as client:
+            collection = client.collections.get(index_name.lower())
+            tokenization = {prop.name: prop.tokenization for prop in collection.config.get().properties}
+            if any(tokenization.get(key) not in (None, wvc.config.Tokenization.FIELD) for key in filters):
+                deleted_ids = [str(obj.uuid) for obj in collection.iterator(return_properties=list(filters))
+                               if all(obj.properties.get(key) == value for key, value in filters.items()) and
+                               str(obj.uuid) not in keep_ids]
+                self.delete(index_name, deleted_ids)
+                return deleted_ids
+            # One request deletes at most QUERY_MAXIMUM_RESULTS objects
+            while True:
+                result = collection.data.delete_many(where=where, verbose=True)
+                deleted_ids.extend(str(obj.uuid) for obj in result.objects if obj.successful)
+                if not result.successful:
+                    break
+        return deleted_ids
+
+    def iter_rows(self, index_name):
+        """
+            Yields the id and the properties of every object of the collection.
+        """
+        with vector_db_session() as client:
+            for obj in client.collections.get(index_name.lower()).iterator():
+                yield str(obj.uuid), obj.properties
+
+    def list_collections(self):
+        with vector_db_session() as client:
+            return sorted(name.lower() for name in client.collections.list_all(simple=True))
+
+    def compact(self, index_name):
+        # Weaviate compacts its segments and removes the deleted objects in the background
+        return None
+
+    def drop(self, index_name):
+        with vector_db_session() as client:
+            client.collections.delete(index_name.lower())
+
+
+class LocalBackend:
+    """
+        Vector backend on in-process LocalVectorIndex instances, one folder per collection under LOCAL_INDEX.path
+        (VECTOR_DB_PATH/local_index by default).
+        Searches run on the I/O pool, the memory-mapped segments are shared by every request of the process.
+    """
+
+    name = "local"
+
+    def __init__(self, index_config: LocalIndexConfig):
+        self.config = index_config
+        self.path = index_config.path or os.path.join(vector_db_path, "local_index")
+        self._indexes: dict[str, LocalVectorIndex] = {}
+        self._lock = threading.Lock()
+
+    def __get_index__(self, index_name) -> LocalVectorIndex:
+        index_name = index_name.lower()
+        if (index := self._indexes.get(index_name)) is None:
+            with self._lock:
+                if (index := self._indexes.get(index_name)) is None:
+                    index = LocalVectorIndex(os.path.join(self.path, index_name),
+                                             ivf_threshold=self.config.ivf_threshold, n_probe=self.config.n_probe,
+                                             merge_segment_rows=self.config.merge_segment_rows,
+                                             merge_factor=self.config.merge_factor)
+                    self._indexes[index_name] = index
+        return index
+
+    def start(self):
+        os.makedirs(self.path, exist_ok=True)
+
+    def is_ready(self):
+        return os.path.isdir(self.path)
+
+    async def aclose(self):
+        with self._lock:
+            for index in self._indexes.values():
+                index.unload()
+            self._indexes.clear()
+
+    def exists(self, index_name):
+        return self.__get_index__(index_name).exists()
+
+    def count(self, index_name):
+        return self.__get_index__(index_name).count()
+
+    def prepare(self, index_name, embeddings):
+        pass
+
+    def insert(self, index_name, docs, vectors, doc_ids, batch_size=100, batch_mode="fixed"):
+        with stage("vector_db_write"):
+            return self.__get_index__(index_name).add(docs, vectors, doc_ids)
+
+    def search(self, index_name, embedded_query, limit, with_distances=False):
+        results = []
+        for doc, distance in self.__get_index__(index_name).search(embedded_query, limit):
+            doc.metadata["score"] = f"{distance:.2f}"
+            results.append((doc, distance) if with_distances else doc)
+        return results
+
+    async def asearch(self, index_name, embedded_query, limit, with_distances=False):
+        return await run_io(self.search, index_name, embedded_query, limit, with_distances)
+
+    def offload(self, index_name):
+        with self._lock:
+            index = self._indexes.pop(index_name.lower(), None)
+        if index is not None:
+            index.unload()
+
+    def delete(self, index_name, ids):
+        self.__get_index__(index_name).delete(ids)
+
+    def delete_where(self, index_name, filters, keep_ids=()):
+        index = self.__get_index__(index_name)
+        ids = [doc_id for doc_id, record in index.iter_rows()
+               if all(record["metadata"].get(key) == value for key, value in filters.items()) and
+               doc_id not in keep_ids]
+        if ids:
+            index.delete(ids)
+        return ids
+
+    def iter_rows(self, index_name):
+        for doc_id, record in self.__get_index__(index_name).iter_rows():
+            yield doc_id, dict(record["metadata"], text=record["text"])
+
+    def list_collections(self):
+        if not os.path.isdir(self.path):
+            return []
+        return sorted(name for name in os.listdir(self.path)
+                      if os.path.exists(os.path.join(self.path, name, "index.json")))
+
+    def compact(self, index_name):
+        return self.__get_index__(index_name).compact()
+
+    def drop(self, index_name):
+        self.__get_index__(index_name).drop()
+
+
+def get_vector_backend():
+    if vector_backend_name == LocalBackend.name:
+        return LocalBackend(LocalIndexConfig(**(get_config().get("LOCAL_INDEX") or {})))
+    return WeaviateBackend()
+
+
+vector_backend = get_vector_backend()
+
+
+def is_schema_exists(index_name):
+    return vector_backend.exists(index_name)
+
+
+def get_row_count(index_name):
+    return vector_backend.count(index_name)
+
+
 def __get_meta_data(prop):
     return str(prop) if isinstance(prop, uuid.UUID) else prop
 
@@ -98,12 +533,15 @@ def __parse_hybrid_search_response__(responses):
     return results
 
 
-def __parse_vector_search_response__(responses):
+def __parse_vector_search_response__(responses, with_distances=False):
+    """
+        Documents of a near_vector response, or (Document, distance) pairs when the unrounded distances are needed.
+    """
     results = []
     for resp in responses.objects:
         result = __populate_result__(resp, resp.metadata.distance)
         if result:
-            results.append(result)
+            results.append((result, resp.metadata.distance) if with_distances else result)
     return results
 
 
@@ -111,7 +549,7 @@ def __parse_vector_search_response__(responses):
 # You can use the alpha argument to weight the keyword (bm25) or vector search results.
 # An alpha of 1 is for a pure vector search and 0 is for a pure keyword search. The default is 0.75.
 def execute_hybrid_search_with_filters(query, index_name, limit, filters, alpha=1):
-    with get_vector_db_client() as client:
+    with vector_db_session() as client:
         embeddings = get_embeddings_model()
         embedded_query = embeddings.embed_query(query)
         collection = client.collections.get(index_name)
@@ -129,7 +567,7 @@ def execute_hybrid_search_with_filters(query, index_name, limit, filters, alpha=
 
 
 def execute_hybrid_search_without_filters(query, index_name, limit, alpha=1):
-    with get_vector_db_client() as client:
+    with vector_db_session() as client:
         embeddings = get_embeddings_model()
         if query:
             if not embeddings:
@@ -156,7 +594,7 @@ def execute_pure_vector_search_with_filters(query, index_name, search_limit, que
     if not embeddings:
         raise RuntimeError(EMBEDDINGS_MODEL_NOT_AVAILABLE)
     embedded_query = embeddings.embed_query(query)
-    with get_vector_db_client() as client:
+    with vector_db_session() as client:
         collection = client.collections.get(index_name)
         response = collection.query.near_vector(near_vector=embedded_query, limit=search_limit, filters=query_filters,
                                                 return_metadata=wvc.query.MetadataQuery(distance=True))
@@ -164,37 +602,168 @@ def execute_pure_vector_search_with_filters(query, index_name, search_limit, que
         return __parse_vector_search_response__(response)
 
 
-def execute_pure_vector_search_without_filters(query, index_name, search_limit):
+def embed_query_cached(query):
     embeddings = get_embeddings_model()
     if not embeddings:
         raise RuntimeError(EMBEDDINGS_MODEL_NOT_AVAILABLE)
-    embedded_query = embeddings.embed_query(query)
-    with get_vector_db_client() as client:
-        collection = client.collections.get(index_name)
-        response = collection.query.near_vector(near_vector=embedded_query, limit=search_limit,
-                                                return_metadata=wvc.query.MetadataQuery(distance=True))
+    model_version = get_embeddings_model_version()
+    if (embedded_query := retrieval_cache.get_embedding(query, model_version)) is None:
+        with stage("query_encoding"):
+            embedded_query = embeddings.embed_query(query)
+        retrieval_cache.set_embedding(query, model_version, embedded_query)
+    return embedded_query
 
-        return __parse_vector_search_response__(response)
+
+def execute_pure_vector_search_without_filters(query, index_name, search_limit):
+    embedded_query = embed_query_cached(query)
+    if (cached_results := retrieval_cache.get_results(embedded_query, index_name, search_limit)) is not None:
+        return cached_results
+    with stage("vector_search"):
+        results = vector_backend.search(index_name, embedded_query, search_limit)
+    retrieval_cache.set_results(embedded_query, index_name, search_limit, results)
+    return results
+
+
+async def aembed_query_cached(query):
+    model_version = await embedding_service.aversion()
+    if (embedded_query := await retrieval_cache.aget_embedding(query, model_version)) is None:
+        with stage("query_encoding"):
+            [embedded_query] = await embedding_service.aembed([query])
+        await retrieval_cache.aset_embedding(query, model_version, embedded_query)
+    return embedded_query
+
+
+async def aexecute_pure_vector_search_without_filters(query, index_name, search_limit):
+    embedded_query = await aembed_query_cached(query)
+    return await aexecute_pure_vector_search_by_vector(embedded_query, index_name, search_limit)
+
+
+async def aexecute_pure_vector_search_by_vector(embedded_query, index_name, search_limit):
+    if (cached_results := await retrieval_cache.aget_results(embedded_query, index_name, search_limit)) is not None:
+        return cached_results
+    with stage("vector_search"):
+        results = await vector_backend.asearch(index_name, embedded_query, search_limit)
+    await retrieval_cache.aset_results(embedded_query, index_name, search_limit, results)
+    return results
+
+
+def fuse_relative_scores(vector_results, keyword_results, alpha, limit):
+    """
+        Relative score fusion, as Weaviate does it: the vector similarities and the BM25 scores are min-max normalized
+        separately and summed as alpha * vector + (1 - alpha) * keyword. An alpha of 1 is a pure vector search.
+    """
+
+    def normalize(scored_docs):
+        if not scored_docs:
+            return {}
+        scores = [score for _, score in scored_docs]
+        low, high = min(scores), max(scores)
+        return {doc.metadata["id"]: (score - low) / (high - low) if high > low else 1.0 for doc, score in scored_docs}
+
+    documents = {doc.metadata["id"]: doc for doc, _ in keyword_results + vector_results}
+    vector_scores, keyword_scores = normalize(vector_results), normalize(keyword_results)
+    fused = {doc_id: alpha * vector_scores.get(doc_id, 0.0) + (1 - alpha) * keyword_scores.get(doc_id, 0.0)
+             for doc_id in documents}
+    results = []
+    for doc_id in sorted(fused, key=fused.get, reverse=True)[:limit]:
+        document = documents[doc_id]
+        document.metadata["score"] = f"{fused[doc_id]:.2f}"
+        results.append(document)
+    return results
+
+
+async def aexecute_hybrid_search_by_vector(query, embedded_query, index_name, search_limit, alpha):
+    """
+        BM25 + vector search. The fusion runs in-process on the local keyword index unless HYBRID_PUSHDOWN hands the
+        whole query to Weaviate.
+    """
+    search_type = f"hybrid:{alpha}"
+    if (cached_results := await retrieval_cache.aget_results(embedded_query, index_name, search_limit,
+                                                             search_type)) is not None:
+        return cached_results
+    if hybrid_pushdown and vector_backend.name == WeaviateBackend.name:
+        with stage("vector_search"):
+            results = await vector_backend.ahybrid_search(index_name, query, embedded_query, search_limit, alpha)
+    else:
+        candidates = search_limit * hybrid_candidates_factor
+
+        async def keyword_search():
+            keyword_index = keyword_indexes.get(index_name)
+            if not keyword_index.exists():
+                await run_io(backfill_keyword_index, index_name)
+            with stage("keyword_search"):
+                return await run_io(keyword_index.search, query, candidates)
+
+        with stage("vector_search"):
+            vector_hits, keyword_results = await asyncio.gather(
+                vector_backend.asearch(index_name, embedded_query, candidates, with_distances=True), keyword_search())
+        # Distances are turned into similarities so that higher is better on both sides, the rounded score of the
+        # metadata would tie close candidates
+        vector_results = [(doc, 1.0 - distance) for doc, distance in vector_hits]
+        results = fuse_relative_scores(vector_results, keyword_results, alpha, search_limit)
+    await retrieval_cache.aset_results(embedded_query, index_name, search_limit, results, search_type)
+    return results
+
+
+def backfill_keyword_index(index_name):
+    """
+        Builds the keyword index of a collection ingested before keyword indexes existed from the chunks of the
+        vector store, returns the number of chunks added. Chunks already indexed are skipped.
+    """
+    if not vector_backend.exists(index_name):
+        return 0
+    rows = ((doc_id, str(properties.get("text", "")),
+             {key: __get_meta_data(value) for key, value in properties.items() if key != "text"})
+            for doc_id, properties in vector_backend.iter_rows(index_name))
+    with stage("keyword_backfill"):
+        return keyword_indexes.get(index_name).backfill(rows)
+
+
+def insert_documents(index_name, docs, vectors, batch_size=100, batch_mode="fixed", doc_ids=None):
+    """
+        Writes a batch of chunks to the vector backend, then adds the chunks that were stored to the keyword index.
+    """
+    doc_ids = doc_ids or [str(uuid.uuid4()) for _ in docs]
+    stored_ids = vector_backend.insert(index_name, docs, vectors, doc_ids, batch_size, batch_mode)
+    # Objects the backend failed to store are left out of the keyword index as well
+    stored = set(stored_ids)
+    stored_docs = [(doc_id, doc) for doc_id, doc in zip(doc_ids, docs) if doc_id in stored]
+    keyword_indexes.get(index_name).add([doc_id for doc_id, _ in stored_docs], [doc for _, doc in stored_docs])
+    return stored_ids
 
 
 def delete_documents_by_ids(ids, index_name):
-    with get_vector_db_client() as client:
-        if ids is None:
-            raise ValueError("No ids provided to delete.")
-        for doc_id in ids:
-            collection = client.collections.get(index_name)
-            collection.data.delete_by_id(doc_id)
+    if ids is None:
+        raise ValueError("No ids provided to delete.")
+    with stage("vector_db_delete"):
+        vector_backend.delete(index_name, ids)
+        keyword_indexes.get(index_name).delete(ids)
+
+
+def delete_documents_by_filter(index_name, keep_ids=frozenset(), **filters):
+    """
+        Deletes every chunk whose metadata matches all `filters` (DELETE_FILTER_KEYS), except `keep_ids`, from the
+        vector store and the keyword index, returns their ids. `keep_ids` is sent in the delete filter, one operand
+        per id, it only lists the matching chunks to keep.
+    """
+    if not filters or set(filters) - set(DELETE_FILTER_KEYS):
+        raise ValueError(f"Chunks are deleted by {', '.join(DELETE_FILTER_KEYS)}, got {sorted(filters)}")
+    with stage("vector_db_delete"):
+        ids = vector_backend.delete_where(index_name, filters, keep_ids) if vector_backend.exists(index_name) else []
+        keyword_indexes.get(index_name).delete(ids)
+    logger.info(f"Deleted {len(ids)} chunks of {index_name} matching {filters}")
+    return ids
 
 
 def delete_collection(collection_name, project_id):
     index_name = get_index_name(project_id, collection_name)
-    with get_vector_db_client() as client:
-        client.collections.delete(index_name)
+    vector_backend.drop(index_name)
+    keyword_indexes.get(index_name).drop()
 
 
 def add_embeddings(docs, embeddings, collection_name, project_id):
     index_name = get_index_name(project_id, collection_name)
-    with get_vector_db_client() as client:
+    with vector_db_session() as client:
         copilot_vectorstore = get_vector_store(client, index_name, embeddings)
         copilot_vectorstore.add_documents(docs)
     row_count = get_row_count(index_name)
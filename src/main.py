@@ -1,3 +1,4 @@
+import asyncio
 import os
 import pathlib
 from contextlib import asynccontextmanager
@@ -7,14 +8,20 @@ import uvicorn
 from fastapi import FastAPI
 from fastapi.logger import logger
 from fastapi_pagination import add_pagination
-from langchain_community.embeddings import SentenceTransformerEmbeddings
 
 from src.config.config_client import config
 from src.routes import document_router as document
-from src.schemas.pydantic_models import SBertConfig
 
 from src.agent.utils import AgentException as SourceException
-from src.middleware import add_process_time, source_exception_handler
+from src.agent.embedding_service import embedding_service
+from src.agent.executors import executors
+from src.agent.ingestion_jobs import ingestion_queue
+from src.agent.llm_gateway import llm_gateway
+from src.agent.model_registry import model_registry
+from src.agent.slack_outbox import slack_outbox
+from src.agent.tenants import tenants
+from src.agent.vector_db_client import vector_backend
+from src.middleware import add_process_time, source_exception_handler, metrics_endpoint, readiness_endpoint
 
 import warnings
 
@@ -22,27 +29,39 @@ warnings.filterwarnings("ignore")
 
 os.environ["ENVIRONMENT_NAME"] = "local"
 
-sentence_encoder_models = {}
 
-
-def load_embeddings_model(system_config):
-    sbert_encoder_config = SBertConfig(**system_config.get("SBERT_CONFIG"))
-    sbert_encoder_version = sbert_encoder_config.version
-    logger.info(f"Sentence Embeddings Model loaded version: {sbert_encoder_version}")
-    sentence_encoder_model = SentenceTransformerEmbeddings(model_name=sbert_encoder_config.model_path)
-    return sentence_encoder_model, sbert_encoder_version
+async def load_models():
+    # Already loaded by the gunicorn master in preload mode, only the warmup encode is left. In the embedding
+    # service client mode, waits for the embedding server instead
+    try:
+        await embedding_service.start()
+    except Exception as e:
+        logger.error(f"Failed while loading the sentence encoder, {e}", exc_info=True)
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    # Load ML models
-    sbert_encoder_model, sbert_encoder_model_version = load_embeddings_model(config)
-    sentence_encoder_models['SBERT'] = sbert_encoder_model
-    sentence_encoder_models['SBERT_VERSION'] = sbert_encoder_model_version
+    # Worker pools for blocking work and the vector backend (shared Weaviate connection or local index)
+    executors.start()
+    vector_backend.start()
+    ingestion_queue.start()
+    tenants.start()
+    llm_gateway.start()
+    slack_outbox.start()
+    # Load ML models in the background, /ready reports when the encoder is warmed up
+    model_loading = asyncio.create_task(load_models())
 
     yield
     # Clean up the ML models and release the resources
-    sentence_encoder_models.clear()
+    model_loading.cancel()
+    await embedding_service.stop()
+    await slack_outbox.stop()
+    await tenants.stop()
+    await llm_gateway.aclose()
+    await ingestion_queue.stop()
+    await vector_backend.aclose()
+    executors.shutdown()
+    model_registry.clear()
 
 
 seed(42)
@@ -58,6 +77,8 @@ def create_app() -> FastAPI:
     fastapi_app = FastAPI(title="Document Agent",
                           description="Document Agent implementation",
                           version="1.0.0",
+                          # Path prefix of the reverse proxy, gunicorn's uvicorn workers do not take --root-path
+                          root_path=os.environ.get("ROOT_PATH", ""),
                           lifespan=lifespan,
                           openapi_tags=get_openapi_tags()
                           )
@@ -66,6 +87,8 @@ def create_app() -> FastAPI:
     fastapi_app.add_exception_handler(SourceException, source_exception_handler)
 
     fastapi_app.include_router(document.router)
+    fastapi_app.add_route("/metrics", metrics_endpoint, include_in_schema=False)
+    fastapi_app.add_route("/ready", readiness_endpoint, include_in_schema=False)
 
     return fastapi_app
 
@@ -1,7 +1,11 @@
 import time
 from fastapi import Request
 from fastapi.logger import logger
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, Response
+from src.agent.embedding_service import embedding_service
+from src.agent.model_registry import model_registry
+from src.agent.vector_db_client import vector_backend
+from src.agent.metrics import request_timings, format_server_timing, render_metrics
 from src.agent.utils import AgentException as SourceException
 from src.schemas.pydantic_models import SystemMessage
 from fastapi.encoders import jsonable_encoder
@@ -12,10 +16,16 @@ class ErrorTemplate:
 
 
 async def add_process_time(request: Request, call_next):
-    start_time = time.time()
-    response = await call_next(request)
-    process_time = (time.time() - start_time) * 1000
+    start_time = time.perf_counter()
+    timings = {}
+    token = request_timings.set(timings)
+    try:
+        response = await call_next(request)
+    finally:
+        request_timings.reset(token)
+    process_time = (time.perf_counter() - start_time) * 1000
     response.headers["X-Process-Time"] = str(process_time)
+    response.headers["Server-Timing"] = format_server_timing(timings, process_time / 1000)
     return response
 
 
@@ -24,3 +34,17 @@ async def source_exception_handler(request: Request, ex: SourceException):
         status_code=ex.code,
         content=jsonable_encoder(SystemMessage(code=ex.code, message=ex.message, displayMessage=ex.displayMessage)),
     )
+
+
+async def metrics_endpoint(request: Request):
+    content, content_type = render_metrics()
+    return Response(content=content, media_type=content_type)
+
+
+async def readiness_endpoint(request: Request):
+    # Liveness is the process answering at all, readiness is the encoder warmed up and the vector store reachable
+    checks = dict(model=await embedding_service.ais_ready(), vector_store=vector_backend.is_ready())
+    content = dict(ready=all(checks.values()), checks=checks, model_version=embedding_service.version,
+                   model_backend=model_registry.backend,
+                   model_load_seconds=model_registry.load_seconds, model_error=model_registry.error)
+    return JSONResponse(status_code=200 if content["ready"] else 503, content=content)
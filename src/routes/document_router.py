@@ -1,6 +1,17 @@
-from typing import Optional, List
-from fastapi import Query, APIRouter, UploadFile, File
+import json
+from typing import Optional, List, Literal
+from fastapi import Query, APIRouter, UploadFile, File, Response, Header
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import StreamingResponse
+from src.agent.answer_cache import answer_cache
 from src.agent.controller import DocumentAgent
+from src.agent.executors import run_io
+from src.agent.ingestion_jobs import ingestion_queue
+from src.agent.maintenance import purge_document
+from src.agent.tenants import tenants
+from src.agent.retrieval_cache import retrieval_cache
+from src.schemas.pydantic_models import DocumentPurgeResult, IngestionJobStatus
+from src.startup_constants import INGESTION_JOB_HEADER, PROJECT_ID_HEADER
 
 router = APIRouter(
     prefix="/agent-document",
@@ -19,6 +30,7 @@ tags_metadata = {
              summary="Generate the Embeddings and Use the Document Space to answer the question"
              )
 async def answer_question_using_documents_space(
+        response: Response,
         questions: List[str] = Query(
             default=None,
             description="List of questions to answer"
@@ -27,8 +39,170 @@ async def answer_question_using_documents_space(
             default=False,
             description="Override the existing embeddings if exists for the given project"
         ),
+        search_mode: Optional[Literal["vector", "hybrid"]] = Query(
+            default=None,
+            description="Pure vector search or hybrid BM25 + vector search, defaults to SEARCH_MODE"
+        ),
+        project_id: Optional[str] = Header(
+            default=None,
+            alias=PROJECT_ID_HEADER,
+            description="Project whose documents are used, the shared collection when not provided"
+        ),
+        file: UploadFile = File(None)
+):
+    agent = DocumentAgent(queries=questions, file=file, override=override, search_mode=search_mode,
+                          project_id=project_id)
+    agent_response = await agent.execute()
+    if agent.ingestion_job:
+        response.headers[INGESTION_JOB_HEADER] = agent.ingestion_job.job_id
+    return agent_response
+
+
+@router.post("/execute/stream",
+             tags=["agent"],
+             status_code=200,
+             summary="Stream the retrieved documents and the answer tokens of every question as they are ready"
+             )
+async def stream_answers_using_documents_space(
+        questions: List[str] = Query(
+            default=None,
+            description="List of questions to answer"
+        ),
+        override: Optional[bool] = Query(
+            default=False,
+            description="Override the existing embeddings if exists for the given project"
+        ),
+        response_format: Literal["ndjson", "sse"] = Query(
+            default="ndjson",
+            description="Newline delimited JSON or server-sent events"
+        ),
+        search_mode: Optional[Literal["vector", "hybrid"]] = Query(
+            default=None,
+            description="Pure vector search or hybrid BM25 + vector search, defaults to SEARCH_MODE"
+        ),
+        project_id: Optional[str] = Header(
+            default=None,
+            alias=PROJECT_ID_HEADER,
+            description="Project whose documents are used, the shared collection when not provided"
+        ),
         file: UploadFile = File(None)
 ):
-    agent = DocumentAgent(queries=questions, file=file, override=override)
-    response = await agent.execute()
-    return response
+    agent = DocumentAgent(queries=questions, file=file, override=override, search_mode=search_mode,
+                          project_id=project_id)
+    # The upload has to be consumed and the questions embedded before the response starts streaming, errors are
+    # returned with their status code
+    await agent.ingest()
+    embedded_queries = await agent.embed_queries()
+    headers = {INGESTION_JOB_HEADER: agent.ingestion_job.job_id} if agent.ingestion_job else None
+
+    async def event_stream():
+        async for event in agent.stream(embedded_queries):
+            payload = json.dumps(jsonable_encoder(event))
+            if response_format == "sse":
+                yield f"event: {event['event']}\ndata: {payload}\n\n"
+            else:
+                yield f"{payload}\n"
+
+    media_type = "text/event-stream" if response_format == "sse" else "application/x-ndjson"
+    return StreamingResponse(event_stream(), media_type=media_type, headers=headers)
+
+
+@router.post("/ingest",
+             tags=["agent"],
+             status_code=202,
+             response_model=IngestionJobStatus,
+             summary="Save the document and queue the generation of its embeddings"
+             )
+async def ingest_document(
+        override: Optional[bool] = Query(
+            default=False,
+            description="Override the existing document if a file with the same name exists"
+        ),
+        project_id: Optional[str] = Header(
+            default=None,
+            alias=PROJECT_ID_HEADER,
+            description="Project whose documents are used, the shared collection when not provided"
+        ),
+        file: UploadFile = File(...)
+):
+    agent = DocumentAgent(queries=[], file=file, override=override, project_id=project_id)
+    return await agent.ingest()
+
+
+@router.post("/reindex",
+             tags=["agent"],
+             status_code=202,
+             response_model=IngestionJobStatus,
+             summary="Rebuild the project's collection into a new version and switch to it once validated"
+             )
+async def reindex_collection(
+        project_id: Optional[str] = Header(
+            default=None,
+            alias=PROJECT_ID_HEADER,
+            description="Project whose documents are used, the shared collection when not provided"
+        ),
+):
+    return ingestion_queue.submit_reindex(tenants.resolve(project_id))
+
+
+@router.post("/maintenance",
+             tags=["agent"],
+             status_code=202,
+             response_model=IngestionJobStatus,
+             summary="Report the orphaned and duplicated chunks of the project's collection and compact it"
+             )
+async def maintain_collection(
+        fix: Optional[bool] = Query(
+            default=False,
+            description="Delete the orphaned and duplicated chunks and the collections left by a re-index"
+        ),
+        project_id: Optional[str] = Header(
+            default=None,
+            alias=PROJECT_ID_HEADER,
+            description="Project whose documents are used, the shared collection when not provided"
+        ),
+):
+    return ingestion_queue.submit_maintenance(tenants.resolve(project_id), fix=fix)
+
+
+@router.delete("/documents/{file_name}",
+               tags=["agent"],
+               status_code=200,
+               response_model=DocumentPurgeResult,
+               summary="Delete an uploaded document, its chunks and its embeddings"
+               )
+async def delete_document(
+        file_name: str,
+        project_id: Optional[str] = Header(
+            default=None,
+            alias=PROJECT_ID_HEADER,
+            description="Project whose documents are used, the shared collection when not provided"
+        ),
+):
+    return await run_io(purge_document, tenants.resolve(project_id), file_name)
+
+
+@router.get("/jobs/{job_id}",
+            tags=["agent"],
+            status_code=200,
+            response_model=IngestionJobStatus,
+            summary="Status and progress of an ingestion job"
+            )
+async def get_ingestion_job(
+        job_id: str,
+        project_id: Optional[str] = Header(
+            default=None,
+            alias=PROJECT_ID_HEADER,
+            description="Project whose documents are used, the shared collection when not provided"
+        ),
+):
+    return ingestion_queue.get(job_id, tenants.resolve(project_id))
+
+
+@router.get("/cache/stats",
+            tags=["agent"],
+            status_code=200,
+            summary="Size and hit rate of the answer, query embedding and search result caches"
+            )
+async def get_cache_stats():
+    return dict(answer=answer_cache.stats(), retrieval=await retrieval_cache.astats())
@@ -1,10 +1,122 @@
-from typing import Optional, Any
+from typing import Optional, Any, Literal, List
 from src.schemas.base import CoPilotBaseModel
 
 
 class SBertConfig(CoPilotBaseModel):
     model_path: str
     version: str
+    backend: Literal["torch", "onnx", "onnx-int8"] = "torch"
+    min_parity_cosine: float = 0.98
+
+
+class AnswerCacheConfig(CoPilotBaseModel):
+    enabled: bool = True
+    max_entries: int = 2048
+    ttl_seconds: float = 86400
+    similarity_threshold: float = 0.95
+
+
+class RetrievalCacheConfig(CoPilotBaseModel):
+    enabled: bool = True
+    backend: Literal["memory", "sqlite"] = "memory"
+    max_entries: int = 10000
+    sqlite_path: str = "data_weaviate/retrieval_cache.sqlite"
+    version_ttl_seconds: float = 1.0
+
+
+class LocalIndexConfig(CoPilotBaseModel):
+    path: Optional[str] = None
+    ivf_threshold: int = 200000
+    n_probe: int = 8
+    merge_segment_rows: int = 16384
+    merge_factor: int = 8
+
+
+class LLMGatewayConfig(CoPilotBaseModel):
+    max_concurrency: int = 16
+    per_request_concurrency: int = 4
+    requests_per_minute: int = 500
+    tokens_per_minute: int = 200000
+    expected_completion_tokens: int = 512
+    max_retries: int = 5
+    backoff_base_seconds: float = 0.5
+    backoff_max_seconds: float = 20
+    max_connections: int = 20
+    timeout_seconds: float = 60
+
+
+class EmbeddingServiceConfig(CoPilotBaseModel):
+    mode: Literal["local", "client"] = "local"
+    max_batch_size: int = 32
+    max_wait_ms: float = 5
+    socket_path: str = "/tmp/agent-embeddings.sock"
+    timeout_seconds: float = 60
+
+
+class ChunkerConfig(CoPilotBaseModel):
+    engine: Literal["streaming", "recursive"] = "recursive"
+    chunk_tokens: int = 160
+    overlap_tokens: int = 16
+    deduplicate: bool = True
+    near_duplicates: bool = True
+    near_duplicate_threshold: float = 0.9
+    shingle_size: int = 3
+    minhash_permutations: int = 64
+    minhash_bands: int = 16
+    strip_repeated_lines: bool = True
+    repeated_line_min_pages: int = 3
+    repeated_line_window_pages: int = 8
+    deduplicate_across_files: bool = False
+
+
+class ReindexConfig(CoPilotBaseModel):
+    max_chunks_per_second: float = 100
+    sample_queries: int = 50
+    sample_query_chars: int = 300
+    sample_top_k: int = 5
+    min_recall: float = 0.8
+    seed: int = 0
+    gc_delay_seconds: float = 60
+    keep_previous: bool = False
+    keep_failed: bool = False
+
+
+class SlackOutboxConfig(CoPilotBaseModel):
+    queue_size: int = 1000
+    max_attempts: int = 8
+    backoff_base_seconds: float = 1
+    backoff_max_seconds: float = 300
+    spool_dir: str = "spool/slack"
+    claim_interval_seconds: float = 60
+
+
+class TenantConfig(CoPilotBaseModel):
+    idle_seconds: float = 900
+    offload_interval_seconds: float = 60
+
+
+class Tenant(CoPilotBaseModel):
+    project_id: Optional[str] = None
+    index_name: str
+    upload_dir: str
+
+
+class TracingConfig(CoPilotBaseModel):
+    enabled: bool = False
+    exporter_path: str = "traces/spans.jsonl"
+
+
+class SavedUpload(CoPilotBaseModel):
+    file_location: str
+    content_hash: str
+    size: int
+    changed: bool
+
+
+class DocumentPurgeResult(CoPilotBaseModel):
+    file_name: str
+    chunks_deleted: int
+    file_deleted: bool
 
 
 class DocumentResult(CoPilotBaseModel):
@@ -18,3 +130,19 @@ class SystemMessage(CoPilotBaseModel):
     code: int
     message: str
     displayMessage: str
+
+
+class IngestionJobStatus(CoPilotBaseModel):
+    job_id: str
+    kind: Literal["ingestion", "reindex", "maintenance"] = "ingestion"
+    project_id: Optional[str] = None
+    status: Literal["queued", "running", "completed", "skipped", "failed"]
+    file_name: Optional[str] = None
+    created_at: float
+    started_at: Optional[float] = None
+    finished_at: Optional[float] = None
+    pages_parsed: int = 0
+    chunks_embedded: int = 0
+    files_ingested: List[str] = []
+    report: Optional[dict] = None
+    error: Optional[str] = None
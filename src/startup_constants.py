@@ -1,8 +1,16 @@
 APP_NAME = 'agent-document'
 PROJECT_ID_HEADER = "X-ProjectID"
+INGESTION_JOB_HEADER = "X-Ingestion-Job-ID"
 EMBEDDINGS_MODEL_NOT_AVAILABLE = "Embeddings model not available!!"
 GENERIC_ERROR = "Oops! We were not able to process your request."
 INVALID_PROJECT_ID = "Project ID not provided"
+PROJECT_ID_NOT_VALID = "Project ID may only contain letters, digits and underscores and must start with a letter."
+INGESTION_QUEUE_FULL = "Too many documents are waiting to be processed, please retry later."
+INGESTION_JOB_NOT_FOUND = "Ingestion job not found"
+REINDEX_IN_PROGRESS = "The collection is already being re-indexed, please retry later."
+EMBEDDINGS_MODEL_MISMATCH = "The documents are being indexed with another embeddings model, please retry later."
+UPLOAD_TOO_LARGE = "The document is too large to be processed."
+DOCUMENT_NOT_FOUND = "Document not found"
 DOCUMENT = "Document"
 METADATA = "metadata"
 CONTENT = "content"